@@ -0,0 +1,39 @@
+"""
+Gunicorn configuration for the Pomodoro Timer
+
+    gunicorn --config gunicorn.conf.py wsgi:application
+
+Every setting can be overridden through the environment. The app is
+preloaded in the master by default: wsgi.py warms the template, the log
+index, the rollups and the history cache once, and forked workers start
+with them already in memory. gthread workers let one process serve
+several requests at a time while sharing those caches.
+"""
+import multiprocessing
+import os
+import time
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# Each open /history/stream holds a thread for up to POMODORO_STREAM_MAX_SECONDS;
+# the default leaves 4 threads for other requests next to POMODORO_MAX_STREAMS=8
+threads = int(os.environ.get('GUNICORN_THREADS', '12'))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '0'))
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def pre_fork(server, worker):
+    # Stamped in the master; the forked worker inherits the attribute
+    worker.boot_started = time.monotonic()
+
+
+def post_worker_init(worker):
+    """Log how long the worker took from fork until it was ready to serve"""
+    boot_ms = (time.monotonic() - worker.boot_started) * 1000
+    worker.log.info('Worker %s booted in %.1f ms (preload_app=%s)', worker.pid, boot_ms, worker.cfg.preload_app)
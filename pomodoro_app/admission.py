@@ -0,0 +1,73 @@
+"""
+Admission control for the /log routes.
+
+``RateLimiter`` keeps a token bucket per client: ``rate`` tokens a second
+refill it up to ``burst``, and each request takes one. ``InFlight`` counts
+the /log requests a worker is currently handling, which together with the
+background writer's queue is the depth the load shedder compares against
+its limit. Both answer with the number of seconds a refused client should
+wait before trying again, for the Retry-After header.
+
+Buckets live in the worker, so with N workers a client can get up to N
+times the rate through; the limit is there to stop a runaway client or a
+retry storm, not to meter exact usage.
+"""
+import collections
+import math
+import threading
+import time
+
+
+class RateLimiter:
+    """Token buckets keyed by client; the least recently seen are forgotten beyond max_clients"""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = collections.OrderedDict()   # key -> (tokens, updated)
+        self.lock = threading.Lock()
+
+    def acquire(self, key, now=None):
+        """Take a token for key; return 0 if admitted, else the whole seconds until one is available"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = max(1, math.ceil((1 - tokens) / self.rate))
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return wait
+
+
+class InFlight:
+    """Number of requests currently inside a ``with`` block of this counter"""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            self.count += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.leave()
+
+    def enter_below(self, limit):
+        """Count one more unless limit are already in; return whether it was counted"""
+        with self.lock:
+            if self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.count -= 1
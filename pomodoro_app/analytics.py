@@ -0,0 +1,282 @@
+"""
+Vectorized reports over stored sessions for /analytics.
+
+Each worker loads a store's sessions once into NumPy columns: timestamps
+as int64 seconds, session type and action as small integer codes. The
+stream is converted ``LOAD_CHUNK_SIZE`` sessions at a time, so a long
+history never exists as Python objects all at once. Later
+loads read only the sessions appended since, resuming from the store
+cursor. Every report is then a handful of whole-array operations (masks,
+``bincount``, ``unique``) instead of a Python loop over session dicts.
+
+Finished reports are memoized in an LRU keyed by the store, the generation
+the columns were loaded at and the query, so repeated dashboard loads
+between two writes cost a memory read and a dictionary lookup.
+
+NumPy is optional: without it ``AVAILABLE`` is False and /analytics
+answers 503, while the rest of the app runs as before.
+"""
+import collections
+import datetime
+import itertools
+import threading
+
+import generation
+
+try:
+    import numpy as np
+except ImportError:  # analytics is optional; nothing else needs NumPy
+    np = None
+
+AVAILABLE = np is not None
+
+# Known names get fixed codes; anything else is coded as it first appears
+SESSION_TYPES = ('work', 'short_break', 'long_break')
+ACTIONS = ('completed', 'skipped')
+WORK = SESSION_TYPES.index('work')
+COMPLETED = ACTIONS.index('completed')
+SKIPPED = ACTIONS.index('skipped')
+
+SECONDS_PER_DAY = 86400
+HOURS_PER_WEEK = 7 * 24
+
+# 1970-01-01 was a Thursday; weekday 0 is Monday, as in datetime.weekday()
+EPOCH_WEEKDAY = 3
+
+# Sessions converted to arrays at a time while loading, which bounds the
+# Python objects held at once however long the history is
+LOAD_CHUNK_SIZE = 65536
+
+
+class Vocabulary:
+    """Stable integer codes for the distinct values of one text field"""
+
+    def __init__(self, known):
+        self.codes = {}
+        self.names = []
+        for name in known:
+            self.code(name)
+
+    def code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def encode(self, values):
+        """Return the codes of a list of values, looking each distinct value up once"""
+        distinct, inverse = np.unique(np.array(values, dtype=str), return_inverse=True)
+        return np.array([self.code(name) for name in distinct.tolist()], dtype=np.int16)[inverse.ravel()]
+
+
+def _timestamp_or_nat(text):
+    try:
+        return np.datetime64(text, 's')
+    except ValueError:
+        return np.datetime64('NaT')
+
+
+def parse_timestamps(texts):
+    """Return log timestamp strings as datetime64 seconds; unparseable ones become NaT"""
+    try:
+        return np.array(texts, dtype='datetime64[s]')
+    except ValueError:
+        return np.array([_timestamp_or_nat(text) for text in texts], dtype='datetime64[s]')
+
+
+Snapshot = collections.namedtuple('Snapshot', 'generation seconds type_codes action_codes types actions')
+
+
+class SessionColumns:
+    """Every session of one store as NumPy arrays, extended as the store grows"""
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.seen = None       # generation the columns were loaded at
+        self.cursor = 0        # store cursor after the last session loaded
+        self.types = Vocabulary(SESSION_TYPES)
+        self.actions = Vocabulary(ACTIONS)
+        self.seconds = np.empty(0, dtype=np.int64)
+        self.type_codes = np.empty(0, dtype=np.int16)
+        self.action_codes = np.empty(0, dtype=np.int16)
+
+    def refresh(self):
+        """Load the sessions stored since the last refresh and return a Snapshot of the columns
+
+        The arrays are replaced rather than resized, so a snapshot stays
+        valid while another thread refreshes.
+        """
+        with self.lock:
+            current = generation.current(self.store.path)
+            if current != self.seen:
+                if self.store.end_cursor() < self.cursor:
+                    self._reset()  # the store was replaced or truncated
+
+                cursor = self.cursor
+                seconds, type_codes, action_codes = [self.seconds], [self.type_codes], [self.action_codes]
+                sessions = self.store.stream(cursor=cursor)
+                while True:
+                    chunk = list(itertools.islice(sessions, LOAD_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    cursor = chunk[-1][0]
+                    stamps = parse_timestamps([session['timestamp'] for _, session in chunk])
+                    valid = ~np.isnat(stamps)
+                    seconds.append(stamps[valid].astype(np.int64))
+                    type_codes.append(self.types.encode([session['session_type'] for _, session in chunk])[valid])
+                    action_codes.append(self.actions.encode([session['action'] for _, session in chunk])[valid])
+
+                if len(seconds) > 1:
+                    self.seconds = np.concatenate(seconds)
+                    self.type_codes = np.concatenate(type_codes)
+                    self.action_codes = np.concatenate(action_codes)
+                self.cursor = cursor
+                self.seen = current
+
+            return Snapshot(self.seen, self.seconds, self.type_codes, self.action_codes,
+                            tuple(self.types.names), tuple(self.actions.names))
+
+
+def day_number(day):
+    """Return a date as the number of days since 1970-01-01"""
+    return (day - datetime.date(1970, 1, 1)).days
+
+
+def day_strings(days):
+    """Return day numbers since the epoch as YYYY-MM-DD strings"""
+    return np.asarray(days, dtype=np.int64).astype('datetime64[D]').astype(str).tolist()
+
+
+def epoch_seconds(bound):
+    return int(np.datetime64(bound, 's').astype(np.int64))
+
+
+def streaks(active_days, today):
+    """Return the longest and current runs of consecutive days in a sorted array of unique day numbers"""
+    if not active_days.size:
+        return {'longest': 0, 'longest_start': None, 'longest_end': None, 'current': 0}
+
+    # A run starts wherever the gap to the previous active day is not exactly one day
+    starts = np.flatnonzero(np.diff(active_days, prepend=active_days[0] - 2) != 1)
+    lengths = np.diff(np.append(starts, active_days.size))
+    longest = int(lengths.argmax())
+    start = starts[longest]
+    # The streak is still alive if it reached yesterday; today may not be done yet
+    current = int(lengths[-1]) if active_days[-1] >= today - 1 else 0
+    first, last = day_strings([active_days[start], active_days[start + lengths[longest] - 1]])
+    return {'longest': int(lengths[longest]), 'longest_start': first, 'longest_end': last, 'current': current}
+
+
+def build_report(snapshot, since=None, until=None, today=None, work_minutes=25):
+    """Compute every report from a Snapshot, restricted to [since, until)
+
+    Focus time is the number of completed work sessions times work_minutes:
+    the log records when a session ended, not how long it ran.
+    """
+    seconds, type_codes, action_codes = snapshot.seconds, snapshot.type_codes, snapshot.action_codes
+    if since is not None or until is not None:
+        in_range = np.ones(seconds.size, dtype=bool)
+        if since is not None:
+            in_range &= seconds >= epoch_seconds(since)
+        if until is not None:
+            in_range &= seconds < epoch_seconds(until)
+        seconds, type_codes, action_codes = seconds[in_range], type_codes[in_range], action_codes[in_range]
+
+    days = seconds // SECONDS_PER_DAY
+    completed = action_codes == COMPLETED
+    skipped = action_codes == SKIPPED
+    focus = completed & (type_codes == WORK)
+
+    # Completed work sessions by weekday and hour of the day
+    hour_of_week = (days[focus] + EPOCH_WEEKDAY) % 7 * 24 + seconds[focus] % SECONDS_PER_DAY // 3600
+    heatmap = np.bincount(hour_of_week, minlength=HOURS_PER_WEEK).reshape(7, 24)
+
+    day_values, day_index = np.unique(days, return_inverse=True)
+    day_index = day_index.ravel()
+    focus_sessions = np.bincount(day_index[focus], minlength=day_values.size)
+    daily = [
+        {'date': date, 'completed': done, 'skipped': dropped,
+         'focus_sessions': sessions, 'focus_minutes': sessions * work_minutes}
+        for date, done, dropped, sessions in zip(
+            day_strings(day_values),
+            np.bincount(day_index[completed], minlength=day_values.size).tolist(),
+            np.bincount(day_index[skipped], minlength=day_values.size).tolist(),
+            focus_sessions.tolist())
+    ]
+
+    # One bincount over (type, action) pairs gives every per-type count at once
+    pairs = type_codes.astype(np.int64) * len(snapshot.actions) + action_codes
+    counts = np.bincount(pairs, minlength=len(snapshot.types) * len(snapshot.actions))
+    counts = counts.reshape(len(snapshot.types), len(snapshot.actions))
+    completion_rates = {}
+    for name, done, dropped in zip(snapshot.types, counts[:, COMPLETED].tolist(), counts[:, SKIPPED].tolist()):
+        if done + dropped:
+            completion_rates[name] = {'completed': done, 'skipped': dropped, 'rate': done / (done + dropped)}
+
+    today = int(days.max()) if today is None and days.size else today
+    focus_total = int(focus_sessions.sum())
+    return {
+        'totals': {
+            'sessions': int(seconds.size),
+            'completed': int(completed.sum()),
+            'skipped': int(skipped.sum()),
+            'focus_sessions': focus_total,
+            'focus_minutes': focus_total * work_minutes,
+        },
+        'heatmap': heatmap.tolist(),
+        'daily': daily,
+        'completion_rates': completion_rates,
+        'streaks': streaks(np.unique(days[focus]), today if today is not None else 0),
+    }
+
+
+_columns = collections.OrderedDict()
+_reports = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def get_columns(store, max_stores):
+    """Return this worker's columns for store, forgetting the least recently used beyond max_stores"""
+    with _lock:
+        columns = _columns.pop(store.path, None)
+        if columns is None or columns.store is not store:
+            columns = SessionColumns(store)
+        _columns[store.path] = columns
+        while len(_columns) > max_stores:
+            _columns.popitem(last=False)
+        return columns
+
+
+def report(store, since=None, until=None, today=None, work_minutes=25, max_entries=64):
+    """Return (report, cached) for store, computing it only if the store changed since
+
+    today is a day number since the epoch and decides whether the newest
+    streak is still current; it defaults to the newest day in the data.
+    """
+    snapshot = get_columns(store, max_entries).refresh()
+    key = (store.path, snapshot.generation, since, until, today, work_minutes)
+    with _lock:
+        cached = _reports.get(key)
+        if cached is not None:
+            _reports.move_to_end(key)
+            return cached, True
+
+    result = build_report(snapshot, since, until, today, work_minutes)
+    with _lock:
+        _reports[key] = result
+        while len(_reports) > max_entries:
+            _reports.popitem(last=False)
+    return result, False
+
+
+def discard(path):
+    """Forget the columns and reports of a store that was closed"""
+    with _lock:
+        _columns.pop(path, None)
+        for key in [key for key in _reports if key[0] == path]:
+            del _reports[key]
@@ -1,68 +1,1115 @@
-from flask import Flask, render_template, request, jsonify
-from datetime import datetime
+from flask import (Blueprint, Flask, Response, abort, current_app, g, render_template, request, jsonify, make_response,
+                   send_from_directory, url_for)
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+import click
+from datetime import datetime, timedelta, timezone
+import atexit
+import collections
+import csv
+import functools
+import io
+import json
+import logging
+import mimetypes
 import os
+import queue
+import threading
+import time
+import zlib
 
-app = Flask(__name__)
+import admission
+import analytics
+import assets
+import binary_store
+import event_dedup
+import generation
+import log_archive
+import log_writer
+import metrics
+import session_feed
+import storage
+from storage import TIMESTAMP_FORMAT, parse_log_line
 
-# Ensure log file exists
-LOG_FILE = 'pomodoro_log.txt'
+# Routes, request hooks and CLI commands; create_app() registers them on an app
+bp = Blueprint('pomodoro', __name__, cli_group=None)
 
-@app.route('/')
+logger = logging.getLogger(__name__)
+
+# Session log, relative to the working directory unless an absolute path is given
+LOG_FILE = os.environ.get('POMODORO_LOG_FILE', 'pomodoro_log.txt')
+
+# Largest page /history will return when paginating
+MAX_PAGE_SIZE = 1000
+
+# /history query parameters that select a filtered, paginated view
+HISTORY_FILTERS = ('since', 'until', 'session_type', 'action')
+
+# Records /history/export buffers before sending a chunk
+EXPORT_CHUNK_RECORDS = 500
+
+# Largest number of records accepted by one /log/batch request, and the
+# largest request body read at all (Flask's MAX_CONTENT_LENGTH)
+MAX_BATCH_SIZE = 1000
+MAX_REQUEST_BYTES = 1024 * 1024
+
+# 'direct' appends inside the request; 'background' hands records to a
+# group-commit writer thread and returns immediately
+WRITE_MODE = os.environ.get('POMODORO_WRITE_MODE', 'direct')
+FLUSH_INTERVAL = float(os.environ.get('POMODORO_FLUSH_INTERVAL', '0.05'))
+FLUSH_BATCH_SIZE = int(os.environ.get('POMODORO_FLUSH_BATCH_SIZE', '256'))
+WRITE_QUEUE_SIZE = int(os.environ.get('POMODORO_WRITE_QUEUE_SIZE', '10000'))
+
+# 'text' keeps the human readable LOG_FILE; 'binary' stores fixed-width
+# records in BINARY_LOG_FILE (see binary_store.py and `flask convert-log`);
+# 'sqlite' keeps an SQLite database in WAL mode at SQLITE_FILE
+STORAGE_ENGINE = os.environ.get('POMODORO_STORAGE_ENGINE', 'text')
+BINARY_LOG_FILE = os.environ.get('POMODORO_BINARY_LOG_FILE', 'pomodoro_log.bin')
+SQLITE_FILE = os.environ.get('POMODORO_SQLITE_FILE', 'pomodoro_log.db')
+
+# Sessions sent with a user_id go to that user's own shard under SHARD_DIR
+# instead of the shared log; at most MAX_OPEN_STORAGES shards (and shared
+# logs) keep their caches and open files in a worker at a time
+SHARD_DIR = os.environ.get('POMODORO_SHARD_DIR', 'pomodoro_shards')
+
+# Whether the timer page sends its browser's device id as user_id. Off by
+# default: requests without a user_id, such as the dashboards, read only
+# the shared log and would not see sessions sharded by device.
+DEVICE_SHARDS = os.environ.get('POMODORO_DEVICE_SHARDS', '0') == '1'
+SHARD_EXTENSIONS = {'text': '.txt', 'binary': '.bin', 'sqlite': '.db'}
+MAX_USER_ID_LENGTH = 128
+MAX_OPEN_STORAGES = int(os.environ.get('POMODORO_MAX_OPEN_STORAGES', '1024'))
+
+# Rotation of the text log into gzip archive segments (0 disables a trigger)
+ROTATE_MAX_BYTES = int(os.environ.get('POMODORO_ROTATE_MAX_BYTES', '0'))
+ROTATE_DAILY = os.environ.get('POMODORO_ROTATE_DAILY', '0') == '1'
+ARCHIVE_RETENTION_DAYS = int(os.environ.get('POMODORO_ARCHIVE_RETENTION_DAYS', '0'))
+
+# /history/stream: each response ends after STREAM_MAX_SECONDS (the browser
+# reconnects and resumes), so a stream never pins a worker thread for long;
+# at most MAX_STREAMS run per worker across all shards, with a comment sent every
+# STREAM_HEARTBEAT seconds to notice clients that went away
+STREAM_MAX_SECONDS = float(os.environ.get('POMODORO_STREAM_MAX_SECONDS', '120'))
+MAX_STREAMS = int(os.environ.get('POMODORO_MAX_STREAMS', '8'))
+STREAM_HEARTBEAT = 15
+STREAM_RETRY_MS = 1000
+
+# Admission control for /log and /log/batch (0 disables each): a token
+# bucket per client address holding LOG_RATE_BURST requests and refilled at
+# LOG_RATE_LIMIT a second, and load shedding once the /log requests in
+# flight plus the batches queued for the background writer reach
+# LOG_SHED_DEPTH. Refused requests get 429 with Retry-After.
+LOG_RATE_LIMIT = float(os.environ.get('POMODORO_LOG_RATE_LIMIT', '0'))
+LOG_RATE_BURST = int(os.environ.get('POMODORO_LOG_RATE_BURST', '20'))
+LOG_SHED_DEPTH = int(os.environ.get('POMODORO_LOG_SHED_DEPTH', '0'))
+SHED_RETRY_AFTER = 1
+
+# Reverse proxies in front of the app (Azure App Service has one): their
+# X-Forwarded-For and X-Forwarded-Proto are trusted, so the rate limiter
+# keys on the real client instead of the proxy. 0 trusts no header.
+TRUSTED_PROXIES = int(os.environ.get('POMODORO_TRUSTED_PROXIES', '0'))
+
+# Fingerprinted, minified and gzipped static assets (flask build-assets),
+# served from /assets/ with a year-long immutable Cache-Control
+ASSET_DIR = os.environ.get('POMODORO_ASSET_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'dist'))
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+# Client event ids remembered for dropping retried /log events, for
+# DEDUP_WINDOW to twice that many seconds (0 disables) and at most
+# DEDUP_CAPACITY of them; see event_dedup.py
+DEDUP_WINDOW = float(os.environ.get('POMODORO_DEDUP_WINDOW', '3600'))
+DEDUP_CAPACITY = int(os.environ.get('POMODORO_DEDUP_CAPACITY', '65536'))
+MAX_EVENT_ID_LENGTH = 128
+
+# Reports /analytics keeps per worker (and stores it keeps loaded as
+# NumPy columns), and the minutes one completed work session counts as
+ANALYTICS_CACHE_SIZE = int(os.environ.get('POMODORO_ANALYTICS_CACHE_SIZE', '64'))
+WORK_MINUTES = int(os.environ.get('POMODORO_WORK_MINUTES', '25'))
+
+# Parsed sessions of the active log kept in memory per worker; older ones
+# are evicted and read from disk again when needed
+HISTORY_CACHE_RECORDS = int(os.environ.get('POMODORO_HISTORY_CACHE_RECORDS', '100000'))
+
+# Worker-local /stats results: log file -> (generation, days)
+_stats_cache = {}
+
+_writer = None
+_writer_lock = threading.Lock()
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+_log_in_flight = admission.InFlight()
+
+# Open /history/stream responses of this worker, whichever store they follow
+_open_streams = admission.InFlight()
+
+# Storage backends of this process, keyed by the settings they were built
+# from, least recently used first
+_storages = collections.OrderedDict()
+_storages_lock = threading.Lock()
+
+
+def get_log_writer():
+    """Return this process's background writer, starting it on first use"""
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.closed:
+            _writer = log_writer.BackgroundWriter(
+                flush_interval=FLUSH_INTERVAL,
+                batch_size=FLUSH_BATCH_SIZE,
+                max_queue=WRITE_QUEUE_SIZE
+            )
+        return _writer
+
+
+def get_rate_limiter():
+    """Return this process's /log rate limiter for the current LOG_RATE_LIMIT and LOG_RATE_BURST"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None or (_rate_limiter.rate, _rate_limiter.burst) != (LOG_RATE_LIMIT, LOG_RATE_BURST):
+            _rate_limiter = admission.RateLimiter(LOG_RATE_LIMIT, LOG_RATE_BURST)
+        return _rate_limiter
+
+
+def client_address():
+    """Return the address the rate limiter keys on, without the port some proxies append to X-Forwarded-For"""
+    address = request.remote_addr or ''
+    if address.startswith('['):
+        return address[1:].partition(']')[0]
+    if address.count(':') == 1:
+        return address.partition(':')[0]
+    return address
+
+
+def log_queue_depth():
+    """Return the /log requests being handled plus the batches waiting for the background writer"""
+    depth = _log_in_flight.count
+    if _writer is not None and not _writer.closed:
+        depth += _writer.queue.qsize()
+    return depth
+
+
+def shed(reason, retry_after, message):
+    """Refuse a request with 429 and Retry-After, counting it in the metrics"""
+    metrics.inc(shared_log_file(), 'pomodoro_log_requests_shed_total', label_value=reason)
+    return jsonify({'status': 'error', 'message': message}), 429, {'Retry-After': str(retry_after)}
+
+
+def admission_control(view):
+    """Shed /log requests while the worker is overloaded and rate limit each client
+    
+    Shedding is checked first, so a refused request never spends one of the
+    client's tokens. Admitted requests count towards the depth until they
+    return.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if LOG_SHED_DEPTH > 0 and log_queue_depth() >= LOG_SHED_DEPTH:
+            return shed('overload', SHED_RETRY_AFTER, 'Server is busy, try again later')
+        if LOG_RATE_LIMIT > 0:
+            wait = get_rate_limiter().acquire(client_address())
+            if wait:
+                return shed('rate_limit', wait, 'Too many requests, slow down')
+        with _log_in_flight:
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def storage_engine():
+    return STORAGE_ENGINE if STORAGE_ENGINE in ('binary', 'sqlite') else 'text'
+
+
+def shared_log_file():
+    """Return the shared log of the configured storage engine without opening it
+    
+    The metrics registry of every shard lives next to this file, so the
+    request hooks use it rather than get_storage(), which creates the
+    backend and checks the log for a torn tail.
+    """
+    return {'text': LOG_FILE, 'binary': BINARY_LOG_FILE, 'sqlite': SQLITE_FILE}[storage_engine()]
+
+
+def get_storage(user_id=None):
+    """Return this process's backend for the configured storage engine
+    
+    With a user_id the backend reads and writes that user's shard rather
+    than the shared log. Backends are kept per process so the history
+    cache and SQLite connections they hold are reused across requests.
+    """
+    engine = storage_engine()
+    shared_path = shared_log_file()
+    path = shared_path if user_id is None else storage.shard_path(SHARD_DIR, user_id, SHARD_EXTENSIONS[engine])
+    key = (engine, path)
+    if engine == 'text':
+        key += (HISTORY_CACHE_RECORDS, ROTATE_MAX_BYTES, ROTATE_DAILY, ARCHIVE_RETENTION_DAYS)
+    
+    with _storages_lock:
+        store = _storages.get(key)
+        if store is not None:
+            _storages.move_to_end(key)
+            return store
+        
+        if user_id is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # One registry for the whole deployment, whichever shard is written
+            metrics.share_registry(path, shared_path)
+        if engine == 'binary':
+            store = storage.BinaryStorage(path)
+        elif engine == 'sqlite':
+            store = storage.SQLiteStorage(path)
+        else:
+            store = storage.TextStorage(path, HISTORY_CACHE_RECORDS, ROTATE_MAX_BYTES,
+                                        ROTATE_DAILY, ARCHIVE_RETENTION_DAYS)
+        # Cut off a record torn by a crash before anything is appended after it
+        try:
+            store.recover()
+        except OSError as e:
+            logger.warning('Could not check %s for torn records: %s', path, e)
+        _storages[key] = store
+        
+        while len(_storages) > MAX_OPEN_STORAGES:
+            _, evicted = _storages.popitem(last=False)
+            evicted.close()
+            _stats_cache.pop(evicted.path, None)
+            analytics.discard(evicted.path)
+        return store
+
+
+def parse_user_id(value):
+    """Validate an optional user or device id; None (or empty) selects the shared log"""
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str) or len(value) > MAX_USER_ID_LENGTH:
+        raise ValueError(f'user_id must be a string of at most {MAX_USER_ID_LENGTH} characters')
+    return value
+
+
+def request_storage():
+    """Return the backend holding the sessions of the user a read request names
+    
+    Raises ValueError for an unacceptable user_id.
+    """
+    return get_storage(parse_user_id(request.args.get('user_id')))
+
+
+def active_log_file():
+    """Return the file the configured storage engine reads and writes"""
+    return get_storage().path
+
+
+def data_validator():
+    """Return the validators of the data behind /history and /stats
+    
+    Besides the store's files they carry its generation counter: rotation,
+    retention and compaction change what the store returns without
+    touching the active log.
+    """
+    try:
+        store = request_storage()
+    except ValueError:
+        return None  # the view itself rejects the request
+    return file_validator(*store.validator_paths, version=generation.current(store.path))
+
+
+def file_validator(*paths, version=None):
+    """Return (etag, last_modified) from the inode, size and mtime of paths, and an optional version number"""
+    parts = [] if version is None else [f'{version:x}']
+    last_modified = None
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            parts.append('missing')
+            continue
+        parts.append(f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}')
+        modified = datetime.fromtimestamp(st.st_mtime, timezone.utc)
+        last_modified = modified if last_modified is None else max(last_modified, modified)
+    return '.'.join(parts), last_modified
+
+
+def conditional(validator):
+    """Serve a view with ETag/Last-Modified and answer 304 while the data behind it is unchanged
+    
+    validator is called per request and returns the (etag, last_modified)
+    of what the response is built from, or None to serve the view
+    unconditionally. Only files are stat'ed before deciding, so a 304
+    never reads or serializes anything.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            validators = validator()
+            if validators is None:
+                return view(*args, **kwargs)
+            etag, last_modified = validators
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def build_session(data, now):
+    """Build a session record from a /log payload, stamped with its occurred_at or else now"""
+    return {
+        'timestamp': parse_occurred_at(data.get('occurred_at')) or now,
+        'session_type': data.get('session_type', 'work'),  # work, short_break, long_break
+        'action': data.get('action', 'completed'),  # completed, skipped
+        'session_number': data.get('session_number', 1),
+        'user_id': parse_user_id(data.get('user_id')),
+        'event_id': parse_event_id(data.get('event_id'))
+    }
+
+
+def parse_occurred_at(value):
+    """Parse the optional ISO 8601 time a client says the event happened, as naive local time"""
+    if value is None or value == '':
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError('occurred_at must be an ISO 8601 timestamp')
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+
+def clamp_timestamps(store, sessions):
+    """Keep session times between the newest session in store and now, in order
+    
+    Events queued offline are logged at the time they happened, but the
+    log must stay in time order for the index's binary search, and a
+    client clock running ahead must not log sessions in the future.
+    """
+    now = datetime.now()
+    floor = datetime.min
+    newest = store.tail(1)
+    if newest:
+        try:
+            floor = datetime.strptime(newest[0]['timestamp'], TIMESTAMP_FORMAT)
+        except ValueError:
+            pass
+    for session in sessions:
+        floor = session['timestamp'] = max(min(session['timestamp'], now), floor)
+
+
+def parse_event_id(value):
+    """Validate an optional client-generated event id; None (or empty) disables deduplication"""
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str) or len(value) > MAX_EVENT_ID_LENGTH:
+        raise ValueError(f'event_id must be a string of at most {MAX_EVENT_ID_LENGTH} characters')
+    return value
+
+
+def write_new_sessions(sessions):
+    """Write the sessions whose event_id has not been logged yet and return how many were written
+    
+    Ids are claimed before writing and released again if the write fails,
+    so the client's retry of a failed request is not mistaken for a duplicate.
+    """
+    if DEDUP_WINDOW <= 0:
+        write_sessions(sessions)
+        return len(sessions)
+    
+    log_file = active_log_file()
+    now = time.time()
+    new_sessions, claimed = [], []
+    for session in sessions:
+        if session['event_id'] is None:
+            new_sessions.append(session)
+            continue
+        # Ids are only unique per client
+        key = f"{session['user_id'] or ''}\0{session['event_id']}"
+        if event_dedup.claim(log_file, key, DEDUP_WINDOW, DEDUP_CAPACITY, now):
+            new_sessions.append(session)
+            claimed.append(key)
+        else:
+            metrics.inc(log_file, 'pomodoro_log_duplicates_total')
+    
+    if new_sessions:
+        try:
+            write_sessions(new_sessions)
+        except BaseException:
+            for key in claimed:
+                event_dedup.release(log_file, key, DEDUP_CAPACITY)
+            raise
+    return len(new_sessions)
+
+
+def write_sessions(sessions):
+    """Persist sessions with one append per shard, or queue them for the background writer"""
+    writer = get_log_writer() if WRITE_MODE == 'background' else None
+    by_user = {}
+    for session in sessions:
+        by_user.setdefault(session['user_id'], []).append(session)
+    for user_id, user_sessions in by_user.items():
+        store = get_storage(user_id)
+        clamp_timestamps(store, user_sessions)
+        store.append_many(user_sessions, writer)
+        session_feed.wake(store.path)
+
+
+@atexit.register
+def shutdown_log_writer():
+    """Drain any queued records before the process exits"""
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+
+
+def parse_time_bound(value, end=False):
+    """Parse a since/until value; a bare date used as an end bound covers that whole day"""
+    bound = datetime.fromisoformat(value)
+    if bound.tzinfo is not None:
+        bound = bound.astimezone().replace(tzinfo=None)
+    if end and len(value) == 10:
+        bound += timedelta(days=1)
+    return bound
+
+def record_cache_lookup(cache, hit):
+    """Count a hit or miss of one of the worker-local caches"""
+    name = 'pomodoro_cache_hits_total' if hit else 'pomodoro_cache_misses_total'
+    metrics.inc(shared_log_file(), name, label_value=cache)
+
+
+@bp.before_app_request
+def start_request_timer():
+    """Note when an instrumented request started and how many lines had been parsed"""
+    route = (request.endpoint or '').rpartition('.')[2]
+    if metrics.ENABLED and route in metrics.ROUTES:
+        g.route = route
+        g.request_started = time.perf_counter()
+        g.records_parsed = storage.parse_counter.records
+
+
+@bp.after_app_request
+def record_request_metrics(response):
+    """Add the latency (and for /history the lines parsed) of the request to the metrics"""
+    if 'request_started' in g:
+        log_file = shared_log_file()
+        metrics.observe(log_file, 'pomodoro_http_request_duration_seconds',
+                        time.perf_counter() - g.request_started, g.route)
+        if g.route == 'get_history':
+            metrics.observe(log_file, 'pomodoro_history_records_parsed',
+                            storage.parse_counter.records - g.records_parsed)
+    return response
+
+
+def index_validator_file():
+    """Return the file whose changes invalidate the page: the template, or the asset manifest if built later
+    
+    The page embeds the fingerprinted asset names, so a new build must
+    change its validators as much as an edit of the template does.
+    """
+    template = os.path.join(current_app.root_path, current_app.template_folder, 'index.html')
+    manifest = assets.manifest_path(ASSET_DIR)
+    if os.path.exists(manifest) and os.path.getmtime(manifest) > os.path.getmtime(template):
+        return manifest
+    return template
+
+
+@bp.app_template_global()
+def asset_url(name):
+    """Return the URL of a static asset: its fingerprinted build if there is one, else the source file"""
+    built = assets.load_manifest(ASSET_DIR).get(name)
+    if built:
+        return url_for('pomodoro.static_asset', filename=built)
+    return url_for('static', filename=name)
+
+
+@bp.route('/')
+@conditional(lambda: file_validator(index_validator_file(), version=int(DEVICE_SHARDS)))
 def index():
     """Serve the main timer page"""
-    return render_template('index.html')
+    return render_template('index.html', device_shards=DEVICE_SHARDS)
 
-@app.route('/log', methods=['POST'])
+@bp.route('/assets/<filename>')
+def static_asset(filename):
+    """Serve a fingerprinted asset, pre-gzipped when the client accepts it
+    
+    A fingerprinted name always has the same content, so the response may
+    be cached forever and is never revalidated.
+    """
+    if filename == assets.MANIFEST_NAME or filename.endswith(('.gz', '.tmp')):
+        abort(404)
+    
+    gzipped = request.accept_encodings['gzip'] > 0 and os.path.exists(os.path.join(ASSET_DIR, filename + '.gz'))
+    response = send_from_directory(ASSET_DIR, filename + '.gz' if gzipped else filename,
+                                   mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                   max_age=ASSET_MAX_AGE)
+    if gzipped:
+        response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@bp.route('/log', methods=['POST'])
+@admission_control
 def log_session():
     """Log pomodoro session events"""
     try:
         data = request.get_json()
+        session = build_session(data, datetime.now())
+        
+        # Append to log file, unless this is a retry of an event already logged
+        try:
+            if not write_new_sessions([session]):
+                return jsonify({'status': 'success', 'message': 'Duplicate event ignored', 'duplicate': True})
+        except queue.Full:
+            return jsonify({'status': 'error', 'message': 'Log queue is full, try again later'}), 503, {'Retry-After': str(SHED_RETRY_AFTER)}
+        
+        return jsonify({'status': 'success', 'message': 'Session logged successfully'})
+    
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except RequestEntityTooLarge:
+        return jsonify({'status': 'error', 'message': f'Request body is larger than {MAX_REQUEST_BYTES} bytes'}), 413
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def batch_too_large():
+    return jsonify({'status': 'error', 'message': f'At most {MAX_BATCH_SIZE} sessions per batch'}), 400
+
+@bp.route('/log/batch', methods=['POST'])
+@admission_control
+def log_session_batch():
+    """Log many session events with a single append
+    
+    Accepts a JSON array of session payloads, or NDJSON (one payload per
+    line) when sent as ``application/x-ndjson``.
+    """
+    try:
+        # The body is at most MAX_REQUEST_BYTES; NDJSON lines are counted before any is parsed
+        if request.mimetype == 'application/x-ndjson':
+            lines = [line for line in request.get_data(as_text=True).splitlines() if line.strip()]
+            if len(lines) > MAX_BATCH_SIZE:
+                return batch_too_large()
+            records = [json.loads(line) for line in lines]
+        else:
+            records = request.get_json()
         
-        # Extract session data
-        session_type = data.get('session_type', 'work')  # work, short_break, long_break
-        action = data.get('action', 'completed')  # completed, skipped
-        session_number = data.get('session_number', 1)
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            return jsonify({'status': 'error', 'message': 'Expected a list of session objects'}), 400
+        if len(records) > MAX_BATCH_SIZE:
+            return batch_too_large()
         
-        # Log entry format: timestamp | session_type | action | session_number
-        log_entry = f"{timestamp} | {session_type} | {action} | session_{session_number}\n"
+        now = datetime.now()
+        sessions = [build_session(record, now) for record in records]
         
-        # Append to log file
-        with open(LOG_FILE, 'a') as f:
-            f.write(log_entry)
+        written = 0
+        if sessions:
+            try:
+                written = write_new_sessions(sessions)
+            except queue.Full:
+                return jsonify({'status': 'error', 'message': 'Log queue is full, try again later'}), 503, {'Retry-After': str(SHED_RETRY_AFTER)}
         
-        return jsonify({'status': 'success', 'message': 'Session logged successfully'})
+        return jsonify({'status': 'success', 'message': f'{written} sessions logged successfully',
+                        'count': written, 'duplicates': len(sessions) - written})
     
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except RequestEntityTooLarge:
+        return jsonify({'status': 'error', 'message': f'Request body is larger than {MAX_REQUEST_BYTES} bytes'}), 413
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/history')
+@bp.route('/history')
+@conditional(data_validator)
 def get_history():
-    """Optional endpoint to retrieve session history"""
+    """Optional endpoint to retrieve session history
+    
+    Pass ``limit`` (and the ``next_cursor`` of a previous page as ``cursor``)
+    to page through the log via its byte-offset index instead of reading it all.
+    ``since``, ``until``, ``session_type`` and ``action`` narrow the result.
+    ``last=N`` returns just the N most recent sessions. With ``user_id`` only
+    that user's shard is read.
+    """
+    try:
+        store = request_storage()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
     try:
-        if not os.path.exists(LOG_FILE):
-            return jsonify({'sessions': []})
+        if 'last' in request.args:
+            return get_history_tail(store)
         
-        sessions = []
-        with open(LOG_FILE, 'r') as f:
-            for line in f:
-                if line.strip():
-                    parts = line.strip().split(' | ')
-                    if len(parts) == 4:
-                        sessions.append({
-                            'timestamp': parts[0],
-                            'session_type': parts[1],
-                            'action': parts[2],
-                            'session_number': parts[3]
-                        })
+        if any(arg in request.args for arg in ('limit', 'cursor') + HISTORY_FILTERS):
+            return get_history_page(store)
         
+        sessions, _ = store.query()
         return jsonify({'sessions': sessions})
     
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+def history_filters():
+    """Parse since/until/session_type/action from the query string
+    
+    Returns (since, until, filters) in the form the storage backends take.
+    Raises ValueError for unparseable times.
+    """
+    try:
+        since = parse_time_bound(request.args['since']) if 'since' in request.args else None
+        until = parse_time_bound(request.args['until'], end=True) if 'until' in request.args else None
+    except ValueError:
+        raise ValueError('since and until must be ISO 8601 dates or times')
+    filters = {field: request.args.get(field) for field in storage.FILTER_FIELDS}
+    return since, until, filters
+
+def get_history_page(store):
+    """Return one page of (optionally filtered) history starting at ``cursor``
+    
+    ``since`` (inclusive) and ``until`` (exclusive; a bare date includes that
+    day) are resolved by the storage backend to a range it can read directly
+    (index binary search, record numbers or an SQL index), so the cost
+    depends on the page rather than on the size of the history.
+    """
+    try:
+        limit = int(request.args.get('limit', 100))
+        cursor = int(request.args.get('cursor', 0))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'limit and cursor must be integers'}), 400
+    if limit < 1 or cursor < 0:
+        return jsonify({'status': 'error', 'message': 'limit must be positive and cursor non-negative'}), 400
+    limit = min(limit, MAX_PAGE_SIZE)
+    
+    try:
+        since, until, filters = history_filters()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    sessions, next_cursor = store.query(since, until, filters, cursor, limit)
+    return jsonify({'sessions': sessions, 'next_cursor': next_cursor})
+
+def get_history_tail(store):
+    """Return the ``last`` N (optionally filtered) sessions, oldest first
+    
+    The text log is read backwards from its end in blocks and reading
+    stops once N sessions are found, so the cost depends on N rather than on
+    the size of the log.
+    """
+    try:
+        last = int(request.args['last'])
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'last must be an integer'}), 400
+    if last < 1:
+        return jsonify({'status': 'error', 'message': 'last must be positive'}), 400
+    last = min(last, MAX_PAGE_SIZE)
+    
+    try:
+        since, until, filters = history_filters()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    return jsonify({'sessions': store.tail(last, since, until, filters)})
+
+@bp.route('/history/export')
+def export_history():
+    """Stream the whole (optionally filtered) history as NDJSON or CSV
+    
+    The format comes from ``format=ndjson|csv`` or the Accept header. Records
+    are read and sent in small chunks, so worker memory stays flat however
+    large the log is. Every record carries the ``cursor`` to pass back to
+    resume an interrupted download after it, and the stream is gzip-encoded
+    when the client accepts it.
+    """
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        if cursor < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'cursor must be a non-negative integer'}), 400
+    try:
+        since, until, filters = history_filters()
+        store = request_storage()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    export_format = request.args.get('format')
+    if export_format is None:
+        best = request.accept_mimetypes.best_match(['application/x-ndjson', 'text/csv'], default='application/x-ndjson')
+        export_format = 'csv' if best == 'text/csv' else 'ndjson'
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'status': 'error', 'message': 'format must be ndjson or csv'}), 400
+    
+    try:
+        sessions = store.stream(since, until, filters, cursor)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    
+    chunks = export_chunks(sessions, export_format)
+    headers = {
+        'Content-Disposition': f'attachment; filename=pomodoro_history.{export_format}',
+        'Vary': 'Accept, Accept-Encoding'
+    }
+    if request.accept_encodings['gzip'] > 0:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+@bp.route('/history/stream')
+def stream_history():
+    """Push sessions to the client as Server-Sent Events as soon as they are stored
+    
+    Every event's id is its store cursor. A reconnecting EventSource sends
+    the last one as ``Last-Event-ID`` and the stream resumes right after it,
+    read through the index, so nothing is missed or repeated. Without one,
+    ``cursor`` chooses the starting point, and by default only sessions
+    stored from now on are sent. ``user_id`` selects a shard, and
+    ``session_type``/``action`` filter the events.
+    """
+    try:
+        store = request_storage()
+        resume = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+        cursor = int(resume) if resume is not None else None
+        if cursor is not None and cursor < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Last-Event-ID, cursor and user_id must be valid'}), 400
+    
+    # Counted across every shard: each open stream holds one worker thread
+    if not _open_streams.enter_below(MAX_STREAMS):
+        return jsonify({'status': 'error', 'message': 'Too many open streams, try again later'}), 503, {'Retry-After': '5'}
+    
+    try:
+        feed = session_feed.get_feed(store)
+        # Subscribe before reading the backlog: sessions stored meanwhile are
+        # queued as well, and the duplicates dropped by cursor
+        subscription = feed.subscribe()
+    except Exception as e:
+        _open_streams.leave()
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    
+    def close_stream():
+        feed.unsubscribe(subscription)
+        _open_streams.leave()
+    
+    try:
+        if cursor is None:
+            cursor = store.end_cursor()
+        backlog = store.stream(cursor=cursor)
+    except Exception as e:
+        close_stream()
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    
+    matches = storage.matcher(filters={field: request.args.get(field) for field in storage.FILTER_FIELDS})
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(session_events(subscription, backlog, cursor, matches),
+                        mimetype='text/event-stream', headers=headers)
+    # Runs when the client goes away, even before the first event was sent
+    response.call_on_close(close_stream)
+    return response
+
+def session_events(subscription, backlog, cursor, matches):
+    """Yield SSE messages for the backlog and then for live sessions until STREAM_MAX_SECONDS pass"""
+    deadline = time.monotonic() + STREAM_MAX_SECONDS
+    yield f'retry: {STREAM_RETRY_MS}\n\n'
+    for cursor, session in backlog:
+        if matches(session):
+            yield f'id: {cursor}\nevent: session\ndata: {json.dumps(session)}\n\n'
+    
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            item = subscription.get(timeout=min(remaining, STREAM_HEARTBEAT))
+        except queue.Empty:
+            yield ': keep-alive\n\n'
+            continue
+        if item is None:
+            return  # too far behind; the client reconnects and catches up from the store
+        event_cursor, session = item
+        if event_cursor <= cursor:
+            continue
+        cursor = event_cursor
+        if matches(session):
+            yield f'id: {cursor}\nevent: session\ndata: {json.dumps(session)}\n\n'
+
+def export_chunks(sessions, export_format):
+    """Serialize (cursor, session) pairs into text chunks of EXPORT_CHUNK_RECORDS records"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if export_format == 'csv':
+        writer.writerow(['cursor', 'timestamp', 'session_type', 'action', 'session_number'])
+    
+    count = 0
+    for cursor, session in sessions:
+        if export_format == 'csv':
+            writer.writerow([cursor, session['timestamp'], session['session_type'],
+                             session['action'], session['session_number']])
+        else:
+            buffer.write(json.dumps(dict(session, cursor=cursor)) + '\n')
+        count += 1
+        if count % EXPORT_CHUNK_RECORDS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    """Gzip-compress a stream of text chunks incrementally"""
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@bp.route('/stats')
+@conditional(data_validator)
+def get_stats():
+    """Return completed/skipped counts per day and per session type
+    
+    Served from per-day aggregates the storage backend keeps up to date as
+    sessions are written, so the cost depends on the number of days rather
+    than the number of events. Results are kept per worker until the log's
+    generation counter moves. With ``user_id`` only that user's shard is read.
+    """
+    try:
+        store = request_storage()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    try:
+        current_generation = generation.current(store.path)
+        cached = _stats_cache.get(store.path)
+        record_cache_lookup('stats', bool(cached and cached[0] == current_generation))
+        if cached and cached[0] == current_generation:
+            days = cached[1]
+        else:
+            days = store.aggregate()
+            _stats_cache[store.path] = (current_generation, days)
+        
+        totals = {}
+        for session_types in days.values():
+            for session_type, actions in session_types.items():
+                type_totals = totals.setdefault(session_type, {})
+                for action, count in actions.items():
+                    type_totals[action] = type_totals.get(action, 0) + count
+        
+        return jsonify({'days': days, 'totals': totals})
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@bp.route('/analytics')
+def get_analytics():
+    """Return focus-time, completion-rate, streak and hour-of-week reports
+    
+    Computed with NumPy over columns of the whole history that each worker
+    loads once and extends as sessions are appended; reports are memoized
+    until the log's generation counter moves. ``since`` and ``until``
+    narrow the range and ``user_id`` selects that user's shard.
+    """
+    if not analytics.AVAILABLE:
+        return jsonify({'status': 'error', 'message': 'Analytics require NumPy to be installed'}), 503
+    
+    try:
+        store = request_storage()
+        since, until, _ = history_filters()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    try:
+        report, cached = analytics.report(store, since, until, analytics.day_number(datetime.now().date()),
+                                          WORK_MINUTES, ANALYTICS_CACHE_SIZE)
+        record_cache_lookup('analytics', cached)
+        return jsonify(report)
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@bp.route('/metrics')
+def get_metrics():
+    """Expose request, write and cache metrics in the Prometheus text format
+    
+    Counters and histograms are shared by all workers through the mmap'ed
+    registry in metrics.py; the log size and cache hit ratios are computed
+    when scraped.
+    """
+    try:
+        log_file = active_log_file()
+        log_size = os.path.getsize(log_file) if os.path.exists(log_file) else 0
+        hit_ratios = {}
+        for cache in metrics.CACHES:
+            hits = metrics.value(log_file, 'pomodoro_cache_hits_total', cache)
+            lookups = hits + metrics.value(log_file, 'pomodoro_cache_misses_total', cache)
+            hit_ratios[('cache', cache)] = hits / lookups if lookups else 0
+        
+        body = metrics.render(log_file, [
+            ('pomodoro_log_size_bytes', 'Size of the active session log', {None: log_size}),
+            ('pomodoro_cache_hit_ratio', 'Share of cache lookups answered without rebuilding', hit_ratios),
+        ])
+        return Response(body, mimetype='text/plain; version=0.0.4')
+    
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def convert_text_log(text_path, binary_path):
+    """Convert a text session log into a binary store, returning (converted, skipped)
+    
+    The log is streamed through TextStorage, so sessions already rotated
+    into archived segments are converted along with the active log. Lines
+    that are malformed or use values the binary format cannot hold are
+    skipped. The store is written to a temporary file and moved into place.
+    """
+    source = storage.TextStorage(text_path)
+    converted = skipped = 0
+    previous = 0
+    tmp_path = binary_path + '.tmp'
+    with open(tmp_path, 'wb') as dst:
+        batch = []
+        for cursor, session in source.stream():
+            # Cursors number every line, so a gap is lines the stream could not parse
+            skipped += cursor - previous - 1
+            previous = cursor
+            try:
+                session['timestamp'] = datetime.strptime(session['timestamp'], TIMESTAMP_FORMAT)
+                batch.append(binary_store.encode_record(session))
+            except (TypeError, ValueError):
+                skipped += 1
+                continue
+            if len(batch) >= 4096:
+                dst.write(b''.join(batch)); converted += len(batch); batch = []
+        dst.write(b''.join(batch)); converted += len(batch)
+    skipped += max(source.end_cursor() - previous, 0)
+    os.replace(tmp_path, binary_path)
+    return converted, skipped
+
+@bp.cli.command('convert-log')
+@click.argument('source', required=False)
+@click.argument('destination', required=False)
+def convert_log_command(source, destination):
+    """Convert the text session log into the binary storage engine format"""
+    converted, skipped = convert_text_log(source or LOG_FILE, destination or BINARY_LOG_FILE)
+    click.echo(f'Converted {converted} sessions ({skipped} skipped)')
+
+@bp.cli.command('build-assets')
+def build_assets_command():
+    """Write fingerprinted, minified and gzipped static assets and their manifest"""
+    manifest = build_static_assets(current_app)
+    for name, built in sorted(manifest.items()):
+        click.echo(f'{name} -> {built}')
+
+@bp.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the /stats rollups from the raw session log"""
+    days = get_storage().rebuild_aggregates()
+    click.echo(f'Rebuilt rollups for {len(days)} days')
+
+@bp.cli.command('rotate-log')
+@click.option('--retention-days', type=int, default=None, help='Drop archived segments older than this')
+def rotate_log_command(retention_days):
+    """Rotate the text session log now and gzip it into the archive"""
+    segment = log_archive.rotate_log(LOG_FILE, force=True)
+    log_archive.archive_pending(LOG_FILE, ARCHIVE_RETENTION_DAYS if retention_days is None else retention_days)
+    if segment:
+        click.echo(f"Archived {segment['lines']} lines ({segment['first']} - {segment['last']})")
+    else:
+        click.echo('Nothing to rotate')
+
+@bp.cli.command('compact-archive')
+@click.option('--target-bytes', type=int, default=64 * 1024 * 1024, help='Approximate size of merged segments')
+def compact_archive_command(target_bytes):
+    """Merge small adjacent archive segments into larger ones"""
+    removed = log_archive.compact_archive(LOG_FILE, target_bytes)
+    click.echo(f'Merged away {removed} segments')
+
+# Module settings that create_app(config) may override
+SETTINGS = (
+    'LOG_FILE', 'MAX_PAGE_SIZE', 'MAX_BATCH_SIZE', 'MAX_REQUEST_BYTES', 'EXPORT_CHUNK_RECORDS',
+    'WRITE_MODE', 'FLUSH_INTERVAL', 'FLUSH_BATCH_SIZE', 'WRITE_QUEUE_SIZE',
+    'STORAGE_ENGINE', 'BINARY_LOG_FILE', 'SQLITE_FILE', 'SHARD_DIR', 'DEVICE_SHARDS', 'MAX_OPEN_STORAGES',
+    'STREAM_MAX_SECONDS', 'MAX_STREAMS', 'LOG_RATE_LIMIT', 'LOG_RATE_BURST', 'LOG_SHED_DEPTH',
+    'TRUSTED_PROXIES', 'ANALYTICS_CACHE_SIZE', 'WORK_MINUTES', 'DEDUP_WINDOW', 'DEDUP_CAPACITY', 'ASSET_DIR',
+    'ROTATE_MAX_BYTES', 'ROTATE_DAILY', 'ARCHIVE_RETENTION_DAYS', 'HISTORY_CACHE_RECORDS'
+)
+
+def create_app(config=None):
+    """Configure this process and build its Flask application
+    
+    Keys of config named in SETTINGS replace the module setting of the same
+    name; everything is also copied into ``app.config``. The settings are
+    module globals read by the storage helpers at call time, not per app:
+    only one configuration per process is supported, which suits gunicorn,
+    where every worker process serves a single app. Calling create_app
+    again with other settings moves every app already built in the process
+    onto them, so it logs a warning.
+    """
+    global _apps_built
+    config = dict(config or {})
+    changed = [key for key in SETTINGS if key in config and config[key] != globals()[key]]
+    if changed and _apps_built:
+        logger.warning('create_app() changed %s for every app of this process', ', '.join(changed))
+    for key in changed:
+        globals()[key] = config[key]
+    _apps_built += 1
+    
+    flask_app = Flask(__name__)
+    flask_app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+    flask_app.config.update(config)
+    flask_app.register_blueprint(bp)
+    if TRUSTED_PROXIES:
+        flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+    return flask_app
+
+def build_static_assets(flask_app):
+    """Build the fingerprinted static assets into ASSET_DIR and return the manifest"""
+    return assets.build_assets(os.path.join(flask_app.root_path, 'static'), ASSET_DIR)
+
+def warm_up(flask_app):
+    """Load everything the first request would otherwise have to
+    
+    Compiles the index template and brings the byte-offset index, the
+    rollups and this process's history cache up to date. Under gunicorn
+    with preload_app this runs once in the master, and forked workers
+    inherit the results instead of rebuilding them on their first request.
+    """
+    flask_app.jinja_env.get_template('index.html')
+    assets.load_manifest(ASSET_DIR)
+    get_storage().warm_up()
+
+def _forget_log_writer():
+    # The writer thread does not survive fork; a child starts its own
+    global _writer
+    _writer = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_log_writer)
+
+_apps_built = 0
+_default_app = None
+
+def __getattr__(name):
+    # ``app`` (for flask --app app and the tests) is built on first use, so
+    # wsgi.py, which builds its own with create_app(), makes only one
+    global _default_app
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    if _default_app is None:
+        _default_app = create_app()
+    return _default_app
+
 if __name__ == '__main__':
     # Use environment variables for production deployment
     port = int(os.environ.get('PORT', 5000))
     debug_mode = os.environ.get('FLASK_ENV', 'production') == 'development'
-    app.run(debug=debug_mode, host='0.0.0.0', port=port)
\ No newline at end of file
+    create_app().run(debug=debug_mode, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+Fingerprinted, minified and pre-gzipped copies of the static assets.
+
+``build_assets`` writes each asset of ``ASSETS`` to the output directory as
+``<name>.<hash>.<ext>``, where the hash is taken from the minified content,
+together with a ``.gz`` copy and a ``manifest.json`` mapping the source
+name to the fingerprinted one. Because a file's name changes whenever its
+content does, the files can be cached by browsers forever; the page picks
+up a new build through the new names in its markup.
+
+Earlier builds are left in place, so a page cached before a deploy can
+still load the files it refers to.
+
+The minifiers are deliberately conservative (comments, indentation and
+blank lines; whitespace around CSS punctuation): they never need to parse
+a string or a regular expression to stay correct.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+
+# Files of the static folder that are built, and the manifest listing them
+ASSETS = ('timer.js', 'style.css')
+MANIFEST_NAME = 'manifest.json'
+
+# Hex digits of the content hash kept in file names
+HASH_LENGTH = 12
+
+
+def minify_js(source):
+    """Drop indentation, blank lines and whole-line // comments, keeping line breaks for ASI"""
+    lines = (line.strip() for line in source.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//')) + '\n'
+
+
+def minify_css(source):
+    """Drop comments and the whitespace CSS does not need"""
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.DOTALL)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,])\s*', r'\1', source)
+    source = re.sub(r':\s+', ':', source)
+    return source.replace(';}', '}').strip() + '\n'
+
+
+MINIFIERS = {'.js': minify_js, '.css': minify_css}
+
+
+def fingerprinted_name(name, content):
+    """Return name with the hash of content inserted before its extension"""
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(content).hexdigest()[:HASH_LENGTH]}{extension}'
+
+
+def _write(path, data):
+    # Write under a temporary name and rename, so a running server never
+    # serves a half-written file
+    partial = path + '.tmp'
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+def build_assets(static_dir, output_dir):
+    """Build every asset into output_dir and return the manifest written there"""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {}
+    for name in ASSETS:
+        with open(os.path.join(static_dir, name), encoding='utf-8') as f:
+            source = f.read()
+        minify = MINIFIERS.get(os.path.splitext(name)[1])
+        content = (minify(source) if minify else source).encode('utf-8')
+
+        built = fingerprinted_name(name, content)
+        _write(os.path.join(output_dir, built), content)
+        # mtime=0 keeps the compressed bytes identical from build to build
+        _write(os.path.join(output_dir, built + '.gz'), gzip.compress(content, compresslevel=9, mtime=0))
+        manifest[name] = built
+
+    _write(os.path.join(output_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def manifest_path(output_dir):
+    return os.path.join(output_dir, MANIFEST_NAME)
+
+
+_manifests = {}
+
+
+def load_manifest(output_dir):
+    """Return the manifest of output_dir ({} if never built), re-read only when the file changes"""
+    path = manifest_path(output_dir)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _manifests.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, encoding='utf-8') as f:
+            cached = _manifests[path] = (mtime, json.load(f))
+    return cached[1]
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the Pomodoro Timer backend
+
+Generates synthetic session logs of increasing size and measures /log
+throughput and /history latency, both in-process through Flask's test
+client and over HTTP against a locally started gunicorn. Results are
+written as JSON and can be compared against a saved baseline:
+
+    python benchmark.py --sizes 1000,100000 --output results.json
+    python benchmark.py --baseline baseline.json --tolerance 0.25
+
+The comparison exits with status 1 if any measurement regressed by more
+than the tolerance, so it can gate a CI job.
+"""
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import app as app_module
+import log_writer
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+SESSION_TYPES = ('work', 'short_break', 'work', 'long_break')
+ACTIONS = ('completed', 'completed', 'completed', 'skipped')
+
+# Measurements where a larger number is better (log_rps and the
+# log_rps_<durability> variants); all others are latencies
+HIGHER_IS_BETTER = ('log_rps',)
+
+# Latency changes smaller than this are timer noise, never a regression
+NOISE_FLOOR_MS = 0.5
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Logged by the post_worker_init hook in gunicorn.conf.py
+BOOT_LINE = re.compile(r'booted in ([0-9.]+) ms')
+
+
+def generate_log(path, lines, start=datetime(2024, 1, 1)):
+    """Write a synthetic, time-ordered session log with the given number of lines"""
+    chunk = []
+    with open(path, 'w') as f:
+        for i in range(lines):
+            timestamp = (start + timedelta(seconds=30 * i)).strftime('%Y-%m-%d %H:%M:%S')
+            chunk.append(f"{timestamp} | {SESSION_TYPES[i % 4]} | {ACTIONS[i % 4]} | session_{i % 4 + 1}\n")
+            if len(chunk) == 10000:
+                f.writelines(chunk)
+                chunk = []
+        f.writelines(chunk)
+    return start, start + timedelta(seconds=30 * lines)
+
+
+def history_queries(lines, start, end):
+    """Return (name, path) of the /history requests measured for a log size"""
+    middle = start + (end - start) / 2
+    queries = [
+        ('history_last', '/history?last=20'),
+        ('history_page', f'/history?limit=100&cursor={lines // 2}'),
+        ('history_range', f"/history?since={middle.isoformat()}&until={(middle + timedelta(hours=1)).isoformat()}"),
+        ('stats', '/stats'),
+    ]
+    if lines <= 100000:
+        queries.append(('history_full', '/history'))
+    return queries
+
+
+def summarize(samples):
+    """Return latency percentiles in milliseconds"""
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(statistics.median(samples) * 1000, 3),
+        'p95_ms': round(samples[int(0.95 * (len(samples) - 1))] * 1000, 3),
+    }
+
+
+def time_requests(send, path, repeat):
+    """Time repeat requests to path; the first (cold) one is reported separately"""
+    started = time.perf_counter()
+    send(path)
+    cold = time.perf_counter() - started
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        send(path)
+        samples.append(time.perf_counter() - started)
+    return dict(summarize(samples), cold_ms=round(cold * 1000, 3))
+
+
+def bench_test_client(log_file, lines, start, end, log_requests, repeat, durability_modes=('none',)):
+    """Measure the app in-process through Flask's test client
+
+    /log throughput is measured once per durability mode: as ``log_rps`` for
+    ``none`` and as ``log_rps_<mode>`` for the others.
+    """
+    app_module.LOG_FILE = log_file
+    app_module.STORAGE_ENGINE = 'text'
+    client = app_module.app.test_client()
+
+    def send(path):
+        response = client.get(path)
+        if response.status_code != 200:
+            raise RuntimeError(f'{path} answered {response.status_code}')
+
+    results = {name: time_requests(send, path, repeat) for name, path in history_queries(lines, start, end)}
+
+    body = json.dumps({'session_type': 'work', 'action': 'completed', 'session_number': 1})
+    default_durability = log_writer.DURABILITY
+    try:
+        for mode in durability_modes:
+            log_writer.DURABILITY = mode
+            started = time.perf_counter()
+            for _ in range(log_requests):
+                client.post('/log', data=body, content_type='application/json')
+            if mode == 'interval':
+                log_writer.get_syncer().sync()
+            name = 'log_rps' if mode == 'none' else f'log_rps_{mode}'
+            results[name] = round(log_requests / (time.perf_counter() - started), 1)
+    finally:
+        log_writer.DURABILITY = default_durability
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(log_file, workers):
+    """Start gunicorn with the repository's gunicorn.conf.py and wait until it answers
+
+    Returns (process, port, startup seconds, per-worker boot milliseconds).
+    Worker boot times come from the ``booted in`` lines gunicorn.conf.py logs
+    after each fork.
+    """
+    port = free_port()
+    env = dict(os.environ, POMODORO_LOG_FILE=log_file, GUNICORN_WORKERS=str(workers), GUNICORN_LOG_LEVEL='info')
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', os.path.join(REPO_ROOT, 'gunicorn.conf.py'),
+         '--bind', f'127.0.0.1:{port}', '--chdir', REPO_ROOT, 'wsgi:application'],
+        env=env, stderr=subprocess.PIPE, text=True
+    )
+    boot_ms = []
+
+    def collect_boot_times():
+        for line in process.stderr:
+            match = BOOT_LINE.search(line)
+            if match:
+                boot_ms.append(float(match.group(1)))
+
+    threading.Thread(target=collect_boot_times, daemon=True).start()
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/stats')
+            connection.getresponse().read()
+            startup = time.perf_counter() - started
+            # Give the remaining workers a moment to report their boot time
+            while len(boot_ms) < workers and time.monotonic() < deadline:
+                time.sleep(0.05)
+            return process, port, startup, boot_ms
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError('gunicorn did not start within 30 seconds')
+
+
+def bench_gunicorn(log_file, lines, start, end, log_requests, repeat, workers, concurrency):
+    """Measure the app over HTTP against a local gunicorn"""
+    process, port, startup, boot_ms = start_gunicorn(log_file, workers)
+    try:
+        results = {'startup_ms': round(startup * 1000, 3)}
+        if boot_ms:
+            results['worker_boot_ms'] = {'mean_ms': round(statistics.mean(boot_ms), 3), 'max_ms': max(boot_ms)}
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+
+        def send(path):
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError(f'{path} answered {response.status}')
+
+        results.update((name, time_requests(send, path, repeat)) for name, path in history_queries(lines, start, end))
+        connection.close()
+
+        body = json.dumps({'session_type': 'work', 'action': 'completed', 'session_number': 1})
+
+        def post_many(count):
+            worker_connection = http.client.HTTPConnection('127.0.0.1', port)
+            for _ in range(count):
+                worker_connection.request('POST', '/log', body, {'Content-Type': 'application/json'})
+                worker_connection.getresponse().read()
+            worker_connection.close()
+
+        per_client = max(log_requests // concurrency, 1)
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(post_many, [per_client] * concurrency))
+        results['log_rps'] = round(per_client * concurrency / (time.perf_counter() - started), 1)
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run(sizes, log_requests, repeat, use_gunicorn, workers, concurrency, durability_modes=('none',)):
+    """Run every benchmark for every log size and return the results document"""
+    results = {'test_client': {}}
+    if use_gunicorn:
+        results['gunicorn'] = {}
+
+    for lines in sizes:
+        workdir = tempfile.mkdtemp(prefix='pomodoro-bench-')
+        try:
+            log_file = os.path.join(workdir, 'pomodoro_log.txt')
+            start, end = generate_log(log_file, lines)
+            print(f'{lines} lines: test client...', file=sys.stderr)
+            results['test_client'][str(lines)] = bench_test_client(
+                log_file, lines, start, end, log_requests, repeat, durability_modes)
+            if use_gunicorn:
+                # Start again from an untouched log and no derived files
+                shutil.rmtree(workdir)
+                os.makedirs(workdir)
+                generate_log(log_file, lines)
+                print(f'{lines} lines: gunicorn...', file=sys.stderr)
+                results['gunicorn'][str(lines)] = bench_gunicorn(
+                    log_file, lines, start, end, log_requests, repeat, workers, concurrency)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'log_requests': log_requests,
+            'repeat': repeat,
+            'durability': list(durability_modes),
+        },
+        'results': results,
+    }
+
+
+def flatten(results, prefix=''):
+    """Flatten nested results into {'test_client/1000/history_last/p50_ms': value}"""
+    flat = {}
+    for key, value in results.items():
+        path = f'{prefix}/{key}' if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path))
+        else:
+            flat[path] = value
+    return flat
+
+
+def compare(current, baseline, tolerance):
+    """Return a list of human readable regressions of current against baseline
+
+    Cold-request timings are reported but not compared, since they mostly
+    measure the page cache of the machine, and latencies within
+    NOISE_FLOOR_MS of the baseline always pass.
+    """
+    regressions = []
+    current_flat = flatten(current['results'])
+    for key, base in flatten(baseline['results']).items():
+        value = current_flat.get(key)
+        if value is None or not base or key.endswith('cold_ms'):
+            continue
+        if key.split('/')[-1].startswith(HIGHER_IS_BETTER):
+            if value < base * (1 - tolerance):
+                regressions.append(f'{key}: {value} < baseline {base}')
+        elif value > base * (1 + tolerance) and value - base > NOISE_FLOOR_MS:
+            regressions.append(f'{key}: {value} > baseline {base}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated log sizes in lines (up to 10000000)')
+    parser.add_argument('--log-requests', type=int, default=2000, help='POST /log requests per size')
+    parser.add_argument('--repeat', type=int, default=50, help='timed repetitions of each /history query')
+    parser.add_argument('--gunicorn', action='store_true', help='also benchmark a locally started gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients posting to gunicorn')
+    parser.add_argument('--durability', default='none',
+                        help='comma separated durability modes to measure /log throughput under '
+                             f'({", ".join(log_writer.DURABILITY_MODES)})')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    durability_modes = args.durability.split(',')
+    unknown = set(durability_modes) - set(log_writer.DURABILITY_MODES)
+    if unknown:
+        parser.error(f'unknown durability modes: {", ".join(sorted(unknown))}')
+    document = run(sizes, args.log_requests, args.repeat, args.gunicorn, args.workers, args.concurrency,
+                   durability_modes)
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(document, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.baseline}')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
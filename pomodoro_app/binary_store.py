@@ -0,0 +1,102 @@
+"""
+Fixed-width binary session store.
+
+Each session is one 16 byte record (little endian):
+    int64  - epoch timestamp in seconds
+    uint32 - session number
+    uint8  - session type (index into SESSION_TYPES)
+    uint8  - action (index into ACTIONS)
+    2 bytes padding
+
+Because every record has the same size, record N lives at byte N * 16 and
+reads can slice a memory map of the file without scanning or splitting text.
+A trailing partial record (an append in progress) is ignored by readers.
+"""
+import mmap
+import os
+import struct
+from datetime import datetime
+
+RECORD = struct.Struct('<qIBB2x')
+
+SESSION_TYPES = ('work', 'short_break', 'long_break')
+ACTIONS = ('completed', 'skipped')
+
+
+def encode_record(session):
+    """Pack a session dict (timestamp as datetime) into a record.
+
+    Raises ValueError for session types, actions or numbers the binary
+    format cannot represent.
+    """
+    session_type = session['session_type']
+    action = session['action']
+    if session_type not in SESSION_TYPES:
+        raise ValueError(f'Unknown session type: {session_type}')
+    if action not in ACTIONS:
+        raise ValueError(f'Unknown action: {action}')
+    session_number = int(str(session['session_number']).removeprefix('session_'))
+
+    return RECORD.pack(
+        int(session['timestamp'].timestamp()),
+        session_number,
+        SESSION_TYPES.index(session_type),
+        ACTIONS.index(action)
+    )
+
+
+def decode_record(fields):
+    """Turn unpacked record fields into the session dict served by /history"""
+    timestamp, session_number, session_type, action = fields
+    return {
+        'timestamp': datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+        'session_type': SESSION_TYPES[session_type],
+        'action': ACTIONS[action],
+        'session_number': f'session_{session_number}'
+    }
+
+
+def record_count(path):
+    """Return the number of complete records stored in path"""
+    try:
+        return os.path.getsize(path) // RECORD.size
+    except FileNotFoundError:
+        return 0
+
+
+def find_record(path, timestamp):
+    """Binary search for the first record at or after an epoch timestamp.
+
+    Relies on records being appended in time order; returns record_count()
+    when every record is older.
+    """
+    low, high = 0, record_count(path)
+    if low == high:
+        return 0
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while low < high:
+            mid = (low + high) // 2
+            if struct.unpack_from('<q', mm, mid * RECORD.size)[0] >= timestamp:
+                high = mid
+            else:
+                low = mid + 1
+    return low
+
+
+def iter_records(path, start=0, stop=None):
+    """Yield unpacked fields for records start..stop straight from a memory map"""
+    count = record_count(path)
+    stop = count if stop is None else min(stop, count)
+    if start >= stop:
+        return
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)[start * RECORD.size:stop * RECORD.size]
+        records = RECORD.iter_unpack(view)
+        try:
+            yield from records
+        finally:
+            # The iterator holds a buffer export that must go before the map closes
+            del records
+            view.release()
@@ -0,0 +1,122 @@
+"""
+Cross-process record of recently logged event ids, so retried /log
+requests are not appended twice.
+
+The record lives in ``<log>.events``, memory-mapped by every worker like
+the generation counter and the metrics registry:
+
+    header   window start, next ring slot, current filter
+    filters  two Bloom filters, the current window's and the previous one's
+    ring     the 64-bit fingerprints of the last ``capacity`` ids
+
+Checking an id sets or tests a few bits in the filters. Nearly every new
+id misses both and is accepted without looking further. A filter hit is
+confirmed against the ring with ``mmap.find``, a C-speed search, so a
+Bloom false positive never drops a real event. An id counts as a
+duplicate only if it is still in the ring and was seen within the last
+one to two windows: when the current window is over, the older filter is
+cleared and reused. Memory is fixed by ``capacity`` however many events
+arrive; if more than ``capacity`` arrive within a window, the oldest ids
+are forgotten early and a very late retry of one of them is logged again.
+
+Nothing here reads the log.
+"""
+import hashlib
+import struct
+
+import shared_mmap
+
+# window start (wall clock, shared by all workers), next ring slot, current filter
+_HEADER = struct.Struct('<dQQ')
+_FINGERPRINT = struct.Struct('<Q')
+
+# Bloom filter size per id of capacity, and bits set per id; about 0.06%
+# false positives when a window holds ``capacity`` ids
+BITS_PER_ID = 16
+HASHES = 8
+
+def events_path(log_file):
+    """Return the path of the event id record that belongs to log_file"""
+    return log_file + '.events'
+
+
+def _filter_bytes(capacity):
+    return capacity * BITS_PER_ID // 8
+
+
+def _size(capacity):
+    return _HEADER.size + 2 * _filter_bytes(capacity) + capacity * _FINGERPRINT.size
+
+
+def _map(log_file, capacity):
+    return shared_mmap.get(events_path(log_file), _size(capacity))
+
+
+def _hash(key):
+    """Return the nonzero fingerprint of key and the second hash used to place its filter bits"""
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    fingerprint = _FINGERPRINT.unpack_from(digest)[0] or 1  # 0 marks an empty ring slot
+    step = _FINGERPRINT.unpack_from(digest, 8)[0] | 1
+    return fingerprint, step
+
+
+def _bits(fingerprint, step, capacity):
+    bits = capacity * BITS_PER_ID
+    return [(fingerprint + i * step) % bits for i in range(HASHES)]
+
+
+def _in_filter(mm, offset, bits):
+    return all(mm[offset + bit // 8] & (1 << bit % 8) for bit in bits)
+
+
+def _find(mm, ring, fingerprint):
+    """Return the offset of fingerprint's ring slot, or -1"""
+    needle = _FINGERPRINT.pack(fingerprint)
+    position = mm.find(needle, ring)
+    while position != -1 and (position - ring) % _FINGERPRINT.size:
+        position = mm.find(needle, position + 1)
+    return position
+
+
+def claim(log_file, key, window, capacity, now):
+    """Record key as logged; return False if it already was within the window
+
+    now is wall-clock seconds (``time.time()``), since the window is
+    shared by every process.
+    """
+    fingerprint, step = _hash(key)
+    bits = _bits(fingerprint, step, capacity)
+    filter_bytes = _filter_bytes(capacity)
+    ring = _HEADER.size + 2 * filter_bytes
+
+    with _map(log_file, capacity).locked() as mm:
+        start, next_slot, current = _HEADER.unpack_from(mm, 0)
+        if now - start >= window:
+            # Reuse the older filter for the new window; both are stale after a long pause
+            current = 1 - current
+            stale = (0, 1) if now - start >= 2 * window else (current,)
+            for index in stale:
+                offset = _HEADER.size + index * filter_bytes
+                mm[offset:offset + filter_bytes] = bytes(filter_bytes)
+            start = now
+
+        filters = [_HEADER.size + index * filter_bytes for index in (current, 1 - current)]
+        if any(_in_filter(mm, offset, bits) for offset in filters) and _find(mm, ring, fingerprint) != -1:
+            _HEADER.pack_into(mm, 0, start, next_slot, current)
+            return False
+
+        for bit in bits:
+            mm[filters[0] + bit // 8] |= 1 << bit % 8
+        _FINGERPRINT.pack_into(mm, ring + next_slot % capacity * _FINGERPRINT.size, fingerprint)
+        _HEADER.pack_into(mm, 0, start, next_slot + 1, current)
+        return True
+
+
+def release(log_file, key, capacity):
+    """Forget a claimed key whose event could not be stored, so a retry is accepted"""
+    fingerprint, _ = _hash(key)
+    ring = _HEADER.size + 2 * _filter_bytes(capacity)
+    with _map(log_file, capacity).locked() as mm:
+        position = _find(mm, ring, fingerprint)
+        if position != -1:
+            _FINGERPRINT.pack_into(mm, position, 0)
@@ -0,0 +1,39 @@
+"""
+Cross-process change counter for the session log.
+
+Every write to the log bumps a 64-bit counter kept in ``<log>.gen``. Each
+process maps that file once, so checking whether the log changed is a plain
+memory read: no stat, no open and no reading of the log itself. Worker-local
+caches remember the generation they were built at and rebuild when it moves.
+
+Only writes made through the app (or its CLI commands) bump the counter;
+editing the log by hand is not noticed until the next such write.
+"""
+import struct
+
+import shared_mmap
+
+_COUNTER = struct.Struct('<Q')
+
+
+def generation_path(log_file):
+    """Return the path of the generation counter that belongs to log_file"""
+    return log_file + '.gen'
+
+
+def release(log_file):
+    """Unmap log_file's counter in this process; the next use maps it again"""
+    shared_mmap.release(generation_path(log_file))
+
+
+def current(log_file):
+    """Return the current generation of log_file"""
+    return _COUNTER.unpack_from(shared_mmap.get(generation_path(log_file), _COUNTER.size).mm)[0]
+
+
+def bump(log_file):
+    """Record that log_file changed and return the new generation"""
+    with shared_mmap.get(generation_path(log_file), _COUNTER.size).locked() as mm:
+        value = _COUNTER.unpack_from(mm)[0] + 1
+        _COUNTER.pack_into(mm, 0, value)
+    return value
@@ -0,0 +1,116 @@
+"""
+Per-worker cache of parsed sessions from the active text log.
+
+The cache is keyed by the log's inode and the byte offset it has read up
+to. A refresh stats the log and parses only the bytes appended since the
+last one, so repeated /history calls stop re-parsing identical lines. The
+log being replaced or truncated (rotation, manual edits) resets the cache.
+
+Memory is capped at ``max_records`` sessions. The oldest ones are evicted
+first and served from disk through the byte-offset index when asked for.
+When more lines were appended than the cache can hold (the first refresh
+of a large log, typically in the gunicorn master at boot), the refresh
+seeks through the index to the last ``max_records`` of them instead of
+parsing lines it would evict straight away.
+"""
+import os
+import threading
+
+import log_index
+
+# No log line is shorter than this, so fewer unread bytes than
+# max_records * MIN_LINE_BYTES cannot hold more lines than fit in the cache
+MIN_LINE_BYTES = 32
+
+
+class HistoryCache:
+    """Parsed sessions of one log file, one entry per line (None if malformed)"""
+
+    def __init__(self, log_file, parse, max_records=100000):
+        self.log_file = log_file
+        self.parse = parse
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inode):
+        self.inode = inode
+        self.offset = 0          # bytes of the log parsed so far
+        self.first_line = 0      # line number of records[0]
+        self.records = []
+
+    def refresh(self):
+        """Parse lines appended since the last refresh and return the line count"""
+        with self.lock:
+            try:
+                st = os.stat(self.log_file)
+            except FileNotFoundError:
+                self._reset(None)
+                return 0
+
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                self._reset(st.st_ino)
+
+            if st.st_size - self.offset > self.max_records * MIN_LINE_BYTES:
+                self._skip_to_tail()
+
+            if st.st_size > self.offset:
+                with open(self.log_file, 'rb') as log:
+                    log.seek(self.offset)
+                    for raw in log:
+                        if not raw.endswith(b'\n'):
+                            break  # partial record, still being appended
+                        self.offset += len(raw)
+                        self.records.append(self.parse(raw.decode('utf-8', errors='replace')))
+
+                        # Evict in chunks so trimming stays amortized O(1) per record
+                        excess = len(self.records) - self.max_records
+                        if excess > self.max_records // 4:
+                            del self.records[:excess]
+                            self.first_line += excess
+
+            return self.first_line + len(self.records)
+
+    def _skip_to_tail(self):
+        """Drop the cached lines and move to the indexed line at or before the last max_records"""
+        line_count = log_index.refresh_index(self.log_file)
+        target = line_count - self.max_records
+        if target > self.first_line + len(self.records):
+            self.offset, self.first_line = log_index.line_offset(self.log_file, target)
+            self.records = []
+
+    def iter_sessions(self, start, stop):
+        """Yield (line number, session or None) for lines start..stop
+
+        Lines still held in memory come from the cache; evicted ones are
+        read from disk via the byte-offset index.
+        """
+        with self.lock:
+            first_line = self.first_line
+            cached = self.records[max(start - first_line, 0):max(stop - first_line, 0)]
+
+        if start < first_line:
+            line_count = log_index.refresh_index(self.log_file)
+            for line_number, line in log_index.iter_lines(self.log_file, start, min(stop, first_line, line_count)):
+                yield line_number, self.parse(line)
+
+        yield from enumerate(cached, max(start, first_line))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(log_file, parse, max_records):
+    """Return this worker's cache for log_file, creating it on first use"""
+    with _caches_lock:
+        cache = _caches.get(log_file)
+        if cache is None or cache.max_records != max_records:
+            cache = _caches[log_file] = HistoryCache(log_file, parse, max_records)
+        return cache
+
+
+def discard(log_file):
+    """Drop this worker's cache for log_file, freeing its parsed sessions"""
+    with _caches_lock:
+        _caches.pop(log_file, None)
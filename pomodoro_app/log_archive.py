@@ -0,0 +1,324 @@
+"""
+Rotation, gzip archival, compaction and retention for the text session log.
+
+Rotated logs become segments in ``<log>.archive/``. ``manifest.json`` in that
+directory lists every segment in log order with its first global line
+number, line count, first/last timestamp and per-day rollups, so readers
+can skip segments outside a requested range and /stats never reopens them.
+Line numbers are global: the active log starts at the manifest's
+``next_line``, which keeps history cursors valid across rotations.
+
+Appenders and readers hold a shared advisory lock on ``<log>.lock`` while
+they touch the log; rotation takes it exclusively just long enough to
+rename the active log and record the new segment. Compressing the renamed
+file happens afterwards without blocking anyone.
+"""
+import contextlib
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines: no cross-process locking
+    fcntl = None
+
+import generation
+import log_index
+import rollups
+
+logger = logging.getLogger(__name__)
+
+
+def archive_dir(log_file):
+    """Return the directory holding the archived segments of log_file"""
+    return log_file + '.archive'
+
+
+def manifest_path(log_file):
+    """Return the path of the archive manifest of log_file"""
+    return os.path.join(archive_dir(log_file), 'manifest.json')
+
+
+@contextlib.contextmanager
+def _flock(path, exclusive=False, blocking=True):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl:
+            flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(fd, flags if blocking else flags | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+        yield True
+    finally:
+        os.close(fd)  # closing the descriptor releases the lock
+
+
+def log_lock(log_file, exclusive=False):
+    """Hold the advisory lock that coordinates appends and reads with rotation"""
+    return _flock(log_file + '.lock', exclusive)
+
+
+def load_manifest(log_file):
+    """Return the archive manifest, or an empty one if nothing was archived yet"""
+    try:
+        with open(manifest_path(log_file), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'next_line': 0, 'segments': []}
+
+
+def _save_manifest(log_file, manifest):
+    tmp_path = f'{manifest_path(log_file)}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path(log_file))
+
+
+def segment_path(log_file, segment):
+    """Return the path of an archived segment"""
+    return os.path.join(archive_dir(log_file), segment['file'])
+
+
+def overlaps(segment, since=None, until=None):
+    """Whether a segment may hold timestamps in [since, until)"""
+    if since and segment['last'] and segment['last'] < since:
+        return False
+    if until and segment['first'] and segment['first'] >= until:
+        return False
+    return True
+
+
+def open_segment_lines(log_file, segment, start_line=0):
+    """Open a segment and return an iterator of (global line number, text) from start_line on.
+
+    The file is opened before returning, so the caller may release the log
+    lock and keep reading even if the segment is compacted or deleted.
+    """
+    path = segment_path(log_file, segment)
+    f = (gzip.open if path.endswith('.gz') else open)(path, 'rb')
+    return _segment_lines(f, segment, start_line)
+
+
+def _segment_lines(f, segment, start_line):
+    stop_line = segment['first_line'] + segment['lines']
+    with f:
+        for line_number, raw in enumerate(f, segment['first_line']):
+            if line_number >= stop_line:
+                break
+            if line_number >= start_line:
+                yield line_number, raw.decode('utf-8', errors='replace')
+
+
+def iter_segment_lines(log_file, segment, start_line=0):
+    """Yield (global line number, text) for a segment from global start_line on"""
+    yield from open_segment_lines(log_file, segment, start_line)
+
+
+def _segment_at(log_file, line_number):
+    """Return the segment now holding line_number, or None if retention deleted it"""
+    with log_lock(log_file):
+        for segment in load_manifest(log_file)['segments']:
+            if segment['first_line'] <= line_number < segment['first_line'] + segment['lines']:
+                return segment
+    return None
+
+
+def stream_segment_lines(log_file, segments, start_line=0):
+    """Yield (global line number, text) from a list of segments, opening one file at a time
+
+    segments is a snapshot of the manifest taken under the log lock. A
+    segment gzipped or compacted since is found again by line number in
+    the current manifest; lines that retention deleted meanwhile are
+    skipped.
+    """
+    for segment in segments:
+        stop_line = segment['first_line'] + segment['lines']
+        next_line = max(start_line, segment['first_line'])
+        current = segment
+        while current is not None and next_line < stop_line:
+            try:
+                lines = open_segment_lines(log_file, current, next_line)
+            except FileNotFoundError:
+                current = _segment_at(log_file, next_line)
+                continue
+            with contextlib.closing(lines):
+                for line_number, text in lines:
+                    if line_number >= stop_line:
+                        break  # a compacted segment also holds the next ones
+                    yield line_number, text
+            break
+
+
+def rotation_due(log_file, max_bytes=0, daily=False):
+    """Cheap check whether the active log should be rotated"""
+    try:
+        size = os.path.getsize(log_file)
+    except FileNotFoundError:
+        return False
+    if size == 0:
+        return False
+    if max_bytes and size >= max_bytes:
+        return True
+    if daily:
+        with open(log_file, 'rb') as f:
+            first_day = f.read(10).decode('ascii', errors='replace')
+        return first_day < datetime.now().strftime('%Y-%m-%d')
+    return False
+
+
+def rotate_log(log_file, max_bytes=0, daily=False, force=False):
+    """Move the active log into a new pending segment if rotation is due.
+
+    Returns the new segment entry, or None if nothing was rotated. The
+    segment is still uncompressed; call archive_pending() to gzip it.
+    """
+    with log_lock(log_file, exclusive=True):
+        # Re-check under the lock: another worker may have rotated already
+        if not force and not rotation_due(log_file, max_bytes, daily):
+            return None
+        if not os.path.exists(log_file) or os.path.getsize(log_file) == 0:
+            return None
+
+        line_count = log_index.refresh_index(log_file)
+        first, last = log_index.time_span(log_file)
+        days = rollups.refresh_rollups(log_file)
+
+        manifest = load_manifest(log_file)
+        segment = {
+            'file': f"segment-{manifest['next_line']:012d}.log",
+            'first_line': manifest['next_line'],
+            'lines': line_count,
+            'first': first,
+            'last': last,
+            'days': days
+        }
+        os.makedirs(archive_dir(log_file), exist_ok=True)
+        os.rename(log_file, segment_path(log_file, segment))
+        manifest['segments'].append(segment)
+        manifest['next_line'] += line_count
+        _save_manifest(log_file, manifest)
+        generation.bump(log_file)
+
+        # The index and rollups described the file that was just moved away
+        for derived in (log_index.index_path(log_file), rollups.stats_path(log_file)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(derived)
+
+    return segment
+
+
+def _archive_lock(log_file):
+    os.makedirs(archive_dir(log_file), exist_ok=True)
+    return _flock(os.path.join(archive_dir(log_file), '.lock'), exclusive=True, blocking=False)
+
+
+def _replace_segments(log_file, old_files, new_segment):
+    """Swap the manifest entries for old_files with new_segment and delete the old files"""
+    with log_lock(log_file, exclusive=True):
+        manifest = load_manifest(log_file)
+        segments = manifest['segments']
+        positions = [i for i, segment in enumerate(segments) if segment['file'] in old_files]
+        if not positions:
+            return
+        segments[positions[0]:positions[-1] + 1] = [new_segment] if new_segment else []
+        _save_manifest(log_file, manifest)
+        generation.bump(log_file)
+    for name in old_files:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(archive_dir(log_file), name))
+
+
+def archive_pending(log_file, retention_days=0):
+    """Gzip segments that are still plain text, then apply the retention policy"""
+    with _archive_lock(log_file) as acquired:
+        if not acquired:
+            return  # another process is already archiving
+
+        for segment in load_manifest(log_file)['segments']:
+            if segment['file'].endswith('.gz'):
+                continue
+            source = segment_path(log_file, segment)
+            archived = dict(segment, file=segment['file'] + '.gz')
+            tmp_path = segment_path(log_file, archived) + '.tmp'
+            with open(source, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, segment_path(log_file, archived))
+            _replace_segments(log_file, [segment['file']], archived)
+
+        if retention_days:
+            cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+            for segment in load_manifest(log_file)['segments']:
+                if segment['last'] and segment['last'] < cutoff:
+                    _replace_segments(log_file, [segment['file']], None)
+
+
+def compact_archive(log_file, target_bytes):
+    """Merge runs of adjacent gzip segments until each is about target_bytes.
+
+    gzip files concatenate into a valid multi-member gzip file, so merging
+    needs no recompression. Returns the number of segments removed.
+    """
+    removed = 0
+    with _archive_lock(log_file) as acquired:
+        if not acquired:
+            return removed
+
+        segments = [s for s in load_manifest(log_file)['segments'] if s['file'].endswith('.gz')]
+        runs, run, run_bytes = [], [], 0
+        for segment in segments:
+            size = os.path.getsize(segment_path(log_file, segment))
+            if run and (run_bytes + size > target_bytes or run[-1]['first_line'] + run[-1]['lines'] != segment['first_line']):
+                runs.append(run)
+                run, run_bytes = [], 0
+            run.append(segment)
+            run_bytes += size
+        runs.append(run)
+
+        for run in runs:
+            if len(run) < 2:
+                continue
+            days = {}
+            for segment in run:
+                rollups.merge_days(days, segment['days'])
+            merged = {
+                'file': f"segment-{run[0]['first_line']:012d}-{run[-1]['first_line']:012d}.log.gz",
+                'first_line': run[0]['first_line'],
+                'lines': sum(segment['lines'] for segment in run),
+                'first': run[0]['first'],
+                'last': run[-1]['last'],
+                'days': days
+            }
+            tmp_path = segment_path(log_file, merged) + '.tmp'
+            with open(tmp_path, 'wb') as dst:
+                for segment in run:
+                    with open(segment_path(log_file, segment), 'rb') as src:
+                        shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, segment_path(log_file, merged))
+            _replace_segments(log_file, [segment['file'] for segment in run], merged)
+            removed += len(run) - 1
+    return removed
+
+
+def maybe_rotate(log_file, max_bytes=0, daily=False, retention_days=0):
+    """Rotate the log if due and archive the new segment on a background thread"""
+    if not rotation_due(log_file, max_bytes, daily):
+        return
+    if rotate_log(log_file, max_bytes, daily):
+        threading.Thread(
+            target=_archive_in_background, args=(log_file, retention_days),
+            name='pomodoro-log-archiver', daemon=True
+        ).start()
+
+
+def _archive_in_background(log_file, retention_days):
+    try:
+        archive_pending(log_file, retention_days)
+    except Exception:
+        logger.exception('Failed to archive rotated log segments')
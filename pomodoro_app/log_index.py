@@ -0,0 +1,216 @@
+"""
+Sparse byte-offset and timestamp index over the pomodoro session log.
+
+The index lives next to the log file (``<log>.idx``) and stores, for every
+INDEX_STRIDE-th line, its byte offset and the timestamp of the log at that
+point. It is brought up to date incrementally, so only bytes appended since
+the last refresh are ever scanned. A page of history can seek straight to
+its slice, and because the log is append-only and time-ordered a time range
+is located by binary search over the entries instead of a linear scan.
+
+Index file layout (little endian):
+    header  - magic, inode, indexed bytes, line count, last timestamp seen
+    entries - (byte offset, timestamp) of line 0, INDEX_STRIDE, 2 * INDEX_STRIDE, ...
+
+Timestamps are the 19 character ``YYYY-MM-DD HH:MM:SS`` strings of the log,
+which sort lexically. An entry whose line is malformed carries the last
+timestamp seen before it, so entry timestamps never go backwards.
+"""
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines: no cross-process locking
+    fcntl = None
+
+# Number of lines between two index entries
+INDEX_STRIDE = 64
+
+# Bytes read per step when scanning the log backwards from its end
+TAIL_BLOCK_SIZE = 8192
+
+_MAGIC = b'PIX2'
+_HEADER = struct.Struct('<4sQQQ19s')
+_ENTRY = struct.Struct('<Q19s')
+
+
+def index_path(log_file):
+    """Return the path of the index file that belongs to log_file"""
+    return log_file + '.idx'
+
+
+def _line_timestamp(raw, previous):
+    parts = raw.split(b' | ')
+    # Four fields, or five when the line carries a checksum (see framing.py)
+    if len(parts) in (4, 5) and len(parts[0]) == 19:
+        return parts[0]
+    return previous
+
+
+def refresh_index(log_file):
+    """Bring the index up to date with log_file and return its line count.
+
+    Only complete (newline terminated) lines are indexed, so a record that
+    is still being written is picked up by a later refresh. The index is
+    rebuilt from scratch if the log was replaced or truncated. Refreshes
+    from different processes are serialized with an exclusive flock.
+    """
+    fd = os.open(index_path(log_file), os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+b') as idx:
+        if fcntl:
+            fcntl.flock(idx, fcntl.LOCK_EX)
+        st = os.stat(log_file)
+        header = idx.read(_HEADER.size)
+        if len(header) == _HEADER.size and header.startswith(_MAGIC):
+            _, inode, indexed, lines, last_timestamp = _HEADER.unpack(header)
+        else:
+            inode, indexed, lines, last_timestamp = st.st_ino, 0, 0, b''
+
+        if inode != st.st_ino or indexed > st.st_size:
+            inode, indexed, lines, last_timestamp = st.st_ino, 0, 0, b''
+
+        if indexed < st.st_size or not header.startswith(_MAGIC):
+            first_entry = -(-lines // INDEX_STRIDE)
+            new_entries = []
+            with open(log_file, 'rb') as log:
+                log.seek(indexed)
+                for raw in log:
+                    if not raw.endswith(b'\n'):
+                        break  # partial record, still being appended
+                    last_timestamp = _line_timestamp(raw, last_timestamp)
+                    if lines % INDEX_STRIDE == 0:
+                        new_entries.append(_ENTRY.pack(indexed, last_timestamp))
+                    indexed += len(raw)
+                    lines += 1
+
+            idx.seek(_HEADER.size + first_entry * _ENTRY.size)
+            idx.truncate()
+            idx.write(b''.join(new_entries))
+            idx.seek(0)
+            idx.write(_HEADER.pack(_MAGIC, inode, indexed, lines, last_timestamp))
+
+    return lines
+
+
+def _read_entry(idx, entry):
+    idx.seek(_HEADER.size + entry * _ENTRY.size)
+    raw = idx.read(_ENTRY.size)
+    if len(raw) < _ENTRY.size:
+        return None
+    offset, timestamp = _ENTRY.unpack(raw)
+    return offset, timestamp.rstrip(b'\0').decode('ascii')
+
+
+def line_offset(log_file, line_number):
+    """Return (offset, line) of the closest indexed line at or before line_number"""
+    entry = line_number // INDEX_STRIDE
+    with open(index_path(log_file), 'rb') as idx:
+        found = _read_entry(idx, entry)
+    if found is None:
+        return 0, 0
+    return found[0], entry * INDEX_STRIDE
+
+
+def time_span(log_file):
+    """Return (first, last) timestamps of the indexed lines, '' when unknown"""
+    with open(index_path(log_file), 'rb') as idx:
+        header = idx.read(_HEADER.size)
+        first = _read_entry(idx, 0)
+    if len(header) < _HEADER.size or first is None:
+        return '', ''
+    last = _HEADER.unpack(header)[4].rstrip(b'\0').decode('ascii')
+    return first[1], last
+
+
+def _first_entry_after(log_file, line_count, is_after):
+    """Binary search for the first entry whose timestamp satisfies is_after"""
+    low, high = 0, -(-line_count // INDEX_STRIDE)
+    with open(index_path(log_file), 'rb') as idx:
+        while low < high:
+            mid = (low + high) // 2
+            if is_after(_read_entry(idx, mid)[1]):
+                high = mid
+            else:
+                low = mid + 1
+    return low
+
+
+def line_range(log_file, line_count, since=None, until=None):
+    """Return (start, stop) line numbers that cover timestamps in [since, until).
+
+    since and until are ``YYYY-MM-DD HH:MM:SS`` strings. The range is rounded
+    out to index entries, so callers still filter individual lines; lines
+    outside it are guaranteed to fall outside the time range.
+    """
+    start, stop = 0, line_count
+    if since:
+        # Entry k starts at or after since, so lines of entry k - 1 may still match
+        entry = _first_entry_after(log_file, line_count, lambda ts: ts >= since)
+        start = max(entry - 1, 0) * INDEX_STRIDE
+    if until:
+        entry = _first_entry_after(log_file, line_count, lambda ts: ts >= until)
+        stop = min(entry * INDEX_STRIDE, line_count)
+    return start, stop
+
+
+def open_lines(log_file, start_line, line_count):
+    """Open log_file at start_line and return an iterator of (line_number, text).
+
+    Unlike iter_lines the file is opened before returning, so callers can
+    release locks and keep reading from the open file.
+    """
+    offset, line_number = line_offset(log_file, start_line)
+    log = open(log_file, 'rb')
+    log.seek(offset)
+    return _read_lines(log, line_number, start_line, line_count)
+
+
+def _read_lines(log, line_number, start_line, line_count):
+    with log:
+        for raw in log:
+            if line_number >= line_count:
+                break
+            if line_number >= start_line:
+                yield line_number, raw.decode('utf-8', errors='replace')
+            line_number += 1
+
+
+def iter_lines(log_file, start_line, line_count):
+    """Yield (line_number, text) for complete lines from start_line up to line_count.
+
+    Seeks to the nearest indexed offset and skips at most INDEX_STRIDE - 1
+    lines, so the cost is independent of how far into the log the page is.
+    """
+    yield from open_lines(log_file, start_line, line_count)
+
+
+def iter_lines_reversed(log_file, block_size=TAIL_BLOCK_SIZE):
+    """Yield the complete lines of log_file from the last one to the first.
+
+    The file is read backwards in block_size steps from the end, so taking
+    the last N lines costs O(N) however long the log is. A final line that
+    is not newline terminated yet (an append in progress) is skipped.
+    """
+    with open(log_file, 'rb') as log:
+        position = log.seek(0, os.SEEK_END)
+        pending = b''       # start of the earliest line seen, may begin in an earlier block
+        in_partial = True   # still inside the unterminated tail of the file
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            log.seek(position)
+            chunk = log.read(size) + pending
+            if in_partial:
+                end = chunk.rfind(b'\n')
+                if end < 0:
+                    pending = b''
+                    continue
+                chunk = chunk[:end]
+                in_partial = False
+            lines = chunk.split(b'\n')
+            pending = lines.pop(0)
+            for raw in reversed(lines):
+                yield raw.decode('utf-8', errors='replace')
+        if not in_partial:
+            yield pending.decode('utf-8', errors='replace')
@@ -0,0 +1,319 @@
+"""
+Appending session records to the pomodoro log.
+
+``append_lines`` (text log) and ``append_binary`` (binary store) perform a
+synchronous append, bump the log's generation counter and bring the derived
+index and rollups up to date. Each call issues exactly one ``O_APPEND``
+write, so batches written by concurrent gunicorn workers never interleave.
+``BackgroundWriter`` lets
+request handlers enqueue records on a bounded in-process queue while a
+single writer thread group-commits them: each batch costs one
+open/write/close cycle no matter how many records it holds.
+
+DURABILITY decides when appended bytes are forced to disk: ``none`` leaves
+it to the OS, ``interval`` fsyncs written files from a background thread at
+most FSYNC_INTERVAL seconds apart, and ``always`` fsyncs before the append
+returns. ``recover_tail`` cuts a record torn by a crash off the end of the
+text log before anything is appended after it.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import binary_store
+import framing
+import generation
+import log_archive
+import log_index
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 'none', 'interval' or 'always'; see the module docstring
+DURABILITY = os.environ.get('POMODORO_DURABILITY', 'none')
+FSYNC_INTERVAL = float(os.environ.get('POMODORO_FSYNC_INTERVAL', '1.0'))
+
+DURABILITY_MODES = ('none', 'interval', 'always')
+
+# Queue marker asking the writer thread to drain and exit
+_STOP = object()
+
+
+def append_once(log_file, data):
+    """Append bytes to log_file with a single unbuffered O_APPEND write, durable as DURABILITY asks"""
+    with open(log_file, 'ab', buffering=0) as f:
+        written = f.write(data)
+        # Short writes only happen on a full disk or an interrupted call
+        while written < len(data):
+            written += f.write(data[written:])
+
+        if DURABILITY == 'always':
+            fsync(log_file, f.fileno())
+            if f.tell() == len(data):
+                # First write to a new file: its directory entry must survive too
+                sync_directory(log_file)
+        elif DURABILITY == 'interval':
+            get_syncer().mark(log_file)
+
+
+def fsync(log_file, fd):
+    """fsync fd and record how long it took"""
+    started = time.perf_counter()
+    os.fsync(fd)
+    metrics.observe(log_file, 'pomodoro_log_fsync_duration_seconds', time.perf_counter() - started)
+
+
+def sync_directory(path):
+    """fsync the directory holding path so a newly created file is not lost"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return  # not possible on every platform
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class IntervalSyncer:
+    """Thread that fsyncs the files appended to since its last pass, every interval seconds"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pomodoro-fsync', daemon=True)
+        self._thread.start()
+
+    def mark(self, log_file):
+        """Note that log_file has bytes that are not on disk yet"""
+        with self.lock:
+            self.dirty.add(log_file)
+
+    def sync(self):
+        """fsync every file marked since the last pass"""
+        with self.lock:
+            paths, self.dirty = self.dirty, set()
+        for path in paths:
+            try:
+                # fsync flushes the file's data whichever descriptor it is called on
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    fsync(path, fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logger.warning('Could not fsync %s: %s', path, e)
+
+    def close(self):
+        """Stop the thread after a final pass"""
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sync()
+        self.sync()
+
+
+_syncer = None
+_syncer_lock = threading.Lock()
+
+
+def get_syncer():
+    """Return this process's interval syncer, starting it on first use"""
+    global _syncer
+    with _syncer_lock:
+        if _syncer is None:
+            _syncer = IntervalSyncer(FSYNC_INTERVAL)
+        return _syncer
+
+
+@atexit.register
+def shutdown_syncer():
+    """Force what is still pending to disk before the process exits"""
+    with _syncer_lock:
+        if _syncer is not None:
+            _syncer.close()
+
+
+def _forget_syncer():
+    # The syncer thread does not survive fork; a child starts its own
+    global _syncer
+    _syncer = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_syncer)
+
+
+def recover_tail(log_file, block_size=log_index.TAIL_BLOCK_SIZE):
+    """Truncate a record torn by a crash from the end of the text log; return the bytes removed
+
+    Only the last block_size bytes are read. A final line without its
+    newline is an append that never completed, and framed lines at the end
+    whose checksum fails were only partly written. Appends hold the log
+    lock shared, so with it held exclusively nothing is being written and
+    whatever is incomplete is torn for good.
+    """
+    with log_archive.log_lock(log_file, exclusive=True):
+        try:
+            log = open(log_file, 'r+b')
+        except FileNotFoundError:
+            return 0
+        with log:
+            size = log.seek(0, os.SEEK_END)
+            start = max(size - block_size, 0)
+            log.seek(start)
+            tail = log.read()
+
+            keep = tail.rfind(b'\n') + 1
+            if keep == 0 and start > 0:
+                logger.warning('No complete record in the last %d bytes of %s; not truncating', block_size, log_file)
+                return 0
+            while keep:
+                line_start = tail.rfind(b'\n', 0, keep - 1) + 1
+                if line_start == 0 and start > 0:
+                    break  # the line may begin before the block
+                if not framing.is_damaged(tail[line_start:keep].decode('utf-8', errors='replace')):
+                    break
+                keep = line_start
+
+            removed = len(tail) - keep
+            if not removed:
+                return 0
+            log.truncate(start + keep)
+            os.fsync(log.fileno())
+
+    generation.bump(log_file)
+    logger.warning('Removed %d bytes of torn records from the end of %s', removed, log_file)
+    return removed
+
+
+def recover_binary_tail(log_file):
+    """Truncate a partially written record from the end of the binary store; return the bytes removed"""
+    with log_archive.log_lock(log_file, exclusive=True):
+        try:
+            size = os.path.getsize(log_file)
+        except FileNotFoundError:
+            return 0
+        removed = size % binary_store.RECORD.size
+        if not removed:
+            return 0
+        with open(log_file, 'r+b') as log:
+            log.truncate(size - removed)
+            os.fsync(log.fileno())
+
+    generation.bump(log_file)
+    logger.warning('Removed %d bytes of a torn record from the end of %s', removed, log_file)
+    return removed
+
+
+def append_lines(log_file, lines):
+    """Append already formatted log lines to log_file in a single write"""
+    data = ''.join(lines).encode('utf-8')
+    started = time.perf_counter()
+    # Shared lock: appends never land in a file that rotation is moving away
+    with log_archive.log_lock(log_file):
+        append_once(log_file, data)
+    elapsed = time.perf_counter() - started
+    generation.bump(log_file)
+
+    record_append(log_file, elapsed, len(data))
+    # Keep the index in step; the rollups are folded in when /stats reads them
+    try:
+        log_index.refresh_index(log_file)
+    except OSError as e:
+        logger.warning('Could not update history index: %s', e)
+
+
+def append_binary(log_file, records):
+    """Append packed binary records to log_file in a single write"""
+    started = time.perf_counter()
+    with log_archive.log_lock(log_file):
+        append_once(log_file, b''.join(records))
+    elapsed = time.perf_counter() - started
+    generation.bump(log_file)
+    record_append(log_file, elapsed, len(records) * binary_store.RECORD.size)
+
+
+def record_append(log_file, elapsed, size):
+    """Count one append of size bytes that took elapsed seconds in the metrics registry"""
+    metrics.observe(log_file, 'pomodoro_log_append_duration_seconds', elapsed)
+    metrics.inc(log_file, 'pomodoro_log_bytes_written_total', size)
+
+
+class BackgroundWriter:
+    """Group-commit writer thread fed by a bounded queue.
+
+    A batch is flushed as soon as it holds ``batch_size`` records or
+    ``flush_interval`` seconds after its first record arrived, whichever
+    comes first.
+    """
+
+    def __init__(self, flush_interval=0.05, batch_size=256, max_queue=10000):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, name='pomodoro-log-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, log_file, entries, append=append_lines, timeout=1.0):
+        """Enqueue entries to be written with append(log_file, entries).
+
+        Raises queue.Full if the queue stays full for timeout seconds.
+        """
+        if self.closed:
+            raise RuntimeError('Log writer has been shut down')
+        self.queue.put((append, log_file, entries), timeout=timeout)
+
+    def flush(self):
+        """Block until every record submitted so far has been written"""
+        self.queue.join()
+
+    def close(self, timeout=None):
+        """Stop accepting records, write everything still queued and stop the thread"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is _STOP
+            records = batch[:-1] if stop else batch
+            try:
+                self._write(records)
+            except Exception:
+                logger.exception('Failed to write %d log records', len(records))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if stop:
+                return
+
+    def _write(self, records):
+        # Group by file while preserving arrival order within each file
+        by_file = {}
+        for append, log_file, entries in records:
+            by_file.setdefault((append, log_file), []).extend(entries)
+        for (append, log_file), entries in by_file.items():
+            append(log_file, entries)
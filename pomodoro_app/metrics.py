@@ -0,0 +1,178 @@
+"""
+Cross-process metrics registry behind the /metrics endpoint.
+
+Every metric has a fixed set of label values, so the whole registry is a
+flat array of float64 slots laid out once at import time. The array lives
+in ``<log>.metrics`` and is memory mapped by every process, which makes the
+numbers add up across gunicorn workers without a collector process: an
+update is a few in-place adds under an flock, and a scrape reads the map.
+
+Histograms store one non-cumulative count per bucket (the last one is
++Inf) followed by the sum of observed values; ``render`` turns them into
+the cumulative ``_bucket``/``_sum``/``_count`` series Prometheus expects.
+"""
+import os
+import struct
+
+import shared_mmap
+
+# Set POMODORO_METRICS=0 to turn all recording off
+ENABLED = os.environ.get('POMODORO_METRICS', '1') == '1'
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Upper bounds of the records-parsed-per-request histogram buckets
+RECORD_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Views whose requests are timed
+ROUTES = ('index', 'log_session', 'get_history')
+
+# Worker-local caches whose hits and misses are counted
+CACHES = ('history', 'stats', 'analytics')
+
+# Reasons /log requests are refused by admission control
+SHED_REASONS = ('rate_limit', 'overload')
+
+_VALUE = struct.Struct('<d')
+
+
+class Metric:
+    """One counter or histogram and the slots it occupies in the registry"""
+
+    def __init__(self, name, kind, help_text, label=None, label_values=(None,), buckets=()):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.label = label
+        self.label_values = label_values
+        self.buckets = buckets
+        self.width = len(buckets) + 2 if kind == 'histogram' else 1
+        self.first_slot = 0
+
+    def slot(self, label_value=None):
+        return self.first_slot + self.label_values.index(label_value) * self.width
+
+
+METRICS = {metric.name: metric for metric in (
+    Metric('pomodoro_http_request_duration_seconds', 'histogram',
+           'Time spent handling requests, by route', 'route', ROUTES, LATENCY_BUCKETS),
+    Metric('pomodoro_log_append_duration_seconds', 'histogram',
+           'Time spent appending one batch of records to the log', buckets=LATENCY_BUCKETS),
+    Metric('pomodoro_log_fsync_duration_seconds', 'histogram',
+           'Time spent forcing appended records to disk', buckets=LATENCY_BUCKETS),
+    Metric('pomodoro_log_bytes_written_total', 'counter',
+           'Bytes appended to the log'),
+    Metric('pomodoro_history_records_parsed', 'histogram',
+           'Log records parsed per /history request', buckets=RECORD_BUCKETS),
+    Metric('pomodoro_log_duplicates_total', 'counter',
+           'Logged events dropped because their event_id was already logged'),
+    Metric('pomodoro_log_requests_shed_total', 'counter',
+           '/log requests refused with 429, by reason', 'reason', SHED_REASONS),
+    Metric('pomodoro_cache_hits_total', 'counter',
+           'Lookups answered from a worker-local cache', 'cache', CACHES),
+    Metric('pomodoro_cache_misses_total', 'counter',
+           'Lookups that had to rebuild or extend a worker-local cache', 'cache', CACHES),
+)}
+
+_SLOTS = 0
+for _metric in METRICS.values():
+    _metric.first_slot = _SLOTS
+    _SLOTS += _metric.width * len(_metric.label_values)
+
+# log file -> log file whose registry records its metrics (per-user shards)
+_shared_registries = {}
+
+
+def metrics_path(log_file):
+    """Return the path of the metrics registry that belongs to log_file"""
+    return log_file + '.metrics'
+
+
+def share_registry(log_file, registry_log_file):
+    """Record everything reported for log_file in registry_log_file's registry"""
+    _shared_registries[log_file] = registry_log_file
+
+
+def _map(log_file):
+    return shared_mmap.get(metrics_path(_shared_registries.get(log_file, log_file)), _SLOTS * _VALUE.size)
+
+
+def _add(log_file, increments):
+    with _map(log_file).locked() as mm:
+        for slot, amount in increments:
+            offset = slot * _VALUE.size
+            _VALUE.pack_into(mm, offset, _VALUE.unpack_from(mm, offset)[0] + amount)
+
+
+def inc(log_file, name, amount=1, label_value=None):
+    """Add amount to a counter"""
+    if not ENABLED:
+        return
+    _add(log_file, [(METRICS[name].slot(label_value), amount)])
+
+
+def observe(log_file, name, value, label_value=None):
+    """Record one observation in a histogram"""
+    if not ENABLED:
+        return
+    metric = METRICS[name]
+    base = metric.slot(label_value)
+    bucket = next((i for i, bound in enumerate(metric.buckets) if value <= bound), len(metric.buckets))
+    _add(log_file, [(base + bucket, 1), (base + len(metric.buckets) + 1, value)])
+
+
+def snapshot(log_file):
+    """Return a copy of every slot of the registry"""
+    with _map(log_file).locked(shared=True) as mm:
+        data = mm[:]
+    return [value for (value,) in _VALUE.iter_unpack(data)]
+
+
+def value(log_file, name, label_value=None):
+    """Return the current value of a counter"""
+    return snapshot(log_file)[METRICS[name].slot(label_value)]
+
+
+def _number(value):
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def _labels(pairs):
+    pairs = [(key, value) for key, value in pairs if key is not None]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+def render(log_file, gauges=()):
+    """Return the registry in the Prometheus text exposition format.
+
+    gauges is a sequence of (name, help, {label tuple or None: value}) for
+    values that are computed at scrape time rather than accumulated.
+    """
+    slots = snapshot(log_file)
+    lines = []
+    for metric in METRICS.values():
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for label_value in metric.label_values:
+            base = metric.slot(label_value)
+            label = (metric.label, label_value)
+            if metric.kind == 'counter':
+                lines.append(f'{metric.name}{_labels([label])} {_number(slots[base])}')
+                continue
+            cumulative = 0
+            for i, bound in enumerate(metric.buckets + (None,)):
+                cumulative += slots[base + i]
+                le = '+Inf' if bound is None else _number(bound)
+                lines.append(f'{metric.name}_bucket{_labels([label, ("le", le)])} {_number(cumulative)}')
+            lines.append(f'{metric.name}_sum{_labels([label])} {_number(slots[base + len(metric.buckets) + 1])}')
+            lines.append(f'{metric.name}_count{_labels([label])} {_number(cumulative)}')
+
+    for name, help_text, samples in gauges:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        for label, sample in samples.items():
+            lines.append(f'{name}{_labels([label] if label else [])} {_number(sample)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,134 @@
+"""
+Per-day session counts maintained alongside the session log.
+
+The rollups are persisted as ``<log>.stats.json`` together with the byte
+offset of the log they cover. Every refresh only reads what was appended
+after that offset. Appends never touch the file: /stats, warm-up and
+rotation fold in whatever was appended since, so a write costs the same
+however many days the rollups span, and /stats never has to scan the
+whole log. Refreshes are serialized by an flock on ``<log>.stats.lock``.
+
+Layout of the counts: ``days[date][session_type][action] -> count``.
+"""
+import json
+import os
+import tempfile
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines: no cross-process locking
+    fcntl = None
+
+import binary_store
+import framing
+
+
+def stats_path(log_file):
+    """Return the path of the rollup file that belongs to log_file"""
+    return log_file + '.stats.json'
+
+
+def _empty(inode):
+    return {'inode': inode, 'offset': 0, 'days': {}}
+
+
+def _load(log_file, inode):
+    try:
+        with open(stats_path(log_file), 'r') as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return _empty(inode)
+    if state.get('inode') != inode:
+        return _empty(inode)
+    return state
+
+
+def _save(log_file, state):
+    # Write then rename so readers never see a half-written file
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(stats_path(log_file)) + '.',
+                                    suffix='.tmp', dir=os.path.dirname(os.path.abspath(log_file)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, stats_path(log_file))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _count(days, day, session_type, action):
+    actions = days.setdefault(day, {}).setdefault(session_type, {})
+    actions[action] = actions.get(action, 0) + 1
+
+
+def _scan_text(log_file, state):
+    with open(log_file, 'rb') as log:
+        log.seek(state['offset'])
+        for raw in log:
+            if not raw.endswith(b'\n'):
+                break  # partial record, still being appended
+            state['offset'] += len(raw)
+            parts = framing.split_fields(raw.decode('utf-8', errors='replace'))
+            if parts:
+                _count(state['days'], parts[0][:10], parts[1], parts[2])
+
+
+def _scan_binary(log_file, state):
+    start = state['offset'] // binary_store.RECORD.size
+    for timestamp, _, session_type, action in binary_store.iter_records(log_file, start):
+        day = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+        _count(state['days'], day, binary_store.SESSION_TYPES[session_type], binary_store.ACTIONS[action])
+        state['offset'] += binary_store.RECORD.size
+
+
+def merge_days(into, days):
+    """Add the counts of one per-day rollup into another"""
+    for day, session_types in days.items():
+        for session_type, actions in session_types.items():
+            counts = into.setdefault(day, {}).setdefault(session_type, {})
+            for action, count in actions.items():
+                counts[action] = counts.get(action, 0) + count
+    return into
+
+
+def refresh_rollups(log_file, binary=False):
+    """Fold records appended since the last refresh into the rollups and return the per-day counts
+
+    Refreshes from every thread and process are serialized with an
+    exclusive flock, so each appended record is scanned once.
+    """
+    fd = os.open(log_file + '.stats.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        return _refresh(log_file, binary)
+    finally:
+        os.close(fd)  # closing the descriptor releases the lock
+
+
+def _refresh(log_file, binary):
+    st = os.stat(log_file)
+    state = _load(log_file, st.st_ino)
+    if state['offset'] > st.st_size:
+        state = _empty(st.st_ino)  # log was truncated or replaced
+
+    if state['offset'] < st.st_size:
+        offset = state['offset']
+        if binary:
+            _scan_binary(log_file, state)
+        else:
+            _scan_text(log_file, state)
+        if state['offset'] != offset or not os.path.exists(stats_path(log_file)):
+            _save(log_file, state)
+
+    return state['days']
+
+
+def rebuild_rollups(log_file, binary=False):
+    """Discard the persisted rollups and recompute them from the raw log"""
+    try:
+        os.remove(stats_path(log_file))
+    except FileNotFoundError:
+        pass
+    return refresh_rollups(log_file, binary)
@@ -0,0 +1,133 @@
+"""
+Per-worker fan-out of newly stored sessions to /history/stream subscribers.
+
+Each store that has subscribers gets one ``Feed`` thread per worker. It
+watches the store's generation counter, which any process bumps when it
+appends, so noticing a write is a memory read rather than a stat or a
+read of the log. When the counter moves the feed reads the new sessions
+once, from the cursor it had reached, and puts them on every subscriber's
+queue: the cost of a write is one read per worker however many clients
+are listening.
+
+Subscriber queues are bounded. A client too slow to keep up is sent
+``None`` and dropped; it reconnects with Last-Event-ID and catches up from
+the store like any other reconnect.
+"""
+import os
+import queue
+import threading
+
+import generation
+
+# Seconds between checks of the generation counter
+POLL_INTERVAL = 0.2
+
+# Sessions queued per subscriber before it is dropped as too slow
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+class Feed:
+    """Watches one store and copies what is appended to it to each subscriber's queue"""
+
+    def __init__(self, store):
+        self.store = store
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.seen = None      # generation the feed has caught up with
+        self.cursor = None    # store cursor of the last session published
+
+    def subscribe(self):
+        """Return a new subscriber queue of (cursor, session), starting the feed thread if needed"""
+        subscription = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscription)
+            if self.thread is None:
+                # Generation first: a write landing in between is published, not missed
+                self.seen = generation.current(self.store.path)
+                self.cursor = self.store.end_cursor()
+                self.thread = threading.Thread(target=self._run, name='pomodoro-session-feed', daemon=True)
+                self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(self.subscribers)
+
+    def wake(self):
+        """Check for new sessions now instead of at the next poll"""
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(POLL_INTERVAL)
+            self.wakeup.clear()
+            with self.lock:
+                if not self.subscribers:
+                    # Stop with the last subscriber; the next one starts a fresh thread
+                    self.thread = None
+                    return
+            current = generation.current(self.store.path)
+            if current == self.seen:
+                continue
+            self.seen = current
+            try:
+                self._publish()
+            except Exception:
+                # A rotation or truncation in progress; try again at the next poll
+                self.seen = None
+
+    def _publish(self):
+        for cursor, session in self.store.stream(cursor=self.cursor):
+            self.cursor = cursor
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for subscription in subscribers:
+                try:
+                    subscription.put_nowait((cursor, session))
+                except queue.Full:
+                    self.unsubscribe(subscription)
+                    _drop(subscription)
+
+
+def _drop(subscription):
+    # Make room for the end-of-stream marker the reader is waiting for
+    try:
+        subscription.get_nowait()
+    except queue.Empty:
+        pass
+    subscription.put_nowait(None)
+
+
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+def get_feed(store):
+    """Return this worker's feed of store"""
+    with _feeds_lock:
+        feed = _feeds.get(store.path)
+        if feed is None or feed.store is not store:
+            feed = _feeds[store.path] = Feed(store)
+        return feed
+
+
+def wake(path):
+    """Tell the feed of path, if it has one in this worker, that something was just written"""
+    feed = _feeds.get(path)
+    if feed is not None:
+        feed.wake()
+
+
+def _forget_feeds():
+    # Feed threads do not survive fork; a child starts its own
+    _feeds.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_feeds)
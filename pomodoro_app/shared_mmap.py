@@ -0,0 +1,91 @@
+"""
+Small fixed-size files memory-mapped by every process.
+
+The generation counter, the metrics registry and the event id record each
+keep their state in one such file next to the log. ``get`` maps a file
+once per process and hands out the same ``SharedFile`` afterwards; a file
+of any other size than the one asked for (a new, empty file, or one laid
+out by an older version) is zeroed and resized first. ``SharedFile.locked``
+holds the file's flock, which excludes other processes, together with a
+thread lock, which excludes the other threads of this one.
+"""
+import contextlib
+import mmap
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows development machines: no cross-process locking
+    fcntl = None
+
+# path -> SharedFile, one per process
+_files = {}
+_files_lock = threading.Lock()
+
+
+class SharedFile:
+    """One memory-mapped file; ``mm`` is the map"""
+
+    def __init__(self, path, size):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != size:
+            with self._flock(fcntl and fcntl.LOCK_EX):
+                # Re-check under the lock: another process may have resized it already
+                if os.fstat(self.fd).st_size != size:
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+        # flock() does not exclude threads sharing a descriptor
+        self.thread_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _flock(self, operation):
+        if fcntl:
+            fcntl.flock(self.fd, operation)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def locked(self, shared=False):
+        """Hold the file against other threads and processes; shared only lets other processes read"""
+        with self.thread_lock, self._flock(fcntl and (fcntl.LOCK_SH if shared else fcntl.LOCK_EX)):
+            yield self.mm
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+def get(path, size):
+    """Return this process's map of path, mapping it (again, if size changed) as needed"""
+    with _files_lock:
+        shared = _files.get(path)
+        if shared is None or len(shared.mm) != size:
+            if shared is not None:
+                shared.close()
+            shared = _files[path] = SharedFile(path, size)
+        return shared
+
+
+def release(path):
+    """Unmap path in this process; the next get() maps it again"""
+    with _files_lock:
+        shared = _files.pop(path, None)
+    if shared is not None:
+        shared.close()
+
+
+def _forget_files():
+    # A forked child shares its parent's open file descriptions, and with
+    # them its flocks; it must open each file again to lock on its own
+    for shared in _files.values():
+        shared.close()
+    _files.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_files)
@@ -1,18 +1,88 @@
 // Pomodoro Timer JavaScript Implementation
 
+// Calls back once after a delay, from a Web Worker where possible: browsers
+// throttle the timers of background pages far harder than those of workers
+class Ticker {
+    constructor(callback) {
+        this.callback = callback;
+        this.timeoutId = null;
+        this.worker = null;
+        
+        try {
+            const source = 'let id = null; onmessage = event => { clearTimeout(id); ' +
+                'if (event.data >= 0) id = setTimeout(() => postMessage(0), event.data); };';
+            this.worker = new Worker(URL.createObjectURL(new Blob([source], { type: 'text/javascript' })));
+            this.worker.onmessage = () => this.callback();
+            this.worker.onerror = () => {
+                // Blocked by a content security policy: fall back to page timers
+                this.worker = null;
+                this.callback();
+            };
+        } catch (error) {
+            this.worker = null;
+        }
+    }
+    
+    schedule(delay) {
+        if (this.worker) {
+            this.worker.postMessage(delay);
+        } else {
+            clearTimeout(this.timeoutId);
+            this.timeoutId = setTimeout(this.callback, delay);
+        }
+    }
+    
+    cancel() {
+        if (this.worker) {
+            this.worker.postMessage(-1);
+        } else {
+            clearTimeout(this.timeoutId);
+            this.timeoutId = null;
+        }
+    }
+}
+
 class PomodoroTimer {
     constructor() {
         // Timer state
         this.isRunning = false;
         this.isPaused = false;
-        this.currentTime = 0; // in seconds
-        this.intervalId = null;
+        this.currentTime = 0; // in seconds, as displayed
+        this.remainingMs = 0;
+        this.deadline = 0; // performance.now() at which a running session ends
+        this.ticker = new Ticker(() => this.tick());
+        
+        // Last value written to each DOM property, so unchanged ones are not rewritten
+        this.rendered = new Map();
         
         // Session management
         this.currentSession = 1;
         this.maxSessions = 4;
         this.sessionType = 'work'; // 'work', 'short_break', 'long_break'
         
+        // Session events waiting to be sent to the server, and the few it
+        // rejected as invalid, set aside so they do not block the rest
+        this.logQueueKey = 'pomodoroLogQueue';
+        this.rejectedLogKey = 'pomodoroRejectedLogEvents';
+        this.maxRejectedLogEvents = 100;
+        
+        // One request carries at most the server's MAX_BATCH_SIZE events, and
+        // stays under the 64 KiB keepalive and sendBeacon allow per request
+        this.logBatchMaxEvents = 1000;
+        this.logBatchMaxBytes = 60 * 1024;
+        this.textEncoder = new TextEncoder();
+        
+        // Anonymous id of this browser, sent only if the server keeps each
+        // device's sessions in a log shard of its own (POMODORO_DEVICE_SHARDS)
+        this.deviceId = 'deviceShards' in document.body.dataset ? this.loadDeviceId() : null;
+        this.logFlushPromise = null;
+        
+        // Backoff after the server sheds a request or the network fails
+        this.logRetryAttempt = 0;
+        this.logRetryTimer = null;
+        this.logRetryBaseDelay = 1000;
+        this.logRetryMaxDelay = 60 * 1000;
+        
         // Duration settings (in seconds)
         this.settings = {
             workDuration: 25 * 60,
@@ -25,6 +95,9 @@ class PomodoroTimer {
         this.loadSettings();
         this.resetTimer();
         this.bindEvents();
+        
+        // Send anything left over from a previous visit
+        this.flushLogQueue();
     }
     
     initializeElements() {
@@ -34,6 +107,7 @@ class PomodoroTimer {
         this.sessionCountEl = document.getElementById('session-count');
         this.timerCircleEl = document.querySelector('.timer-circle');
         this.progressDotsEl = document.getElementById('progress-dots');
+        this.progressDots = this.progressDotsEl.querySelectorAll('.dot');
         
         // Buttons
         this.startBtn = document.getElementById('start-btn');
@@ -66,6 +140,21 @@ class PomodoroTimer {
         this.longBreakInput.value = Math.floor(this.settings.longBreakDuration / 60);
     }
     
+    loadDeviceId() {
+        let deviceId = localStorage.getItem('pomodoroDeviceId');
+        if (!deviceId) {
+            deviceId = this.randomId();
+            localStorage.setItem('pomodoroDeviceId', deviceId);
+        }
+        return deviceId;
+    }
+    
+    randomId() {
+        return window.crypto && crypto.randomUUID
+            ? crypto.randomUUID()
+            : Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
+    
     saveSettings() {
         const settings = {
             workDuration: parseInt(this.workDurationInput.value),
@@ -89,6 +178,22 @@ class PomodoroTimer {
         this.settingsBtn.addEventListener('click', () => this.showSettings());
         this.saveSettingsBtn.addEventListener('click', () => this.saveSettings());
         this.cancelSettingsBtn.addEventListener('click', () => this.hideSettings());
+        
+        // Hand queued session events to the browser before the page goes away,
+        // and confirm them with a fetch once it is back
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'hidden') {
+                this.beaconLogQueue();
+            } else {
+                this.flushLogQueue();
+            }
+            // Hidden pages sleep until the deadline; catch up as soon as the page is shown
+            if (this.isRunning) {
+                this.tick();
+            }
+        });
+        window.addEventListener('pagehide', () => this.beaconLogQueue());
+        window.addEventListener('online', () => this.flushLogQueue());
     }
     
     getCurrentDuration() {
@@ -107,49 +212,63 @@ class PomodoroTimer {
         return `${minutes.toString().padStart(2, '0')}:${secs.toString().padStart(2, '0')}`;
     }
     
+    // Set a DOM property only if it differs from the value last written to it
+    render(element, property, value) {
+        let values = this.rendered.get(element);
+        if (!values) {
+            values = {};
+            this.rendered.set(element, values);
+        }
+        if (values[property] !== value) {
+            values[property] = value;
+            element[property] = value;
+        }
+    }
+    
     updateDisplay() {
-        this.timerTimeEl.textContent = this.formatTime(this.currentTime);
+        this.render(this.timerTimeEl, 'textContent', this.formatTime(this.currentTime));
         
         // Update session info
         if (this.sessionType === 'work') {
-            this.sessionTypeEl.textContent = 'Work Session';
-            this.sessionCountEl.textContent = `Session ${this.currentSession} of ${this.maxSessions}`;
-            this.timerCircleEl.className = 'timer-circle active';
+            this.render(this.sessionTypeEl, 'textContent', 'Work Session');
+            this.render(this.sessionCountEl, 'textContent', `Session ${this.currentSession} of ${this.maxSessions}`);
+            this.render(this.timerCircleEl, 'className', 'timer-circle active');
         } else if (this.sessionType === 'short_break') {
-            this.sessionTypeEl.textContent = 'Short Break';
-            this.sessionCountEl.textContent = `After Session ${this.currentSession - 1}`;
-            this.timerCircleEl.className = 'timer-circle break';
+            this.render(this.sessionTypeEl, 'textContent', 'Short Break');
+            this.render(this.sessionCountEl, 'textContent', `After Session ${this.currentSession - 1}`);
+            this.render(this.timerCircleEl, 'className', 'timer-circle break');
         } else {
-            this.sessionTypeEl.textContent = 'Long Break';
-            this.sessionCountEl.textContent = `After ${this.maxSessions} Sessions`;
-            this.timerCircleEl.className = 'timer-circle break';
+            this.render(this.sessionTypeEl, 'textContent', 'Long Break');
+            this.render(this.sessionCountEl, 'textContent', `After ${this.maxSessions} Sessions`);
+            this.render(this.timerCircleEl, 'className', 'timer-circle break');
         }
         
         // Update status
+        let status;
         if (!this.isRunning && this.currentTime === this.getCurrentDuration()) {
-            this.timerStatusEl.textContent = 'Ready to start';
+            status = 'Ready to start';
         } else if (this.isRunning) {
-            this.timerStatusEl.textContent = 'Focus time';
+            status = 'Focus time';
         } else if (this.isPaused) {
-            this.timerStatusEl.textContent = 'Paused';
+            status = 'Paused';
         } else {
-            this.timerStatusEl.textContent = 'Ready';
+            status = 'Ready';
         }
+        this.render(this.timerStatusEl, 'textContent', status);
         
         // Update progress dots
         this.updateProgressDots();
     }
     
     updateProgressDots() {
-        const dots = this.progressDotsEl.querySelectorAll('.dot');
-        dots.forEach((dot, index) => {
+        this.progressDots.forEach((dot, index) => {
             const sessionNum = index + 1;
             if (sessionNum < this.currentSession) {
-                dot.className = 'dot completed';
+                this.render(dot, 'className', 'dot completed');
             } else if (sessionNum === this.currentSession && this.sessionType === 'work') {
-                dot.className = 'dot active';
+                this.render(dot, 'className', 'dot active');
             } else {
-                dot.className = 'dot';
+                this.render(dot, 'className', 'dot');
             }
         });
     }
@@ -167,28 +286,52 @@ class PomodoroTimer {
         this.isPaused = false;
         this.startBtn.textContent = 'Pause';
         
-        this.intervalId = setInterval(() => {
-            if (this.currentTime > 0) {
-                this.currentTime--;
-                this.updateDisplay();
-            } else {
-                this.completeSession();
-            }
-        }, 1000);
+        // Count down from a monotonic deadline rather than counting ticks,
+        // so late or throttled ticks cannot make a session run long
+        this.deadline = performance.now() + this.remainingMs;
+        this.scheduleTick();
         
         this.updateDisplay();
     }
     
+    tick() {
+        if (!this.isRunning) {
+            return; // a tick already in flight when the timer was paused
+        }
+        
+        this.remainingMs = Math.max(0, this.deadline - performance.now());
+        this.currentTime = Math.ceil(this.remainingMs / 1000);
+        if (this.remainingMs === 0) {
+            this.completeSession();
+            return;
+        }
+        
+        if (!document.hidden) {
+            this.updateDisplay();
+        }
+        this.scheduleTick();
+    }
+    
+    scheduleTick() {
+        // Wake when the displayed second changes; a hidden page has nothing
+        // to draw, so it only wakes when the session ends
+        this.ticker.schedule(document.hidden ? this.remainingMs : this.remainingMs % 1000 || 1000);
+    }
+    
+    stopTicking() {
+        this.ticker.cancel();
+        if (this.isRunning) {
+            this.remainingMs = Math.max(0, this.deadline - performance.now());
+            this.currentTime = Math.ceil(this.remainingMs / 1000);
+        }
+    }
+    
     pauseTimer() {
+        this.stopTicking();
         this.isRunning = false;
         this.isPaused = true;
         this.startBtn.textContent = 'Start';
         
-        if (this.intervalId) {
-            clearInterval(this.intervalId);
-            this.intervalId = null;
-        }
-        
         this.updateDisplay();
     }
     
@@ -196,13 +339,10 @@ class PomodoroTimer {
         this.isRunning = false;
         this.isPaused = false;
         this.startBtn.textContent = 'Start';
-        
-        if (this.intervalId) {
-            clearInterval(this.intervalId);
-            this.intervalId = null;
-        }
+        this.ticker.cancel();
         
         this.currentTime = this.getCurrentDuration();
+        this.remainingMs = this.currentTime * 1000;
         this.updateDisplay();
     }
     
@@ -255,29 +395,184 @@ class PomodoroTimer {
     }
     
     async logSession(action) {
+        // Queue the event so it survives network failures and reloads,
+        // then send everything queued so far. The event id
+        // lets the server drop copies sent again by a retry or another tab.
+        const event = {
+            session_type: this.sessionType,
+            action: action,
+            session_number: this.currentSession,
+            event_id: this.randomId(),
+            // Logged at this time even if the queue is only flushed the next day
+            occurred_at: new Date().toISOString()
+        };
+        if (this.deviceId) {
+            event.user_id = this.deviceId;
+        }
+        this.enqueueLogEvent(event);
+        await this.flushLogQueue();
+    }
+    
+    readLogQueue() {
         try {
-            const sessionData = {
-                session_type: this.sessionType,
-                action: action,
-                session_number: this.currentSession
-            };
-            
-            const response = await fetch('/log', {
+            return JSON.parse(localStorage.getItem(this.logQueueKey)) || [];
+        } catch (error) {
+            return [];
+        }
+    }
+    
+    writeLogQueue(events) {
+        if (events.length) {
+            localStorage.setItem(this.logQueueKey, JSON.stringify(events));
+        } else {
+            localStorage.removeItem(this.logQueueKey);
+        }
+    }
+    
+    enqueueLogEvent(sessionData) {
+        const events = this.readLogQueue();
+        events.push(sessionData);
+        this.writeLogQueue(events);
+    }
+    
+    // Drop the events the server has accepted. Matching by id rather than
+    // position leaves alone whatever another tab queued or sent meanwhile.
+    dequeueLogEvents(sent) {
+        const ids = new Set(sent.map(event => event.event_id));
+        this.writeLogQueue(this.readLogQueue().filter(event => !ids.has(event.event_id)));
+    }
+    
+    // Keep invalid events for inspection instead of resending them forever
+    setAsideLogEvents(events) {
+        let rejected;
+        try {
+            rejected = JSON.parse(localStorage.getItem(this.rejectedLogKey)) || [];
+        } catch (error) {
+            rejected = [];
+        }
+        rejected = rejected.concat(events).slice(-this.maxRejectedLogEvents);
+        localStorage.setItem(this.rejectedLogKey, JSON.stringify(rejected));
+        this.dequeueLogEvents(events);
+    }
+    
+    toNdjson(events) {
+        return events.map(event => JSON.stringify(event)).join('\n') + '\n';
+    }
+    
+    // Split events, oldest first, into batches within logBatchMaxEvents and logBatchMaxBytes
+    chunkLogEvents(events) {
+        const chunks = [];
+        let chunk = [];
+        let bytes = 0;
+        for (const event of events) {
+            const size = this.textEncoder.encode(JSON.stringify(event) + '\n').length;
+            if (chunk.length && (chunk.length === this.logBatchMaxEvents || bytes + size > this.logBatchMaxBytes)) {
+                chunks.push(chunk);
+                chunk = [];
+                bytes = 0;
+            }
+            chunk.push(event);
+            bytes += size;
+        }
+        if (chunk.length) {
+            chunks.push(chunk);
+        }
+        return chunks;
+    }
+    
+    flushLogQueue() {
+        // Coalesce: events queued while a request is in flight go out with the next one
+        if (this.logFlushPromise) {
+            return this.logFlushPromise.then(() => this.flushLogQueue());
+        }
+        
+        // While backing off, new events wait for the scheduled retry
+        if (this.logRetryTimer) {
+            return Promise.resolve();
+        }
+        
+        const events = this.readLogQueue();
+        if (!events.length) {
+            return Promise.resolve();
+        }
+        
+        this.logFlushPromise = this.sendLogChunks(this.chunkLogEvents(events)).catch(error => {
+            console.error('Error logging sessions, will retry later:', error);
+            this.scheduleLogRetry(null);
+        }).finally(() => {
+            this.logFlushPromise = null;
+        });
+        
+        return this.logFlushPromise;
+    }
+    
+    // Send batches in order until the queue is empty or the server asks to wait.
+    // The server refuses a whole batch with 400 if one event in it is invalid,
+    // so a refused batch is halved until the invalid events are found and set aside.
+    async sendLogChunks(chunks) {
+        while (chunks.length) {
+            const chunk = chunks.shift();
+            const response = await fetch('/log/batch', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json',
+                    'Content-Type': 'application/x-ndjson',
                 },
-                body: JSON.stringify(sessionData)
+                body: this.toNdjson(chunk),
+                keepalive: true
             });
             
-            if (!response.ok) {
-                console.error('Failed to log session:', response.statusText);
+            if (response.ok) {
+                this.logRetryAttempt = 0;
+                this.dequeueLogEvents(chunk);
+            } else if (response.status === 429 || response.status === 503) {
+                this.scheduleLogRetry(response.headers.get('Retry-After'));
+                return;
+            } else if (response.status === 400 && chunk.length > 1) {
+                const half = Math.ceil(chunk.length / 2);
+                chunks.unshift(chunk.slice(0, half), chunk.slice(half));
+            } else if (response.status === 400) {
+                console.error('Server rejected a session event, setting it aside:', chunk[0]);
+                this.setAsideLogEvents(chunk);
+            } else {
+                console.error('Failed to log sessions:', response.statusText);
+                return;
             }
-        } catch (error) {
-            console.error('Error logging session:', error);
         }
     }
     
+    // Exponential backoff with jitter, never sooner than the server's Retry-After,
+    // so clients shed together do not all come back at the same moment
+    scheduleLogRetry(retryAfter) {
+        if (this.logRetryTimer) {
+            return;
+        }
+        
+        const ceiling = Math.min(this.logRetryMaxDelay, this.logRetryBaseDelay * 2 ** this.logRetryAttempt);
+        const seconds = parseInt(retryAfter, 10);
+        const floor = Number.isNaN(seconds) ? 0 : seconds * 1000;
+        const delay = Math.max(floor, ceiling * (0.5 + Math.random() / 2));
+        this.logRetryAttempt++;
+        
+        this.logRetryTimer = setTimeout(() => {
+            this.logRetryTimer = null;
+            this.flushLogQueue();
+        }, delay);
+    }
+    
+    // A beacon's response is never seen, so a batch the server sheds or
+    // rejects would be lost: the events stay queued until a fetch confirms
+    // them, and the server drops the copies it already stored by event id
+    beaconLogQueue() {
+        const events = this.readLogQueue();
+        if (!events.length || this.logFlushPromise || !navigator.sendBeacon) {
+            return;
+        }
+        
+        // The browser refuses a beacon over its size quota: send the oldest batch
+        const chunk = this.chunkLogEvents(events)[0];
+        navigator.sendBeacon('/log/batch', new Blob([this.toNdjson(chunk)], { type: 'application/x-ndjson' }));
+    }
+    
     showNotification(message) {
         // Browser notification
         if ('Notification' in window && Notification.permission === 'granted') {
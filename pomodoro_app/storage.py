@@ -0,0 +1,644 @@
+"""
+Session storage backends behind the /log, /history and /stats routes.
+
+Every backend implements the same interface:
+
+    append(session), append_many(sessions)      persist new sessions
+    query(since, until, filters, cursor, limit)  one page of history: (sessions, next_cursor)
+    tail(last, since, until, filters)            the newest matching sessions, oldest first
+    stream(since, until, filters, cursor)        (cursor, session) for every matching session
+    end_cursor()                                 the cursor after the newest stored session
+    aggregate()                                  per-day counts: days[date][session_type][action]
+
+Sessions handed to append carry a datetime timestamp; sessions coming back
+use the ``YYYY-MM-DD HH:MM:SS`` string of the text log. since and until
+are naive datetimes (since inclusive, until exclusive), filters maps
+``session_type``/``action`` to the value they must equal, and a cursor is
+an opaque non-negative integer: pass back ``next_cursor``, or the cursor
+streamed with a session, to continue right after it.
+
+``TextStorage`` is the human readable log with its index, rollups and
+archive, ``BinaryStorage`` the fixed-width record file and
+``SQLiteStorage`` an SQLite database in WAL mode.
+"""
+import collections
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+import binary_store
+import framing
+import generation
+import history_cache
+import log_archive
+import log_index
+import log_writer
+import metrics
+import rollups
+
+logger = logging.getLogger(__name__)
+
+# Format of the timestamp column in the text log
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Fields a history query can filter on by equality
+FILTER_FIELDS = ('session_type', 'action')
+
+
+class _ParseCounter(threading.local):
+    """Records decoded by the current thread, read around requests for metrics"""
+    records = 0
+
+parse_counter = _ParseCounter()
+
+
+def format_log_entry(session):
+    """Format a session record as a text log line"""
+    timestamp = session['timestamp'].strftime(TIMESTAMP_FORMAT)
+
+    # Log entry format: timestamp | session_type | action | session_number
+    line = f"{timestamp} | {session['session_type']} | {session['action']} | session_{session['session_number']}\n"
+    return framing.frame(line) if framing.ENABLED else line
+
+
+def parse_log_line(line):
+    """Parse a single log line into a session dict, or None if malformed or failing its checksum"""
+    parse_counter.records += 1
+    parts = framing.split_fields(line)
+    if parts is None:
+        return None
+    return {
+        'timestamp': parts[0],
+        'session_type': parts[1],
+        'action': parts[2],
+        'session_number': parts[3]
+    }
+
+
+def time_text(bound):
+    """Return a since/until datetime as a log timestamp string, or None"""
+    return bound.strftime(TIMESTAMP_FORMAT) if bound else None
+
+
+def matcher(since=None, until=None, filters=None):
+    """Return a predicate applying a time range and field filters to a session"""
+    since_text, until_text = time_text(since), time_text(until)
+    wanted = [(field, value) for field, value in (filters or {}).items() if value is not None]
+
+    def matches(session):
+        return (all(session[field] == value for field, value in wanted)
+                and (since_text is None or session['timestamp'] >= since_text)
+                and (until_text is None or session['timestamp'] < until_text))
+
+    return matches
+
+
+def collect_page(numbered_sessions, stop, limit, matches):
+    """Collect up to limit matching sessions from (position, session) pairs
+
+    Returns (sessions, next_cursor). next_cursor points just past the last
+    session taken, and is None once nothing can follow before stop.
+    """
+    sessions = []
+    next_cursor = None
+    for number, session in numbered_sessions:
+        if session and matches(session):
+            sessions.append(session)
+            if len(sessions) == limit:
+                next_cursor = number + 1
+                break
+    return sessions, (next_cursor if next_cursor is not None and next_cursor < stop else None)
+
+
+def shard_path(shard_dir, user_id, extension):
+    """Return the file holding user_id's sessions inside shard_dir
+
+    The id is hashed, so any string maps to a safe file name, and the first
+    two byte pairs of the digest fan the shards out over 65536 directories.
+    """
+    digest = hashlib.sha256(user_id.encode('utf-8')).hexdigest()
+    return os.path.join(shard_dir, digest[:2], digest[2:4], digest + extension)
+
+
+class Storage:
+    """Interface shared by the storage backends"""
+
+    # File the backend's data lives in; generation counter and metrics hang off it
+    path = None
+
+    @property
+    def validator_path(self):
+        """File whose inode, size and mtime change whenever the data does (for ETags)"""
+        return self.path
+
+    @property
+    def validator_paths(self):
+        """Every file whose inode, size or mtime changes when the data does"""
+        return (self.validator_path,)
+
+    def append(self, session):
+        """Persist a single session"""
+        self.append_many([session])
+
+    def append_many(self, sessions, writer=None):
+        """Persist sessions with one write, or queue them on a log_writer.BackgroundWriter"""
+        entries = self.encode(sessions)
+        if writer is not None:
+            writer.submit(self.path, entries, self.write)
+        else:
+            self.write(self.path, entries)
+
+    def encode(self, sessions):
+        """Turn sessions into the entries write() appends"""
+        raise NotImplementedError
+
+    def write(self, path, entries):
+        """Append encoded entries to path"""
+        raise NotImplementedError
+
+    def query(self, since=None, until=None, filters=None, cursor=0, limit=None):
+        """Return (sessions, next_cursor) for up to limit matching sessions after cursor"""
+        raise NotImplementedError
+
+    def tail(self, last, since=None, until=None, filters=None):
+        """Return the newest last matching sessions, oldest first"""
+        raise NotImplementedError
+
+    def stream(self, since=None, until=None, filters=None, cursor=0):
+        """Return an iterator of (cursor, session) over every matching session after cursor"""
+        raise NotImplementedError
+
+    def end_cursor(self):
+        """Return the cursor that stream() continues from to see only sessions stored later"""
+        raise NotImplementedError
+
+    def aggregate(self):
+        """Return per-day counts of every stored session"""
+        raise NotImplementedError
+
+    def rebuild_aggregates(self):
+        """Recompute the per-day counts from the stored sessions"""
+        raise NotImplementedError
+
+    def warm_up(self):
+        """Load whatever the first request would otherwise have to"""
+
+    def recover(self):
+        """Remove a record torn by a crash from the end of the data; return the bytes removed"""
+        return 0
+
+    def close(self):
+        """Release what this process holds open for the backend; later use reopens it"""
+        generation.release(self.path)
+
+
+class TextStorage(Storage):
+    """The text log, with its byte-offset index, rollups, archive and history cache"""
+
+    def __init__(self, log_file, cache_records=100000, rotate_max_bytes=0, rotate_daily=False, retention_days=0):
+        self.path = log_file
+        self.cache_records = cache_records
+        self.rotate_max_bytes = rotate_max_bytes
+        self.rotate_daily = rotate_daily
+        self.retention_days = retention_days
+
+    @property
+    def validator_paths(self):
+        # Rotation, retention and compaction rewrite the archive manifest
+        return (self.path, log_archive.manifest_path(self.path))
+
+    def append_many(self, sessions, writer=None):
+        super().append_many(sessions, writer)
+        if self.rotate_max_bytes or self.rotate_daily:
+            try:
+                log_archive.maybe_rotate(self.path, self.rotate_max_bytes, self.rotate_daily, self.retention_days)
+            except OSError as e:
+                logger.warning('Could not rotate session log: %s', e)
+
+    def encode(self, sessions):
+        return [format_log_entry(session) for session in sessions]
+
+    def write(self, path, lines):
+        log_writer.append_lines(path, lines)
+
+    def refresh_cache(self):
+        """Return this worker's history cache, brought up to date, and its line count"""
+        cache = history_cache.get_cache(self.path, parse_log_line, self.cache_records)
+        parsed = parse_counter.records
+        line_count = cache.refresh()
+        hit = parse_counter.records == parsed
+        metrics.inc(self.path, 'pomodoro_cache_hits_total' if hit else 'pomodoro_cache_misses_total',
+                    label_value='history')
+        return cache, line_count
+
+    def query(self, since=None, until=None, filters=None, cursor=0, limit=None):
+        """Return one page of history; line numbers are global across the archive and the active log
+
+        since and until are resolved to a line range by binary search over
+        the index, and archived segments outside it are never opened. Lines
+        of the active log come from the worker's parsed history cache.
+        """
+        since_text, until_text = time_text(since), time_text(until)
+        with log_archive.log_lock(self.path):
+            manifest = log_archive.load_manifest(self.path)
+            parts = [((line_number, parse_log_line(line))
+                      for line_number, line in log_archive.iter_segment_lines(self.path, segment, cursor))
+                     for segment in manifest['segments']
+                     if segment['first_line'] + segment['lines'] > cursor
+                     and log_archive.overlaps(segment, since_text, until_text)]
+
+            base = stop = manifest['next_line']
+            if os.path.exists(self.path):
+                cache, line_count = self.refresh_cache()
+                start, stop = 0, line_count
+                if since_text or until_text:
+                    line_count = log_index.refresh_index(self.path)
+                    start, stop = log_index.line_range(self.path, line_count, since_text, until_text)
+                parts.append((base + line_number, session)
+                             for line_number, session in cache.iter_sessions(max(start, cursor - base), stop))
+                stop += base
+
+            return collect_page(itertools.chain.from_iterable(parts), stop, limit,
+                                matcher(since, until, filters))
+
+    def tail(self, last, since=None, until=None, filters=None):
+        """Read the active log backwards from its end until last sessions are found
+
+        Archived segments are only opened if the active log holds fewer than
+        last matching sessions.
+        """
+        since_text, until_text = time_text(since), time_text(until)
+        matches = matcher(since, until, filters)
+        sessions = []
+        with log_archive.log_lock(self.path):
+            if os.path.exists(self.path):
+                for line in log_index.iter_lines_reversed(self.path):
+                    session = parse_log_line(line)
+                    if session is None:
+                        continue
+                    if since_text and session['timestamp'] < since_text:
+                        break
+                    if matches(session):
+                        sessions.append(session)
+                        if len(sessions) == last:
+                            break
+
+            # gzip segments cannot be read backwards: keep a window of the newest matches
+            for segment in reversed(log_archive.load_manifest(self.path)['segments']):
+                if len(sessions) == last:
+                    break
+                if log_archive.overlaps(segment, since_text, until_text):
+                    window = collections.deque(maxlen=last - len(sessions))
+                    for _, line in log_archive.iter_segment_lines(self.path, segment):
+                        session = parse_log_line(line)
+                        if session and matches(session):
+                            window.append(session)
+                    sessions.extend(reversed(window))
+
+        return sessions[::-1]
+
+    def stream(self, since=None, until=None, filters=None, cursor=0):
+        """Return an iterator streaming history from cursor
+
+        The manifest is read and the active log opened while the log lock
+        is held; everything is read after it is released, so a slow
+        download never holds up rotation. Archived segments are opened one
+        at a time as the stream reaches them, however many are in range.
+        """
+        since_text, until_text = time_text(since), time_text(until)
+        with log_archive.log_lock(self.path):
+            manifest = log_archive.load_manifest(self.path)
+            segments = [segment for segment in manifest['segments']
+                        if segment['first_line'] + segment['lines'] > cursor
+                        and log_archive.overlaps(segment, since_text, until_text)]
+            parts = [log_archive.stream_segment_lines(self.path, segments, cursor)]
+
+            if os.path.exists(self.path):
+                base = manifest['next_line']
+                line_count = log_index.refresh_index(self.path)
+                start, stop = log_index.line_range(self.path, line_count, since_text, until_text)
+                parts.append((base + line_number, line)
+                             for line_number, line in log_index.open_lines(self.path, max(start, cursor - base), stop))
+
+        matches = matcher(since, until, filters)
+        numbered = ((line_number, parse_log_line(line)) for line_number, line in itertools.chain.from_iterable(parts))
+        return ((line_number + 1, session) for line_number, session in numbered if session and matches(session))
+
+    def end_cursor(self):
+        with log_archive.log_lock(self.path):
+            base = log_archive.load_manifest(self.path)['next_line']
+            return base + (log_index.refresh_index(self.path) if os.path.exists(self.path) else 0)
+
+    def aggregate(self):
+        """Merge the rollups archived segments carry in the manifest with those of the active log"""
+        days = {}
+        with log_archive.log_lock(self.path):
+            for segment in log_archive.load_manifest(self.path)['segments']:
+                rollups.merge_days(days, segment['days'])
+            if os.path.exists(self.path):
+                rollups.merge_days(days, rollups.refresh_rollups(self.path))
+        return days
+
+    def rebuild_aggregates(self):
+        days = rollups.rebuild_rollups(self.path)
+        generation.bump(self.path)
+        return days
+
+    def warm_up(self):
+        with log_archive.log_lock(self.path):
+            if os.path.exists(self.path):
+                log_index.refresh_index(self.path)
+                rollups.refresh_rollups(self.path)
+                history_cache.get_cache(self.path, parse_log_line, self.cache_records).refresh()
+
+    def recover(self):
+        return log_writer.recover_tail(self.path)
+
+    def close(self):
+        super().close()
+        history_cache.discard(self.path)
+
+
+def decode_binary(fields):
+    """Decode one binary record, counting it for the metrics"""
+    parse_counter.records += 1
+    return binary_store.decode_record(fields)
+
+
+class BinaryStorage(Storage):
+    """Fixed-width records read through a memory map; cursors are record numbers"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def encode(self, sessions):
+        return [binary_store.encode_record(session) for session in sessions]
+
+    def write(self, path, records):
+        log_writer.append_binary(path, records)
+
+    def recover(self):
+        return log_writer.recover_binary_tail(self.path)
+
+    def _numbered(self, since, until, cursor):
+        # Time bounds are found by binary search over the records
+        start = binary_store.find_record(self.path, since.timestamp()) if since else 0
+        stop = (binary_store.find_record(self.path, until.timestamp()) if until
+                else binary_store.record_count(self.path))
+        start = max(start, cursor)
+        numbered = enumerate(
+            (decode_binary(fields) for fields in binary_store.iter_records(self.path, start, stop)),
+            start
+        )
+        return numbered, stop
+
+    def query(self, since=None, until=None, filters=None, cursor=0, limit=None):
+        numbered, stop = self._numbered(since, until, cursor)
+        return collect_page(numbered, stop, limit, matcher(since, until, filters))
+
+    def tail(self, last, since=None, until=None, filters=None):
+        since_text = time_text(since)
+        matches = matcher(since, until, filters)
+        sessions = []
+        stop = binary_store.record_count(self.path)
+        while stop > 0 and len(sessions) < last:
+            start = max(stop - last, 0)
+            block = [decode_binary(fields) for fields in binary_store.iter_records(self.path, start, stop)]
+            sessions.extend(session for session in reversed(block) if matches(session))
+            if since_text and block and block[0]['timestamp'] < since_text:
+                break
+            stop = start
+        return sessions[:last][::-1]
+
+    def stream(self, since=None, until=None, filters=None, cursor=0):
+        numbered, _ = self._numbered(since, until, cursor)
+        matches = matcher(since, until, filters)
+        return ((number + 1, session) for number, session in numbered if matches(session))
+
+    def end_cursor(self):
+        return binary_store.record_count(self.path)
+
+    def aggregate(self):
+        if not os.path.exists(self.path):
+            return {}
+        return rollups.refresh_rollups(self.path, binary=True)
+
+    def rebuild_aggregates(self):
+        days = rollups.rebuild_rollups(self.path, binary=True)
+        generation.bump(self.path)
+        return days
+
+    def warm_up(self):
+        if os.path.exists(self.path):
+            rollups.refresh_rollups(self.path, binary=True)
+
+
+# SQLite schema. daily_counts is kept current by a trigger, so aggregate()
+# reads one row per day and type instead of scanning every session.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    session_type TEXT NOT NULL,
+    action TEXT NOT NULL,
+    session_number TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_timestamp ON sessions (timestamp);
+CREATE INDEX IF NOT EXISTS sessions_type_timestamp ON sessions (session_type, timestamp);
+CREATE TABLE IF NOT EXISTS daily_counts (
+    day TEXT NOT NULL,
+    session_type TEXT NOT NULL,
+    action TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, session_type, action)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS sessions_count AFTER INSERT ON sessions BEGIN
+    INSERT INTO daily_counts (day, session_type, action, count)
+    VALUES (substr(NEW.timestamp, 1, 10), NEW.session_type, NEW.action, 1)
+    ON CONFLICT (day, session_type, action) DO UPDATE SET count = count + 1;
+END;
+"""
+
+_SQLITE_COLUMNS = 'id, timestamp, session_type, action, session_number'
+
+_SQLITE_INSERT = 'INSERT INTO sessions (timestamp, session_type, action, session_number) VALUES (?, ?, ?, ?)'
+
+# Statements each connection keeps compiled; every query shape fits
+SQLITE_STATEMENT_CACHE = 64
+
+# Seconds a writer waits for another process's write transaction
+SQLITE_BUSY_TIMEOUT = 10
+
+# Rows fetched per statement while streaming
+SQLITE_STREAM_CHUNK = 1000
+
+# One connection per database and thread: sqlite3 connections must not be
+# used by two threads at once, and WAL lets them all read while one writes
+_sqlite_local = threading.local()
+
+# db_path -> every thread's open connection to it, so they can be closed
+# together; a thread's connections go away with the thread
+_sqlite_open = collections.defaultdict(weakref.WeakSet)
+_sqlite_open_lock = threading.Lock()
+
+
+class _SQLiteConnection(sqlite3.Connection):
+    """sqlite3.Connection that can be weakly referenced"""
+
+
+def sqlite_connection(db_path):
+    """Return this thread's connection to db_path, opening and initializing it on first use"""
+    connections = _sqlite_local.__dict__.setdefault('connections', {})
+    connection = connections.get(db_path)
+    if connection is None or connection not in _sqlite_open.get(db_path, ()):
+        # Only ever used by this thread, but closed by whichever thread calls close_sqlite_connections
+        connection = sqlite3.connect(db_path, timeout=SQLITE_BUSY_TIMEOUT, factory=_SQLiteConnection,
+                                     cached_statements=SQLITE_STATEMENT_CACHE, isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # NORMAL syncs the WAL at checkpoints only; FULL syncs it on every commit
+        connection.execute('PRAGMA synchronous=FULL' if log_writer.DURABILITY == 'always' else 'PRAGMA synchronous=NORMAL')
+        connection.executescript(SQLITE_SCHEMA)
+        connections[db_path] = connection
+        with _sqlite_open_lock:
+            _sqlite_open[db_path].add(connection)
+    return connection
+
+
+def close_sqlite_connections(db_path):
+    """Close every thread's connection to db_path; each reopens on its next use"""
+    with _sqlite_open_lock:
+        connections = list(_sqlite_open.pop(db_path, ()))
+    for connection in connections:
+        connection.close()
+
+
+def _forget_sqlite_connections():
+    # Connections must never cross a fork; the child opens its own
+    _sqlite_local.__dict__.pop('connections', None)
+    _sqlite_open.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_sqlite_connections)
+
+
+def _sqlite_session(row):
+    parse_counter.records += 1
+    return {'timestamp': row[1], 'session_type': row[2], 'action': row[3], 'session_number': row[4]}
+
+
+class SQLiteStorage(Storage):
+    """Sessions in an SQLite database in WAL mode; cursors are row ids
+
+    Every statement is a constant string with ``?`` parameters, so each
+    per-thread connection compiles it once and reuses the prepared form.
+    """
+
+    def __init__(self, db_path):
+        self.path = db_path
+
+    @property
+    def validator_path(self):
+        # In WAL mode commits go to the -wal file; the database file itself
+        # only changes when a checkpoint copies them over
+        wal_path = self.path + '-wal'
+        return wal_path if os.path.exists(wal_path) else self.path
+
+    def encode(self, sessions):
+        return [(session['timestamp'].strftime(TIMESTAMP_FORMAT), session['session_type'],
+                 session['action'], f"session_{session['session_number']}")
+                for session in sessions]
+
+    def write(self, path, rows):
+        started = time.perf_counter()
+        connection = sqlite_connection(path)
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany(_SQLITE_INSERT, rows)
+        elapsed = time.perf_counter() - started
+        generation.bump(path)
+        log_writer.record_append(path, elapsed, sum(len(''.join(row)) for row in rows))
+
+    def _where(self, since, until, filters, cursor):
+        clauses, params = ['id > ?'], [cursor]
+        if since:
+            clauses.append('timestamp >= ?')
+            params.append(time_text(since))
+        if until:
+            clauses.append('timestamp < ?')
+            params.append(time_text(until))
+        for field in FILTER_FIELDS:
+            if (filters or {}).get(field) is not None:
+                clauses.append(f'{field} = ?')
+                params.append(filters[field])
+        return ' AND '.join(clauses), params
+
+    def query(self, since=None, until=None, filters=None, cursor=0, limit=None):
+        where, params = self._where(since, until, filters, cursor)
+        sql = f'SELECT {_SQLITE_COLUMNS} FROM sessions WHERE {where} ORDER BY id'
+        if limit is not None:
+            # One extra row tells whether another page follows
+            sql += ' LIMIT ?'
+            params.append(limit + 1)
+        rows = sqlite_connection(self.path).execute(sql, params).fetchall()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][0]
+        return [_sqlite_session(row) for row in rows], next_cursor
+
+    def tail(self, last, since=None, until=None, filters=None):
+        where, params = self._where(since, until, filters, 0)
+        rows = sqlite_connection(self.path).execute(
+            f'SELECT {_SQLITE_COLUMNS} FROM sessions WHERE {where} ORDER BY id DESC LIMIT ?', params + [last]
+        ).fetchall()
+        return [_sqlite_session(row) for row in reversed(rows)]
+
+    def stream(self, since=None, until=None, filters=None, cursor=0):
+        # Keyset pagination: no statement stays open between chunks
+        while True:
+            where, params = self._where(since, until, filters, cursor)
+            rows = sqlite_connection(self.path).execute(
+                f'SELECT {_SQLITE_COLUMNS} FROM sessions WHERE {where} ORDER BY id LIMIT ?',
+                params + [SQLITE_STREAM_CHUNK]
+            ).fetchall()
+            for row in rows:
+                yield row[0], _sqlite_session(row)
+            if len(rows) < SQLITE_STREAM_CHUNK:
+                return
+            cursor = rows[-1][0]
+
+    def end_cursor(self):
+        return sqlite_connection(self.path).execute('SELECT COALESCE(MAX(id), 0) FROM sessions').fetchone()[0]
+
+    def aggregate(self):
+        days = {}
+        for day, session_type, action, count in sqlite_connection(self.path).execute(
+                'SELECT day, session_type, action, count FROM daily_counts ORDER BY day'):
+            days.setdefault(day, {}).setdefault(session_type, {})[action] = count
+        return days
+
+    def rebuild_aggregates(self):
+        connection = sqlite_connection(self.path)
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM daily_counts')
+            connection.execute(
+                'INSERT INTO daily_counts (day, session_type, action, count) '
+                'SELECT substr(timestamp, 1, 10), session_type, action, COUNT(*) FROM sessions GROUP BY 1, 2, 3'
+            )
+        generation.bump(self.path)
+        return self.aggregate()
+
+    def warm_up(self):
+        sqlite_connection(self.path)
+
+    def close(self):
+        super().close()
+        close_sqlite_connections(self.path)
@@ -6,9 +6,40 @@ import pytest
 import json
 import os
 import tempfile
+import time
+import glob
+import gzip
+import shutil
+from datetime import datetime, timedelta
+import admission
+import analytics
+import assets
+import benchmark
+import binary_store
+import event_dedup
+import framing
+import generation
+import history_cache
+import log_archive
+import log_index
+import log_writer
+import metrics
+import rollups
+import shared_mmap
+import storage
 from app import app, LOG_FILE
 
 
+@pytest.fixture(autouse=True)
+def isolated_files(monkeypatch, tmp_path):
+    """Point every file the app writes at a temporary directory, away from the repository"""
+    monkeypatch.setattr('app.LOG_FILE', str(tmp_path / 'pomodoro_log.txt'))
+    monkeypatch.setattr('app.BINARY_LOG_FILE', str(tmp_path / 'pomodoro_log.bin'))
+    monkeypatch.setattr('app.SQLITE_FILE', str(tmp_path / 'pomodoro_log.db'))
+    monkeypatch.setattr('app.SHARD_DIR', str(tmp_path / 'pomodoro_shards'))
+    monkeypatch.setattr('app.ASSET_DIR', str(tmp_path / 'dist'))
+
+
 @pytest.fixture
 def client():
     """Create a test client for the Flask app"""
@@ -41,9 +72,12 @@ def temp_log_file():
     
     yield temp_file_path
     
-    # Cleanup
-    if os.path.exists(temp_file_path):
-        os.remove(temp_file_path)
+    # Cleanup, including index, rollup and archive files derived from the log
+    for path in glob.glob(temp_file_path + '*'):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
 
 class TestIndexRoute:
@@ -58,6 +92,24 @@ class TestIndexRoute:
         """Test that index route returns HTML content"""
         response = client.get('/')
         assert b'<!DOCTYPE html>' in response.data or b'<html' in response.data
+    
+    def test_index_opens_no_storage(self, client, monkeypatch):
+        """Test that timing the request records metrics without opening or recovering the log"""
+        def get_storage(user_id=None):
+            raise AssertionError('storage opened')
+        monkeypatch.setattr('app.get_storage', get_storage)
+        
+        assert client.get('/').status_code == 200
+    
+    def test_device_shards_are_opt_in(self, client, monkeypatch):
+        """Test that the page asks the browser for per-device shards only when enabled"""
+        off = client.get('/')
+        assert b'data-device-shards' not in off.data
+        
+        monkeypatch.setattr('app.DEVICE_SHARDS', True)
+        on = client.get('/', headers={'If-None-Match': off.headers['ETag']})
+        assert on.status_code == 200
+        assert b'data-device-shards' in on.data
 
 
 class TestLogSessionRoute:
@@ -228,6 +280,101 @@ class TestLogSessionRoute:
         assert response.status_code in [200, 400, 500]
 
 
+class TestLogBatchRoute:
+    """Tests for the /log/batch route"""
+    
+    def test_batch_json_array(self, client, monkeypatch, temp_log_file):
+        """Test logging a JSON array of sessions"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        sessions = [
+            {'session_type': 'work', 'action': 'completed', 'session_number': 1},
+            {'session_type': 'short_break', 'action': 'completed', 'session_number': 1},
+            {'session_type': 'work', 'action': 'skipped', 'session_number': 2},
+        ]
+        response = client.post('/log/batch',
+                              data=json.dumps(sessions),
+                              content_type='application/json')
+        
+        assert response.status_code == 200
+        assert response.get_json()['count'] == 3
+        with open(temp_log_file, 'r') as f:
+            lines = f.readlines()
+            assert len(lines) == 3
+            assert 'short_break' in lines[1]
+            assert 'skipped' in lines[2]
+    
+    def test_batch_ndjson(self, client, monkeypatch, temp_log_file):
+        """Test logging sessions sent as NDJSON"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        body = '{"session_type": "work", "session_number": 1}\n\n{"session_type": "long_break", "session_number": 4}\n'
+        response = client.post('/log/batch', data=body, content_type='application/x-ndjson')
+        
+        assert response.status_code == 200
+        history = client.get('/history').get_json()['sessions']
+        assert [s['session_type'] for s in history] == ['work', 'long_break']
+    
+    def test_batch_uses_single_write(self, client, monkeypatch, temp_log_file):
+        """Test that a batch is appended with one write call"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        calls = []
+        original = log_writer.append_lines
+        monkeypatch.setattr('log_writer.append_lines',
+                            lambda path, lines: calls.append(len(lines)) or original(path, lines))
+        
+        client.post('/log/batch', data=json.dumps([{}] * 10), content_type='application/json')
+        assert calls == [10]
+    
+    def test_batch_rejects_invalid_payloads(self, client, monkeypatch, temp_log_file):
+        """Test that malformed batches are rejected and nothing is written"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        assert client.post('/log/batch', data=json.dumps({'session_type': 'work'}),
+                           content_type='application/json').status_code == 400
+        assert client.post('/log/batch', data=json.dumps([1, 2]),
+                           content_type='application/json').status_code == 400
+        assert client.post('/log/batch', data='{"a": 1}\nnot json\n',
+                           content_type='application/x-ndjson').status_code == 400
+        assert os.path.getsize(temp_log_file) == 0
+    
+    def test_batch_keeps_occurred_at_within_order(self, client, monkeypatch, temp_log_file):
+        """Test that queued events keep their own time, clamped between the newest logged session and now"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        with open(temp_log_file, 'w') as f:
+            f.write("2024-01-02 08:00:00 | work | completed | session_1\n")
+        
+        events = [
+            {'session_number': 2, 'occurred_at': '2024-01-01T23:50:00'},  # before the newest session
+            {'session_number': 3, 'occurred_at': '2024-01-02T09:15:00'},
+            {'session_number': 4, 'occurred_at': '2024-01-02T09:10:00'},  # out of order
+            {'session_number': 5, 'occurred_at': '2999-01-01T00:00:00Z'},  # clock ahead
+            {'session_number': 6},
+        ]
+        before = datetime.now().replace(microsecond=0)
+        assert client.post('/log/batch', data=json.dumps(events), content_type='application/json').status_code == 200
+        
+        times = [s['timestamp'] for s in client.get('/history').get_json()['sessions']]
+        assert times[:4] == ['2024-01-02 08:00:00', '2024-01-02 08:00:00', '2024-01-02 09:15:00', '2024-01-02 09:15:00']
+        assert all(before <= datetime.strptime(t, storage.TIMESTAMP_FORMAT) <= datetime.now() for t in times[4:])
+        assert client.post('/log', data=json.dumps({'occurred_at': 'yesterday'}),
+                           content_type='application/json').status_code == 400
+    
+    def test_batch_limits_are_checked_before_parsing(self, client, monkeypatch, temp_log_file):
+        """Test that an oversized batch is refused by its line count or body size before it is parsed"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.MAX_BATCH_SIZE', 2)
+        
+        response = client.post('/log/batch', data='{}\n{}\nnot json\n', content_type='application/x-ndjson')
+        assert response.status_code == 400
+        assert 'At most 2' in response.get_json()['message']
+        
+        monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 16)
+        response = client.post('/log/batch', data=json.dumps([{'session_number': 1}] * 2), content_type='application/json')
+        assert response.status_code == 413
+        assert os.path.getsize(temp_log_file) == 0
+
+
 class TestHistoryRoute:
     """Tests for the /history route"""
     
@@ -334,56 +481,2022 @@ class TestHistoryRoute:
         assert 'timestamp' in session
 
 
-class TestLogFileIntegrity:
-    """Tests for log file integrity and format"""
+class TestHistoryPagination:
+    """Tests for cursor pagination of the /history route"""
     
-    def test_log_file_format(self, client, monkeypatch, temp_log_file):
-        """Test that log entries follow the correct format"""
+    def write_sessions(self, path, count):
+        with open(path, 'w') as f:
+            for i in range(count):
+                f.write(f"2024-01-01 10:00:00 | work | completed | session_{i}\n")
+    
+    def test_pages_cover_whole_log(self, client, monkeypatch, temp_log_file):
+        """Test that following next_cursor returns every session exactly once"""
         monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 150)
         
-        data = {
-            'session_type': 'work',
-            'action': 'completed',
-            'session_number': 1
-        }
+        seen = []
+        cursor = 0
+        while cursor is not None:
+            response = client.get(f'/history?limit=40&cursor={cursor}')
+            assert response.status_code == 200
+            json_data = response.get_json()
+            seen.extend(s['session_number'] for s in json_data['sessions'])
+            cursor = json_data['next_cursor']
         
-        client.post('/log',
-                   data=json.dumps(data),
-                   content_type='application/json')
+        assert seen == [f'session_{i}' for i in range(150)]
+    
+    def test_page_seeks_past_index_stride(self, client, monkeypatch, temp_log_file):
+        """Test that a cursor beyond the first index entry lands on the right line"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 200)
         
-        # Read and verify format
-        with open(temp_log_file, 'r') as f:
-            line = f.readline().strip()
-            parts = line.split(' | ')
-            
-            assert len(parts) == 4
-            # Verify timestamp format (basic check)
-            assert len(parts[0]) > 0
-            assert parts[1] == 'work'
-            assert parts[2] == 'completed'
-            assert parts[3] == 'session_1'
+        cursor = log_index.INDEX_STRIDE * 2 + 5
+        response = client.get(f'/history?limit=3&cursor={cursor}')
+        json_data = response.get_json()
+        
+        assert [s['session_number'] for s in json_data['sessions']] == [
+            f'session_{cursor}', f'session_{cursor + 1}', f'session_{cursor + 2}'
+        ]
+        assert json_data['next_cursor'] == cursor + 3
     
-    def test_log_file_append_mode(self, client, monkeypatch, temp_log_file):
-        """Test that log entries are appended, not overwritten"""
+    def test_index_updated_by_log_route(self, client, monkeypatch, temp_log_file):
+        """Test that appends through /log are picked up by the next page"""
         monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 2)
+        client.get('/history?limit=10')
         
-        # Log first session
         client.post('/log',
-                   data=json.dumps({'session_type': 'work', 'action': 'completed', 'session_number': 1}),
+                   data=json.dumps({'session_type': 'long_break', 'session_number': 4}),
                    content_type='application/json')
         
-        # Log second session
-        client.post('/log',
-                   data=json.dumps({'session_type': 'work', 'action': 'completed', 'session_number': 2}),
-                   content_type='application/json')
+        assert log_index.refresh_index(temp_log_file) == 3
+        json_data = client.get('/history?limit=10&cursor=2').get_json()
+        assert json_data['sessions'][0]['session_type'] == 'long_break'
+        assert json_data['next_cursor'] is None
+    
+    def test_index_rebuilt_when_log_replaced(self, client, monkeypatch, temp_log_file):
+        """Test that a truncated log does not serve stale offsets"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 100)
+        client.get('/history?limit=10')
+        self.write_sessions(temp_log_file, 5)
+        
+        json_data = client.get('/history?limit=10').get_json()
+        assert len(json_data['sessions']) == 5
+        assert json_data['next_cursor'] is None
+    
+    def test_invalid_pagination_params(self, client, monkeypatch, temp_log_file):
+        """Test that bad limit or cursor values are rejected"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        assert client.get('/history?limit=abc').status_code == 400
+        assert client.get('/history?limit=0').status_code == 400
+        assert client.get('/history?cursor=-1').status_code == 400
+
+
+class TestHistoryFilters:
+    """Tests for time range and field filters on the /history route"""
+    
+    def write_days(self, path, days, per_day):
+        with open(path, 'w') as f:
+            for day in range(1, days + 1):
+                for i in range(per_day):
+                    session_type = 'work' if i % 2 == 0 else 'short_break'
+                    action = 'skipped' if i % 5 == 0 else 'completed'
+                    f.write(f"2024-01-{day:02d} {8 + i // 60:02d}:{i % 60:02d}:00 | {session_type} | {action} | session_{i}\n")
+    
+    def test_time_range(self, client, monkeypatch, temp_log_file):
+        """Test that since/until select exactly the sessions in range"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_days(temp_log_file, 10, 50)
+        
+        json_data = client.get('/history?since=2024-01-03&until=2024-01-04&limit=1000').get_json()
+        days = {s['timestamp'][:10] for s in json_data['sessions']}
+        assert days == {'2024-01-03', '2024-01-04'}
+        assert len(json_data['sessions']) == 100
+        assert json_data['next_cursor'] is None
+    
+    def test_time_range_reads_only_indexed_range(self, client, monkeypatch, temp_log_file):
+        """Test that the index narrows a time range to a slice of the log"""
+        self.write_days(temp_log_file, 10, 50)
+        line_count = log_index.refresh_index(temp_log_file)
+        
+        start, stop = log_index.line_range(temp_log_file, line_count, '2024-01-05 00:00:00', '2024-01-06 00:00:00')
+        
+        assert start <= 200 and stop >= 250
+        assert stop - start <= 50 + 2 * log_index.INDEX_STRIDE
+    
+    def test_field_filters(self, client, monkeypatch, temp_log_file):
+        """Test filtering on session_type and action"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_days(temp_log_file, 2, 20)
+        
+        sessions = client.get('/history?session_type=work&action=completed').get_json()['sessions']
+        assert len(sessions) == 16
+        assert all(s['session_type'] == 'work' and s['action'] == 'completed' for s in sessions)
+    
+    def test_filtered_pages_follow_cursor(self, client, monkeypatch, temp_log_file):
+        """Test paging through a filtered time range"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_days(temp_log_file, 5, 100)
+        
+        seen = []
+        cursor = 0
+        while cursor is not None:
+            json_data = client.get(f'/history?since=2024-01-02 08:30:00&until=2024-01-03&limit=30&cursor={cursor}').get_json()
+            seen.extend(s['timestamp'] for s in json_data['sessions'])
+            cursor = json_data['next_cursor']
+        
+        assert len(seen) == 170
+        assert seen[0] == '2024-01-02 08:30:00' and seen[-1] == '2024-01-03 09:39:00'
+    
+    def test_filters_with_binary_engine(self, client, monkeypatch, temp_log_file):
+        """Test that the binary engine resolves time ranges by record search"""
+        monkeypatch.setattr('app.BINARY_LOG_FILE', temp_log_file + '.bin')
+        monkeypatch.setattr('app.STORAGE_ENGINE', 'binary')
+        self.write_days(temp_log_file, 4, 30)
+        app.test_cli_runner().invoke(args=['convert-log', temp_log_file, temp_log_file + '.bin'])
+        
+        json_data = client.get('/history?since=2024-01-02&until=2024-01-02&action=skipped').get_json()
+        assert [s['timestamp'] for s in json_data['sessions']] == [
+            f'2024-01-02 08:{minute:02d}:00' for minute in range(0, 30, 5)
+        ]
+    
+    def test_invalid_time_bounds(self, client, monkeypatch, temp_log_file):
+        """Test that unparseable since/until values are rejected"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        assert client.get('/history?since=yesterday').status_code == 400
+
+
+class TestHistoryTail:
+    """Tests for /history?last=N reading the log backwards"""
+    
+    def write_sessions(self, path, count, first=0):
+        with open(path, 'a') as f:
+            for i in range(first, first + count):
+                session_type = 'work' if i % 2 == 0 else 'short_break'
+                f.write(f"2024-01-01 10:{i // 60:02d}:{i % 60:02d} | {session_type} | completed | session_{i}\n")
+    
+    def test_last_returns_newest_sessions(self, client, monkeypatch, temp_log_file):
+        """Test that last=N returns the N most recent sessions, oldest first"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('log_index.TAIL_BLOCK_SIZE', 32)
+        self.write_sessions(temp_log_file, 50)
+        
+        sessions = client.get('/history?last=3').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_47', 'session_48', 'session_49']
+    
+    def test_reads_only_the_tail(self, client, monkeypatch, temp_log_file):
+        """Test that the backwards scan stops once enough sessions are found"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 2000)
+        
+        parsed = []
+        original = storage.parse_log_line
+        monkeypatch.setattr('storage.parse_log_line', lambda line: parsed.append(line) or original(line))
+        
+        sessions = client.get('/history?last=5').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == [f'session_{i}' for i in range(1995, 2000)]
+        assert len(parsed) == 5
+    
+    def test_partial_final_line_is_skipped(self, client, monkeypatch, temp_log_file):
+        """Test that a record still being appended is not returned"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 5)
+        with open(temp_log_file, 'a') as f:
+            f.write('2024-01-01 10:00:05 | work | comp')
+        
+        sessions = client.get('/history?last=2').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_3', 'session_4']
+    
+    def test_last_spans_archive_and_filters(self, client, monkeypatch, temp_log_file):
+        """Test that last=N falls back to archived segments and honours filters"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 20)
+        app.test_cli_runner().invoke(args=['rotate-log'])
+        self.write_sessions(temp_log_file, 4, first=20)
+        
+        sessions = client.get('/history?last=5&session_type=work').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_14', 'session_16', 'session_18', 'session_20', 'session_22']
+    
+    def test_invalid_last(self, client, monkeypatch, temp_log_file):
+        """Test that a non-positive or non-numeric last is rejected"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        assert client.get('/history?last=0').status_code == 400
+        assert client.get('/history?last=abc').status_code == 400
+
+
+class TestHistoryCache:
+    """Tests for the per-worker cache of parsed history"""
+    
+    def write_lines(self, path, first, count):
+        with open(path, 'a') as f:
+            for i in range(first, first + count):
+                f.write(f"2024-01-01 10:00:00 | work | completed | session_{i}\n")
+    
+    def counting_parse(self, calls):
+        from app import parse_log_line
+        return lambda line: calls.append(line) or parse_log_line(line)
+    
+    def test_refresh_parses_only_new_lines(self, temp_log_file):
+        """Test that a refresh parses just the bytes appended since the last one"""
+        calls = []
+        cache = history_cache.HistoryCache(temp_log_file, self.counting_parse(calls))
+        self.write_lines(temp_log_file, 0, 10)
+        assert cache.refresh() == 10
+        
+        self.write_lines(temp_log_file, 10, 3)
+        assert cache.refresh() == 13
+        assert cache.refresh() == 13
+        
+        assert len(calls) == 13
+        assert [s['session_number'] for _, s in cache.iter_sessions(11, 13)] == ['session_11', 'session_12']
+    
+    def test_evicted_lines_served_from_disk(self, temp_log_file):
+        """Test that the memory cap evicts the oldest lines but keeps them readable"""
+        from app import parse_log_line
+        cache = history_cache.HistoryCache(temp_log_file, parse_log_line, max_records=40)
+        self.write_lines(temp_log_file, 0, 100)
+        cache.refresh()
+        
+        assert len(cache.records) <= 50
+        assert cache.first_line > 0
+        sessions = [s['session_number'] for _, s in cache.iter_sessions(0, 100)]
+        assert sessions == [f'session_{i}' for i in range(100)]
+    
+    def test_large_log_parses_only_the_tail(self, temp_log_file):
+        """Test that a first refresh of a large log never parses lines it would evict"""
+        calls = []
+        cache = history_cache.HistoryCache(temp_log_file, self.counting_parse(calls), max_records=100)
+        self.write_lines(temp_log_file, 0, 5000)
+        
+        assert cache.refresh() == 5000
+        
+        assert len(calls) < 100 + log_index.INDEX_STRIDE
+        assert len(cache.records) <= 125
+        assert cache.offset == os.path.getsize(temp_log_file)
+        sessions = [s['session_number'] for _, s in cache.iter_sessions(0, 5000)]
+        assert sessions == [f'session_{i}' for i in range(5000)]
+    
+    def test_truncated_log_resets_cache(self, temp_log_file):
+        """Test that a replaced or truncated log is re-read from the start"""
+        from app import parse_log_line
+        cache = history_cache.HistoryCache(temp_log_file, parse_log_line)
+        self.write_lines(temp_log_file, 0, 10)
+        cache.refresh()
+        
+        with open(temp_log_file, 'w') as f:
+            f.write("2024-01-02 10:00:00 | long_break | completed | session_4\n")
+        
+        assert cache.refresh() == 1
+        assert [s['session_type'] for _, s in cache.iter_sessions(0, 1)] == ['long_break']
+    
+    def test_history_route_uses_cache(self, client, monkeypatch, temp_log_file):
+        """Test that repeated /history calls do not re-parse the log"""
+        import app as app_module
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_lines(temp_log_file, 0, 20)
+        client.get('/history')
+        
+        calls = []
+        monkeypatch.setattr(history_cache.get_cache(temp_log_file, None, app_module.HISTORY_CACHE_RECORDS),
+                            'parse', self.counting_parse(calls))
+        self.write_lines(temp_log_file, 20, 1)
+        
+        assert len(client.get('/history').get_json()['sessions']) == 21
+        assert len(client.get('/history?limit=5&cursor=10').get_json()['sessions']) == 5
+        assert len(calls) == 1
+
+
+class TestBackgroundWriter:
+    """Tests for the group-commit background write mode"""
+    
+    def test_background_mode_writes_all_records(self, client, monkeypatch, temp_log_file):
+        """Test that records posted in background mode all reach the log"""
+        import app as app_module
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.WRITE_MODE', 'background')
+        
+        for i in range(20):
+            response = client.post('/log',
+                                  data=json.dumps({'session_number': i}),
+                                  content_type='application/json')
+            assert response.status_code == 200
+        app_module.get_log_writer().flush()
         
-        # Verify both entries exist
         with open(temp_log_file, 'r') as f:
             lines = f.readlines()
-            assert len(lines) == 2
-            assert 'session_1' in lines[0]
-            assert 'session_2' in lines[1]
+        assert [line.split(' | ')[3].strip() for line in lines] == [f'session_{i}' for i in range(20)]
+        assert log_index.refresh_index(temp_log_file) == 20
+    
+    def test_close_drains_queue(self, temp_log_file):
+        """Test that closing the writer flushes records still in the queue"""
+        writer = log_writer.BackgroundWriter(flush_interval=10, batch_size=1000)
+        for i in range(5):
+            writer.submit(temp_log_file, [f"2024-01-01 10:00:00 | work | completed | session_{i}\n"])
+        writer.close(timeout=5)
+        
+        with open(temp_log_file, 'r') as f:
+            assert len(f.readlines()) == 5
+    
+    def test_batch_size_triggers_flush(self, temp_log_file):
+        """Test that a full batch is written without waiting for the interval"""
+        writer = log_writer.BackgroundWriter(flush_interval=10, batch_size=3)
+        try:
+            for i in range(3):
+                writer.submit(temp_log_file, [f"2024-01-01 10:00:00 | work | completed | session_{i}\n"])
+            writer.flush()
+            with open(temp_log_file, 'r') as f:
+                assert len(f.readlines()) == 3
+        finally:
+            writer.close(timeout=5)
+    
+    def test_full_queue_returns_503(self, client, monkeypatch, temp_log_file):
+        """Test that /log reports overload instead of blocking forever"""
+        import queue
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.WRITE_MODE', 'background')
+        
+        class FullWriter:
+            def submit(self, log_file, entries, append=None):
+                raise queue.Full
+        monkeypatch.setattr('app.get_log_writer', lambda: FullWriter())
+        
+        response = client.post('/log', data=json.dumps({}), content_type='application/json')
+        assert response.status_code == 503
+        assert response.get_json()['status'] == 'error'
+
+
+class TestAdmissionControl:
+    """Tests for /log rate limiting and load shedding"""
+    
+    @pytest.fixture(autouse=True)
+    def log_file(self, monkeypatch, temp_log_file):
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+    
+    def post(self, client, address='127.0.0.1'):
+        return client.post('/log', data=json.dumps({'session_type': 'work', 'action': 'start', 'session_number': 1}),
+                           content_type='application/json', environ_base={'REMOTE_ADDR': address})
+    
+    def test_token_bucket_refills_at_rate(self):
+        """Test that a bucket admits its burst, then one request per 1/rate seconds"""
+        limiter = admission.RateLimiter(rate=0.5, burst=2)
+        
+        assert limiter.acquire('a', now=0) == 0
+        assert limiter.acquire('a', now=0) == 0
+        assert limiter.acquire('a', now=0) == 2
+        assert limiter.acquire('b', now=0) == 0
+        assert limiter.acquire('a', now=1) == 1
+        assert limiter.acquire('a', now=2) == 0
+    
+    def test_forgets_least_recent_clients(self):
+        """Test that the limiter keeps at most max_clients buckets"""
+        limiter = admission.RateLimiter(rate=1, burst=1, max_clients=2)
+        for key in ('a', 'b', 'c'):
+            limiter.acquire(key, now=0)
+        
+        assert list(limiter.buckets) == ['b', 'c']
+    
+    def test_rate_limited_client_gets_429(self, client, monkeypatch, temp_log_file):
+        """Test that a client over its burst gets 429 with Retry-After while others are admitted"""
+        monkeypatch.setattr('app.LOG_RATE_LIMIT', 0.1)
+        monkeypatch.setattr('app.LOG_RATE_BURST', 2)
+        
+        assert [self.post(client).status_code for _ in range(3)] == [200, 200, 429]
+        response = self.post(client)
+        assert response.status_code == 429
+        assert 1 <= int(response.headers['Retry-After']) <= 10
+        assert self.post(client, '10.0.0.2').status_code == 200
+        
+        with open(temp_log_file) as f:
+            assert len(f.readlines()) == 3
+        assert metrics.value(temp_log_file, 'pomodoro_log_requests_shed_total', 'rate_limit') == 2
+    
+    def test_buckets_follow_forwarded_client_behind_proxy(self, monkeypatch, temp_log_file):
+        """Test that behind a trusted proxy each forwarded client gets its own bucket"""
+        import app as app_module
+        monkeypatch.setattr('app.TRUSTED_PROXIES', app_module.TRUSTED_PROXIES)  # restored afterwards
+        monkeypatch.setattr('app.LOG_RATE_LIMIT', 0.1)
+        monkeypatch.setattr('app.LOG_RATE_BURST', 1)
+        client = app_module.create_app({'TRUSTED_PROXIES': 1, 'TESTING': True}).test_client()
+        
+        def post(forwarded_for):
+            return client.post('/log', data=json.dumps({'session_number': 1}), content_type='application/json',
+                               environ_base={'REMOTE_ADDR': '10.0.0.1'}, headers={'X-Forwarded-For': forwarded_for})
+        
+        assert post('203.0.113.5:50123').status_code == 200
+        assert post('203.0.113.5:50124').status_code == 429
+        assert post('198.51.100.7:50125').status_code == 200
+        # Only the address the trusted proxy appended counts, not one the client made up
+        assert post('192.0.2.1, 198.51.100.7').status_code == 429
+    
+    def test_sheds_when_overloaded(self, client, monkeypatch, temp_log_file):
+        """Test that requests beyond the shed depth get 429 without being logged"""
+        monkeypatch.setattr('app.LOG_SHED_DEPTH', 1)
+        import app as app_module
+        
+        with app_module._log_in_flight:
+            response = self.post(client)
+        
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == str(app_module.SHED_RETRY_AFTER)
+        assert os.path.getsize(temp_log_file) == 0
+        assert metrics.value(temp_log_file, 'pomodoro_log_requests_shed_total', 'overload') == 1
+        assert self.post(client).status_code == 200
+        assert app_module._log_in_flight.count == 0
+    
+    def test_disabled_by_default(self, client):
+        """Test that without limits configured every request is admitted"""
+        assert all(self.post(client).status_code == 200 for _ in range(50))
+
+
+class TestEventDedup:
+    """Tests for dropping retried events by their client event_id"""
+    
+    @pytest.fixture(autouse=True)
+    def log_file(self, monkeypatch, temp_log_file):
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        yield
+        if os.path.exists(event_dedup.events_path(temp_log_file)):
+            os.remove(event_dedup.events_path(temp_log_file))
+    
+    def post(self, client, **fields):
+        return client.post('/log', data=json.dumps(fields), content_type='application/json')
+    
+    def lines(self, path):
+        with open(path) as f:
+            return f.readlines()
+    
+    def test_retried_event_logged_once(self, client, temp_log_file):
+        """Test that posting the same event_id twice appends one line"""
+        assert self.post(client, event_id='e1').get_json()['status'] == 'success'
+        response = self.post(client, event_id='e1')
+        
+        assert response.status_code == 200
+        assert response.get_json()['duplicate'] is True
+        assert len(self.lines(temp_log_file)) == 1
+        assert metrics.value(temp_log_file, 'pomodoro_log_duplicates_total') == 1
+    
+    def test_batch_drops_duplicates(self, client, temp_log_file):
+        """Test that a batch skips ids already logged or repeated within it, and events without one"""
+        self.post(client, event_id='a')
+        response = client.post('/log/batch', data=json.dumps(
+            [{'event_id': 'a'}, {'event_id': 'b'}, {'event_id': 'b'}, {}, {}]), content_type='application/json')
+        
+        assert response.get_json()['count'] == 3
+        assert response.get_json()['duplicates'] == 2
+        assert len(self.lines(temp_log_file)) == 4
+    
+    def test_ids_are_per_user(self, client, temp_log_file, monkeypatch):
+        """Test that two clients may use the same event_id"""
+        monkeypatch.setattr('app.SHARD_DIR', temp_log_file + '.shards')
+        try:
+            self.post(client, event_id='e1')
+            response = self.post(client, event_id='e1', user_id='device-1')
+            assert 'duplicate' not in response.get_json()
+        finally:
+            shutil.rmtree(temp_log_file + '.shards', ignore_errors=True)
+    
+    def test_failed_write_releases_id(self, client, temp_log_file, monkeypatch):
+        """Test that a retry of an event whose write failed is logged"""
+        import app as app_module
+        write_sessions = app_module.write_sessions
+        
+        def failing_write(sessions):
+            raise OSError('disk full')
+        
+        monkeypatch.setattr('app.write_sessions', failing_write)
+        assert self.post(client, event_id='e1').status_code == 500
+        monkeypatch.setattr('app.write_sessions', write_sessions)
+        
+        assert 'duplicate' not in self.post(client, event_id='e1').get_json()
+        assert len(self.lines(temp_log_file)) == 1
+    
+    def test_ids_expire_with_the_window(self, temp_log_file):
+        """Test that an id is remembered for one to two windows"""
+        assert event_dedup.claim(temp_log_file, 'k', 10, 64, now=0)
+        assert not event_dedup.claim(temp_log_file, 'k', 10, 64, now=5)
+        assert not event_dedup.claim(temp_log_file, 'k', 10, 64, now=15)
+        assert event_dedup.claim(temp_log_file, 'k', 10, 64, now=40)
+    
+    def test_memory_bounded_by_capacity(self, temp_log_file):
+        """Test that the record has a fixed size and forgets the oldest ids beyond capacity"""
+        for i in range(5):
+            assert event_dedup.claim(temp_log_file, f'k{i}', 10, 4, now=0)
+        
+        assert os.path.getsize(event_dedup.events_path(temp_log_file)) == event_dedup._size(4)
+        assert event_dedup.claim(temp_log_file, 'k0', 10, 4, now=0)
+        assert not event_dedup.claim(temp_log_file, 'k4', 10, 4, now=0)
+    
+    def test_disabled(self, client, temp_log_file, monkeypatch):
+        """Test that DEDUP_WINDOW=0 logs every event"""
+        monkeypatch.setattr('app.DEDUP_WINDOW', 0)
+        self.post(client, event_id='e1')
+        self.post(client, event_id='e1')
+        
+        assert len(self.lines(temp_log_file)) == 2
+    
+    def test_invalid_event_id(self, client):
+        """Test that a non-string event_id is rejected"""
+        assert self.post(client, event_id=42).status_code == 400
+
+
+class TestBinaryStorage:
+    """Tests for the fixed-width binary storage engine"""
+    
+    @pytest.fixture
+    def binary_log(self, monkeypatch, temp_log_file):
+        binary_log_file = temp_log_file + '.bin'
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.BINARY_LOG_FILE', binary_log_file)
+        monkeypatch.setattr('app.STORAGE_ENGINE', 'binary')
+        return binary_log_file
+    
+    def test_log_and_history_round_trip(self, client, binary_log):
+        """Test that sessions logged to the binary store come back unchanged"""
+        client.post('/log', data=json.dumps({'session_type': 'work', 'session_number': 3}),
+                    content_type='application/json')
+        client.post('/log/batch', data=json.dumps([{'session_type': 'long_break', 'action': 'skipped', 'session_number': 4}]),
+                    content_type='application/json')
+        
+        assert os.path.getsize(binary_log) == 2 * binary_store.RECORD.size
+        sessions = client.get('/history').get_json()['sessions']
+        assert [(s['session_type'], s['action'], s['session_number']) for s in sessions] == [
+            ('work', 'completed', 'session_3'),
+            ('long_break', 'skipped', 'session_4'),
+        ]
+    
+    def test_history_page_slices_records(self, client, binary_log):
+        """Test that pagination maps the cursor straight to record numbers"""
+        client.post('/log/batch', data=json.dumps([{'session_number': i} for i in range(10)]),
+                    content_type='application/json')
+        
+        json_data = client.get('/history?limit=4&cursor=4').get_json()
+        assert [s['session_number'] for s in json_data['sessions']] == ['session_4', 'session_5', 'session_6', 'session_7']
+        assert json_data['next_cursor'] == 8
+        assert client.get('/history?limit=4&cursor=8').get_json()['next_cursor'] is None
+    
+    def test_last_reads_trailing_records(self, client, binary_log):
+        """Test that last=N returns the newest records of the binary store"""
+        client.post('/log/batch', data=json.dumps([{'session_number': i} for i in range(10)]),
+                    content_type='application/json')
+        
+        sessions = client.get('/history?last=3').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_7', 'session_8', 'session_9']
+    
+    def test_partial_record_is_ignored(self, client, binary_log):
+        """Test that a torn trailing record is not served"""
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        with open(binary_log, 'ab') as f:
+            f.write(b'\x00' * 5)
+        
+        assert len(client.get('/history').get_json()['sessions']) == 1
+    
+    def test_unknown_session_type_rejected(self, client, binary_log):
+        """Test that values outside the record enums are refused"""
+        response = client.post('/log', data=json.dumps({'session_type': 'nap'}),
+                               content_type='application/json')
+        assert response.status_code == 400
+        assert not os.path.exists(binary_log)
+    
+    def test_convert_text_log(self, temp_log_file):
+        """Test converting the text log format into the binary store"""
+        with open(temp_log_file, 'w') as f:
+            f.write("2024-01-01 10:00:00 | work | completed | session_1\n")
+            f.write("malformed entry\n")
+            f.write("2024-01-01 10:25:00 | short_break | skipped | session_1\n")
+        
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['convert-log', temp_log_file, temp_log_file + '.bin'])
+        
+        assert 'Converted 2 sessions (1 skipped)' in result.output
+        records = [binary_store.decode_record(f) for f in binary_store.iter_records(temp_log_file + '.bin')]
+        assert records == [
+            {'timestamp': '2024-01-01 10:00:00', 'session_type': 'work', 'action': 'completed', 'session_number': 'session_1'},
+            {'timestamp': '2024-01-01 10:25:00', 'session_type': 'short_break', 'action': 'skipped', 'session_number': 'session_1'},
+        ]
+
+    def test_convert_includes_archived_segments(self, temp_log_file):
+        """Test that sessions already rotated into the archive are converted too"""
+        with open(temp_log_file, 'w') as f:
+            f.write("2024-01-01 10:00:00 | work | completed | session_1\n")
+            f.write("malformed entry\n")
+        log_archive.rotate_log(temp_log_file, force=True)
+        with open(temp_log_file, 'w') as f:
+            f.write("2024-01-02 10:00:00 | work | skipped | session_2\n")
 
+        result = app.test_cli_runner().invoke(args=['convert-log', temp_log_file, temp_log_file + '.bin'])
+
+        assert 'Converted 2 sessions (1 skipped)' in result.output
+        records = [binary_store.decode_record(f) for f in binary_store.iter_records(temp_log_file + '.bin')]
+        assert [r['timestamp'] for r in records] == ['2024-01-01 10:00:00', '2024-01-02 10:00:00']
+
+
+
+class TestSQLiteStorage:
+    """Tests for the SQLite (WAL) storage engine"""
+    
+    @pytest.fixture
+    def sqlite_db(self, monkeypatch, temp_log_file):
+        db_file = temp_log_file + '.db'
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.SQLITE_FILE', db_file)
+        monkeypatch.setattr('app.STORAGE_ENGINE', 'sqlite')
+        return db_file
+    
+    def add_sessions(self, count, start=datetime(2024, 1, 1, 9, 0)):
+        import app as app_module
+        app_module.get_storage().append_many([
+            {'timestamp': start + timedelta(minutes=30 * i), 'session_type': 'work' if i % 2 == 0 else 'short_break',
+             'action': 'skipped' if i % 3 == 0 else 'completed', 'session_number': i}
+            for i in range(count)
+        ])
+    
+    def test_log_and_history_round_trip(self, client, sqlite_db):
+        """Test that sessions logged to SQLite come back unchanged and nothing touches the text log"""
+        client.post('/log', data=json.dumps({'session_type': 'work', 'session_number': 3}),
+                    content_type='application/json')
+        client.post('/log/batch', data=json.dumps([{'session_type': 'long_break', 'action': 'skipped', 'session_number': 4}]),
+                    content_type='application/json')
+        
+        sessions = client.get('/history').get_json()['sessions']
+        assert [(s['session_type'], s['action'], s['session_number']) for s in sessions] == [
+            ('work', 'completed', 'session_3'),
+            ('long_break', 'skipped', 'session_4'),
+        ]
+        assert os.path.getsize(app.config.get('LOG_FILE', LOG_FILE)) == 0
+    
+    def test_database_uses_wal_and_indexes(self, client, sqlite_db):
+        """Test that the database is in WAL mode with the timestamp and session_type indexes"""
+        import sqlite3
+        self.add_sessions(1)
+        
+        connection = sqlite3.connect(sqlite_db)
+        try:
+            assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            plan = ' '.join(row[-1] for row in connection.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM sessions WHERE session_type = 'work' AND timestamp >= '2024'"))
+        finally:
+            connection.close()
+        assert {'sessions_timestamp', 'sessions_type_timestamp'} <= indexes
+        assert 'sessions_type_timestamp' in plan
+    
+    def test_history_page_follows_row_ids(self, client, sqlite_db):
+        """Test that cursors page through the table like line numbers do through the text log"""
+        self.add_sessions(10)
+        
+        json_data = client.get('/history?limit=4&cursor=4').get_json()
+        assert [s['session_number'] for s in json_data['sessions']] == ['session_4', 'session_5', 'session_6', 'session_7']
+        assert json_data['next_cursor'] == 8
+        assert client.get('/history?limit=4&cursor=8').get_json()['next_cursor'] is None
+    
+    def test_filters_time_range_and_last(self, client, sqlite_db):
+        """Test that since/until, equality filters and last=N are answered by SQL"""
+        self.add_sessions(12)
+        
+        sessions = client.get('/history?since=2024-01-01T10:00&until=2024-01-01T12:00&session_type=work').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_2', 'session_4']
+        
+        sessions = client.get('/history?last=2&action=skipped').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_6', 'session_9']
+    
+    def test_stats_from_daily_counts(self, client, sqlite_db):
+        """Test that /stats reads the per-day counts the insert trigger maintains"""
+        self.add_sessions(6)
+        self.add_sessions(2, start=datetime(2024, 1, 2, 9, 0))
+        
+        json_data = client.get('/stats').get_json()
+        assert json_data['days']['2024-01-01'] == {
+            'work': {'completed': 2, 'skipped': 1},
+            'short_break': {'completed': 2, 'skipped': 1},
+        }
+        assert json_data['days']['2024-01-02'] == {'work': {'skipped': 1}, 'short_break': {'completed': 1}}
+        assert json_data['totals']['work'] == {'completed': 2, 'skipped': 2}
+        
+        runner = app.test_cli_runner()
+        assert 'Rebuilt rollups for 2 days' in runner.invoke(args=['rebuild-stats']).output
+        assert client.get('/stats').get_json() == json_data
+    
+    def test_export_resumes_after_cursor(self, client, monkeypatch, sqlite_db):
+        """Test that the export streams every row in chunks and resumes after the cursor it carried"""
+        monkeypatch.setattr('storage.SQLITE_STREAM_CHUNK', 3)
+        self.add_sessions(10)
+        
+        records = [json.loads(line) for line in client.get('/history/export?format=ndjson').get_data(as_text=True).splitlines()]
+        assert [r['session_number'] for r in records] == [f'session_{i}' for i in range(10)]
+        
+        resumed = client.get(f"/history/export?format=ndjson&cursor={records[6]['cursor']}").get_data(as_text=True)
+        assert [json.loads(line)['session_number'] for line in resumed.splitlines()] == ['session_7', 'session_8', 'session_9']
+    
+    def test_threads_use_their_own_connections(self, client, sqlite_db):
+        """Test that concurrent threads each write and read through a connection of their own"""
+        import concurrent.futures
+        
+        def log_and_read(i):
+            storage.sqlite_connection(sqlite_db)
+            client_for_thread = app.test_client()
+            client_for_thread.post('/log', data=json.dumps({'session_number': i}), content_type='application/json')
+            return id(storage.sqlite_connection(sqlite_db))
+        
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            connection_ids = list(pool.map(log_and_read, range(20)))
+        
+        assert len(set(connection_ids)) == 4
+        sessions = client.get('/history').get_json()['sessions']
+        assert sorted(int(s['session_number'][8:]) for s in sessions) == list(range(20))
+
+
+class TestUserShards:
+    """Tests for per-user shards selected by user_id"""
+    
+    @pytest.fixture
+    def shard_dir(self, monkeypatch, temp_log_file):
+        shard_dir = temp_log_file + '.shards'
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.SHARD_DIR', shard_dir)
+        return shard_dir
+    
+    def post(self, client, payload):
+        return client.post('/log', data=json.dumps(payload), content_type='application/json')
+    
+    def test_sessions_go_to_the_users_shard(self, client, shard_dir, temp_log_file):
+        """Test that each user's sessions land in their own shard and the shared log keeps anonymous ones"""
+        self.post(client, {'session_number': 1, 'user_id': 'alice'})
+        client.post('/log/batch', data=json.dumps([
+            {'session_number': 2, 'user_id': 'bob'},
+            {'session_number': 3, 'user_id': 'alice'},
+            {'session_number': 4},
+        ]), content_type='application/json')
+        
+        alice_shard = storage.shard_path(shard_dir, 'alice', '.txt')
+        with open(alice_shard, 'r') as f:
+            assert [line.rsplit(' | ', 1)[1].strip() for line in f] == ['session_1', 'session_3']
+        with open(temp_log_file, 'r') as f:
+            assert [line.rsplit(' | ', 1)[1].strip() for line in f] == ['session_4']
+        
+        def numbers(query):
+            return [s['session_number'] for s in client.get('/history' + query).get_json()['sessions']]
+        assert numbers('?user_id=alice') == ['session_1', 'session_3']
+        assert numbers('?user_id=bob&last=5') == ['session_2']
+        assert numbers('?user_id=carol') == []
+        assert numbers('') == ['session_4']
+    
+    def test_stats_read_only_the_callers_shard(self, client, shard_dir):
+        """Test that /stats counts the caller's sessions only"""
+        self.post(client, {'user_id': 'alice'})
+        self.post(client, {'user_id': 'alice', 'action': 'skipped'})
+        self.post(client, {'user_id': 'bob'})
+        
+        totals = client.get('/stats?user_id=alice').get_json()['totals']
+        assert totals == {'work': {'completed': 1, 'skipped': 1}}
+        assert client.get('/stats?user_id=bob').get_json()['totals'] == {'work': {'completed': 1}}
+        assert client.get('/stats').get_json()['totals'] == {}
+    
+    def test_etag_follows_the_callers_shard(self, client, shard_dir):
+        """Test that another user's writes do not invalidate a cached response"""
+        self.post(client, {'user_id': 'alice'})
+        etag = client.get('/history?user_id=alice').headers['ETag']
+        
+        self.post(client, {'user_id': 'bob'})
+        assert client.get('/history?user_id=alice', headers={'If-None-Match': etag}).status_code == 304
+        self.post(client, {'user_id': 'alice'})
+        assert client.get('/history?user_id=alice', headers={'If-None-Match': etag}).status_code == 200
+    
+    def test_shard_paths_are_hashed(self, shard_dir):
+        """Test that ids map to stable hashed files two directory levels down"""
+        path = storage.shard_path(shard_dir, '../../etc/passwd', '.txt')
+        
+        assert path == storage.shard_path(shard_dir, '../../etc/passwd', '.txt')
+        assert path != storage.shard_path(shard_dir, 'alice', '.txt')
+        relative = os.path.relpath(path, shard_dir).split(os.sep)
+        assert len(relative) == 3
+        assert relative[2].startswith(relative[0] + relative[1])
+        assert '..' not in relative
+    
+    def test_invalid_user_id_rejected(self, client, shard_dir, temp_log_file):
+        """Test that user ids that are too long or not strings are refused"""
+        assert self.post(client, {'user_id': 'x' * 129}).status_code == 400
+        assert self.post(client, {'user_id': 42}).status_code == 400
+        assert client.get('/history?user_id=' + 'x' * 129).status_code == 400
+        assert client.get('/stats?user_id=' + 'x' * 129).status_code == 400
+        assert os.path.getsize(temp_log_file) == 0
+        assert not os.path.exists(shard_dir)
+    
+    def test_least_recently_used_shards_are_closed(self, client, monkeypatch, shard_dir):
+        """Test that a worker keeps at most MAX_OPEN_STORAGES backends and reopens evicted ones"""
+        import app as app_module
+        monkeypatch.setattr('app.MAX_OPEN_STORAGES', 2)
+        for user in ('alice', 'bob', 'carol'):
+            self.post(client, {'user_id': user, 'session_number': len(user)})
+        
+        assert len(app_module._storages) <= 2
+        assert storage.shard_path(shard_dir, 'alice', '.txt') not in history_cache._caches
+        sessions = client.get('/history?user_id=alice').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_5']
+    
+    def test_shards_share_the_metrics_registry(self, client, shard_dir, temp_log_file):
+        """Test that appends to shards are counted in the deployment's one registry"""
+        self.post(client, {'user_id': 'alice'})
+        
+        shard = storage.shard_path(shard_dir, 'alice', '.txt')
+        assert metrics.value(temp_log_file, 'pomodoro_log_bytes_written_total') == os.path.getsize(shard)
+        assert not os.path.exists(metrics.metrics_path(shard))
+    
+    def test_sqlite_shards(self, client, monkeypatch, shard_dir, temp_log_file):
+        """Test that the SQLite engine keeps one database per user"""
+        monkeypatch.setattr('app.SQLITE_FILE', temp_log_file + '.db')
+        monkeypatch.setattr('app.STORAGE_ENGINE', 'sqlite')
+        self.post(client, {'user_id': 'alice', 'session_number': 1})
+        self.post(client, {'user_id': 'bob', 'session_number': 2})
+        
+        assert os.path.exists(storage.shard_path(shard_dir, 'alice', '.db'))
+        sessions = client.get('/history?user_id=bob').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_2']
+        # Every shard's metrics go to the registry of the shared database
+        assert os.path.exists(metrics.metrics_path(temp_log_file + '.db'))
+
+needs_numpy = pytest.mark.skipif(not analytics.AVAILABLE, reason='NumPy is not installed')
+
+
+class TestAnalytics:
+    """Tests for the /analytics reports"""
+    
+    LOG_LINES = (
+        "2024-01-01 09:10:00 | work | completed | session_1\n"
+        "2024-01-01 09:40:00 | short_break | completed | session_1\n"
+        "2024-01-01 10:00:00 | work | skipped | session_2\n"
+        "malformed entry\n"
+        "2024-01-02 14:00:00 | work | completed | session_1\n"
+        "2024-01-03 14:30:00 | work | completed | session_1\n"
+        "2024-01-05 08:00:00 | work | completed | session_1\n"
+    )
+    
+    @pytest.fixture(autouse=True)
+    def log_file(self, monkeypatch, temp_log_file):
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        with open(temp_log_file, 'w') as f:
+            f.write(self.LOG_LINES)
+    
+    @needs_numpy
+    def test_reports(self, client):
+        """Test totals, heatmap, daily focus time, completion rates and streaks"""
+        response = client.get('/analytics')
+        
+        assert response.status_code == 200
+        report = response.get_json()
+        assert report['totals'] == {'sessions': 6, 'completed': 5, 'skipped': 1,
+                                    'focus_sessions': 4, 'focus_minutes': 100}
+        heatmap = report['heatmap']
+        assert (len(heatmap), len(heatmap[0])) == (7, 24)
+        assert (heatmap[0][9], heatmap[1][14], heatmap[2][14], heatmap[4][8]) == (1, 1, 1, 1)
+        assert sum(map(sum, heatmap)) == 4
+        assert report['daily'][0] == {'date': '2024-01-01', 'completed': 2, 'skipped': 1,
+                                      'focus_sessions': 1, 'focus_minutes': 25}
+        assert [day['date'] for day in report['daily']] == ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-05']
+        assert report['completion_rates'] == {
+            'work': {'completed': 4, 'skipped': 1, 'rate': 0.8},
+            'short_break': {'completed': 1, 'skipped': 0, 'rate': 1.0},
+        }
+        assert report['streaks'] == {'longest': 3, 'longest_start': '2024-01-01',
+                                     'longest_end': '2024-01-03', 'current': 0}
+    
+    @needs_numpy
+    def test_time_range_and_work_minutes(self, client, monkeypatch):
+        """Test that since/until narrow the reports and WORK_MINUTES scales focus time"""
+        monkeypatch.setattr('app.WORK_MINUTES', 50)
+        
+        report = client.get('/analytics?since=2024-01-02&until=2024-01-03').get_json()
+        
+        assert report['totals'] == {'sessions': 2, 'completed': 2, 'skipped': 0,
+                                    'focus_sessions': 2, 'focus_minutes': 100}
+    
+    @needs_numpy
+    def test_memoized_until_log_changes(self, client, temp_log_file):
+        """Test that repeated loads are cache hits and a write loads only the new session"""
+        client.get('/analytics')
+        client.get('/analytics')
+        assert metrics.value(temp_log_file, 'pomodoro_cache_hits_total', 'analytics') == 1
+        
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        storage.parse_counter.records = 0
+        report = client.get('/analytics').get_json()
+        
+        assert report['totals']['sessions'] == 7
+        assert report['streaks']['current'] == 1
+        assert storage.parse_counter.records == 1
+        assert metrics.value(temp_log_file, 'pomodoro_cache_misses_total', 'analytics') == 2
+    
+    @needs_numpy
+    def test_loads_in_chunks(self, client, monkeypatch):
+        """Test that loading a few sessions at a time gives the same columns as loading them at once"""
+        import app as app_module
+        whole = client.get('/analytics').get_json()
+        analytics.discard(app_module.LOG_FILE)
+        monkeypatch.setattr('analytics.LOAD_CHUNK_SIZE', 2)
+        chunked = []
+        original = analytics.parse_timestamps
+        monkeypatch.setattr('analytics.parse_timestamps', lambda texts: chunked.append(len(texts)) or original(texts))
+        
+        assert client.get('/analytics').get_json() == whole
+        assert chunked == [2, 2, 2]
+    
+    @needs_numpy
+    def test_sqlite_engine(self, client, monkeypatch, temp_log_file):
+        """Test that reports work on the SQLite backend"""
+        monkeypatch.setattr('app.SQLITE_FILE', temp_log_file + '.db')
+        monkeypatch.setattr('app.STORAGE_ENGINE', 'sqlite')
+        client.post('/log/batch', data=json.dumps([{}, {'action': 'skipped'}, {'session_type': 'long_break'}]),
+                    content_type='application/json')
+        
+        report = client.get('/analytics').get_json()
+        
+        assert report['totals']['sessions'] == 3
+        assert report['completion_rates']['work'] == {'completed': 1, 'skipped': 1, 'rate': 0.5}
+    
+    @needs_numpy
+    def test_streaks(self):
+        """Test longest and current streaks over runs of active days"""
+        days = analytics.np.array([1, 2, 3, 5, 6, 10])
+        
+        assert analytics.streaks(days, today=11) == {'longest': 3, 'longest_start': '1970-01-02',
+                                                     'longest_end': '1970-01-04', 'current': 1}
+        assert analytics.streaks(days, today=12)['current'] == 0
+        assert analytics.streaks(days[:0], today=12)['longest'] == 0
+    
+    @needs_numpy
+    def test_invalid_time_range(self, client):
+        """Test that an unparseable since is rejected"""
+        assert client.get('/analytics?since=yesterday').status_code == 400
+    
+    def test_unavailable_without_numpy(self, client, monkeypatch):
+        """Test that /analytics answers 503 when NumPy is missing"""
+        monkeypatch.setattr('analytics.AVAILABLE', False)
+        
+        assert client.get('/analytics').status_code == 503
+
+
+class TestStatsRoute:
+    """Tests for the /stats route and its rollups"""
+    
+    def test_stats_empty_log(self, client, monkeypatch):
+        """Test stats when no log file exists"""
+        monkeypatch.setattr('app.LOG_FILE', '/tmp/nonexistent_pomodoro_log.txt')
+        
+        response = client.get('/stats')
+        assert response.status_code == 200
+        assert response.get_json() == {'days': {}, 'totals': {}}
+    
+    def test_stats_counts_per_day_and_type(self, client, monkeypatch, temp_log_file):
+        """Test that stats count completed and skipped sessions per day"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        with open(temp_log_file, 'w') as f:
+            f.write("2024-01-01 10:00:00 | work | completed | session_1\n")
+            f.write("2024-01-01 10:25:00 | short_break | completed | session_1\n")
+            f.write("2024-01-01 10:30:00 | work | skipped | session_2\n")
+            f.write("malformed entry\n")
+            f.write("2024-01-02 09:00:00 | work | completed | session_1\n")
+        
+        json_data = client.get('/stats').get_json()
+        assert json_data['days'] == {
+            '2024-01-01': {'work': {'completed': 1, 'skipped': 1}, 'short_break': {'completed': 1}},
+            '2024-01-02': {'work': {'completed': 1}},
+        }
+        assert json_data['totals'] == {'work': {'completed': 2, 'skipped': 1}, 'short_break': {'completed': 1}}
+    
+    def test_rollups_folded_in_when_read(self, client, monkeypatch, temp_log_file):
+        """Test that /log leaves the rollups alone and /stats folds in what was appended since"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        client.post('/log', data=json.dumps({'action': 'skipped'}), content_type='application/json')
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        assert not os.path.exists(rollups.stats_path(temp_log_file))
+        
+        client.get('/stats')
+        with open(rollups.stats_path(temp_log_file), 'r') as f:
+            state = json.load(f)
+        assert state['offset'] == os.path.getsize(temp_log_file)
+        (day_counts,) = state['days'].values()
+        assert day_counts == {'work': {'skipped': 1, 'completed': 1}}
+    
+    def test_concurrent_refreshes_count_each_record_once(self, temp_log_file):
+        """Test that threads refreshing the rollups at once never lose or double count records"""
+        import threading
+        def append_and_refresh(worker):
+            for i in range(30):
+                log_writer.append_lines(temp_log_file, [f"2024-01-01 10:00:00 | work | completed | {worker}_{i}\n"])
+                rollups.refresh_rollups(temp_log_file)
+        threads = [threading.Thread(target=append_and_refresh, args=(w,)) for w in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert rollups.refresh_rollups(temp_log_file) == {'2024-01-01': {'work': {'completed': 240}}}
+        assert not glob.glob(rollups.stats_path(temp_log_file) + '.*.tmp')
+    
+    def test_stats_with_binary_engine(self, client, monkeypatch, temp_log_file):
+        """Test that stats are maintained for the binary storage engine"""
+        monkeypatch.setattr('app.BINARY_LOG_FILE', temp_log_file + '.bin')
+        monkeypatch.setattr('app.STORAGE_ENGINE', 'binary')
+        
+        client.post('/log/batch', data=json.dumps([{}, {'session_type': 'long_break'}]),
+                    content_type='application/json')
+        
+        assert client.get('/stats').get_json()['totals'] == {
+            'work': {'completed': 1}, 'long_break': {'completed': 1}
+        }
+    
+    def test_rebuild_stats_command(self, monkeypatch, temp_log_file):
+        """Test that rebuild-stats recomputes rollups from the raw log"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        with open(temp_log_file, 'w') as f:
+            f.write("2024-01-01 10:00:00 | work | completed | session_1\n")
+        with open(rollups.stats_path(temp_log_file), 'w') as f:
+            json.dump({'inode': os.stat(temp_log_file).st_ino, 'offset': os.path.getsize(temp_log_file),
+                       'days': {'2024-01-01': {'work': {'completed': 99}}}}, f)
+        
+        result = app.test_cli_runner().invoke(args=['rebuild-stats'])
+        
+        assert 'Rebuilt rollups for 1 days' in result.output
+        assert rollups.refresh_rollups(temp_log_file) == {'2024-01-01': {'work': {'completed': 1}}}
+
+
+def append_from_worker(log_file, worker, batches):
+    """Append batches of long lines the way a gunicorn worker would"""
+    for batch in range(batches):
+        lines = [f"2024-01-01 10:00:00 | work | completed | session_{worker}_{batch}_{'x' * 200}\n"
+                 for _ in range(50)]
+        log_writer.append_lines(log_file, lines)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork to simulate gunicorn workers')
+class TestMultiProcessWrites:
+    """Tests for appends and change notification across processes"""
+    
+    def test_concurrent_batches_do_not_interleave(self, temp_log_file):
+        """Test that batches from several processes land whole and intact"""
+        import multiprocessing
+        ctx = multiprocessing.get_context('fork')
+        workers = [ctx.Process(target=append_from_worker, args=(temp_log_file, w, 20)) for w in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        with open(temp_log_file, 'r') as f:
+            lines = f.readlines()
+        assert len(lines) == 4 * 20 * 50
+        # Every batch of 50 identical lines must be contiguous
+        for start in range(0, len(lines), 50):
+            assert len(set(lines[start:start + 50])) == 1
+        assert log_index.refresh_index(temp_log_file) == len(lines)
+        assert generation.current(temp_log_file) == 4 * 20
+    
+    def test_generation_visible_across_processes(self, temp_log_file):
+        """Test that a bump in another process is seen through the shared map"""
+        import multiprocessing
+        before = generation.current(temp_log_file)
+        
+        process = multiprocessing.get_context('fork').Process(target=generation.bump, args=(temp_log_file,))
+        process.start()
+        process.join()
+        
+        assert generation.current(temp_log_file) == before + 1
+    
+    def test_stats_cache_follows_generation(self, client, monkeypatch, temp_log_file):
+        """Test that /stats is cached until a write bumps the generation"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        assert client.get('/stats').get_json()['totals'] == {'work': {'completed': 1}}
+        
+        calls = []
+        original = rollups.refresh_rollups
+        monkeypatch.setattr('rollups.refresh_rollups', lambda *a, **k: calls.append(a) or original(*a, **k))
+        client.get('/stats')
+        assert calls == []
+        
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        assert client.get('/stats').get_json()['totals'] == {'work': {'completed': 2}}
+
+
+def observe_from_worker(log_file, count):
+    """Record metrics the way a gunicorn worker would"""
+    for _ in range(count):
+        metrics.inc(log_file, 'pomodoro_log_bytes_written_total', 10)
+        metrics.observe(log_file, 'pomodoro_log_append_duration_seconds', 0.002)
+
+
+class TestSharedMmap:
+    """Tests for the memory-mapped files behind the generation counter, metrics and event ids"""
+    
+    def test_file_of_another_size_is_reset(self, temp_log_file):
+        """Test that a file laid out for another size is zeroed, and a new size maps it again"""
+        path = temp_log_file + '.shared'
+        with open(path, 'wb') as f:
+            f.write(b'\xff' * 3)
+        
+        with shared_mmap.get(path, 16).locked() as mm:
+            assert mm[:] == bytes(16)
+            mm[0] = 7
+        assert shared_mmap.get(path, 16).mm[0] == 7
+        assert os.path.getsize(path) == 16
+        
+        assert shared_mmap.get(path, 32).mm[:] == bytes(32)
+        shared_mmap.release(path)
+        with shared_mmap.get(path, 32).locked(shared=True) as mm:
+            assert len(mm) == 32
+        shared_mmap.release(path)
+
+
+class TestMetrics:
+    """Tests for the shared metrics registry and the /metrics endpoint"""
+    
+    def sample(self, body, series):
+        for line in body.splitlines():
+            if line.startswith(series + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        raise AssertionError(f'{series} not exposed')
+    
+    def test_requests_and_appends_are_recorded(self, client, monkeypatch, temp_log_file):
+        """Test that route latencies, append latency and bytes written are exposed"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        client.get('/history')
+        client.get('/history')
+        
+        response = client.get('/metrics')
+        body = response.data.decode()
+        
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        assert self.sample(body, 'pomodoro_http_request_duration_seconds_count{route="log_session"}') == 1
+        assert self.sample(body, 'pomodoro_http_request_duration_seconds_count{route="get_history"}') == 2
+        assert self.sample(body, 'pomodoro_http_request_duration_seconds_bucket{route="get_history",le="+Inf"}') == 2
+        assert self.sample(body, 'pomodoro_log_append_duration_seconds_count') == 1
+        assert self.sample(body, 'pomodoro_log_bytes_written_total') == os.path.getsize(temp_log_file)
+        assert self.sample(body, 'pomodoro_log_size_bytes') == os.path.getsize(temp_log_file)
+    
+    def test_records_parsed_and_cache_hits(self, client, monkeypatch, temp_log_file):
+        """Test that /history counts parsed lines and the cache hit ratio follows repeat reads"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        client.post('/log/batch', data=json.dumps([{}] * 5), content_type='application/json')
+        client.get('/history')
+        client.get('/history')
+        
+        body = client.get('/metrics').data.decode()
+        assert self.sample(body, 'pomodoro_history_records_parsed_sum') == 5
+        assert self.sample(body, 'pomodoro_history_records_parsed_bucket{le="0"}') == 1
+        assert self.sample(body, 'pomodoro_cache_hit_ratio{cache="history"}') == 0.5
+    
+    def test_disabled_metrics_record_nothing(self, client, monkeypatch, temp_log_file):
+        """Test that POMODORO_METRICS=0 turns recording off"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('metrics.ENABLED', False)
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        
+        body = client.get('/metrics').data.decode()
+        assert self.sample(body, 'pomodoro_log_bytes_written_total') == 0
+    
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork to simulate gunicorn workers')
+    def test_workers_aggregate_through_shared_registry(self, temp_log_file):
+        """Test that updates from several processes add up without losses"""
+        import multiprocessing
+        metrics.inc(temp_log_file, 'pomodoro_log_bytes_written_total', 0)  # map before forking
+        ctx = multiprocessing.get_context('fork')
+        workers = [ctx.Process(target=observe_from_worker, args=(temp_log_file, 200)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        assert metrics.value(temp_log_file, 'pomodoro_log_bytes_written_total') == 4 * 200 * 10
+        body = metrics.render(temp_log_file)
+        assert self.sample(body, 'pomodoro_log_append_duration_seconds_count') == 800
+        assert self.sample(body, 'pomodoro_log_append_duration_seconds_bucket{le="0.0025"}') == 800
+
+
+class TestLogRotation:
+    """Tests for rotation, archival and retention of the text log"""
+    
+    def write_day(self, path, day, count, first=0):
+        with open(path, 'a') as f:
+            for i in range(first, first + count):
+                f.write(f"2024-01-{day:02d} 10:{i // 60:02d}:{i % 60:02d} | work | completed | session_{i}\n")
+    
+    def rotate(self, temp_log_file):
+        result = app.test_cli_runner().invoke(args=['rotate-log'])
+        assert 'Archived' in result.output
+    
+    def test_rotate_creates_gzip_segment(self, client, monkeypatch, temp_log_file):
+        """Test that rotation moves the log into a gzip segment listed in the manifest"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_day(temp_log_file, 1, 10)
+        
+        self.rotate(temp_log_file)
+        
+        manifest = log_archive.load_manifest(temp_log_file)
+        assert manifest['next_line'] == 10
+        (segment,) = manifest['segments']
+        assert segment['file'].endswith('.gz')
+        assert (segment['first'], segment['last']) == ('2024-01-01 10:00:00', '2024-01-01 10:00:09')
+        assert os.path.exists(log_archive.segment_path(temp_log_file, segment))
+        assert not os.path.exists(temp_log_file)
+    
+    def test_history_reads_across_segments(self, client, monkeypatch, temp_log_file):
+        """Test that full history and pagination span archives and the active log"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_day(temp_log_file, 1, 100)
+        self.rotate(temp_log_file)
+        self.write_day(temp_log_file, 2, 100, first=100)
+        self.rotate(temp_log_file)
+        client.post('/log', data=json.dumps({'session_number': 200}), content_type='application/json')
+        
+        full = [s['session_number'] for s in client.get('/history').get_json()['sessions']]
+        assert full == [f'session_{i}' for i in range(201)]
+        
+        paged = []
+        cursor = 0
+        while cursor is not None:
+            json_data = client.get(f'/history?limit=70&cursor={cursor}').get_json()
+            paged.extend(s['session_number'] for s in json_data['sessions'])
+            cursor = json_data['next_cursor']
+        assert paged == full
+    
+    def test_time_range_skips_other_segments(self, client, monkeypatch, temp_log_file):
+        """Test that archives outside the requested range are not opened"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        for day in (1, 2, 3):
+            self.write_day(temp_log_file, day, 20)
+            self.rotate(temp_log_file)
+        
+        opened = []
+        original = log_archive.iter_segment_lines
+        monkeypatch.setattr('log_archive.iter_segment_lines',
+                            lambda log_file, segment, start=0: opened.append(segment['first']) or original(log_file, segment, start))
+        
+        sessions = client.get('/history?since=2024-01-02&until=2024-01-02').get_json()['sessions']
+        assert len(sessions) == 20
+        assert opened == ['2024-01-02 10:00:00']
+    
+    def test_stats_include_archived_segments(self, client, monkeypatch, temp_log_file):
+        """Test that stats combine archived rollups with the active log"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_day(temp_log_file, 1, 5)
+        self.rotate(temp_log_file)
+        self.write_day(temp_log_file, 1, 2, first=5)
+        
+        assert client.get('/stats').get_json()['days'] == {'2024-01-01': {'work': {'completed': 7}}}
+    
+    def test_retention_drops_old_segments(self, client, monkeypatch, temp_log_file):
+        """Test that segments older than the retention period are deleted"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_day(temp_log_file, 1, 5)
+        self.rotate(temp_log_file)
+        old_path = log_archive.segment_path(temp_log_file, log_archive.load_manifest(temp_log_file)['segments'][0])
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        
+        result = app.test_cli_runner().invoke(args=['rotate-log', '--retention-days', '30'])
+        
+        assert 'Archived 1 lines' in result.output
+        manifest = log_archive.load_manifest(temp_log_file)
+        assert len(manifest['segments']) == 1
+        assert manifest['next_line'] == 6
+        assert not os.path.exists(old_path)
+    
+    def test_compaction_merges_segments(self, client, monkeypatch, temp_log_file):
+        """Test that compaction merges adjacent segments without changing history"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        for day in (1, 2, 3):
+            self.write_day(temp_log_file, day, 10)
+            self.rotate(temp_log_file)
+        before = client.get('/history').get_json()['sessions']
+        
+        result = app.test_cli_runner().invoke(args=['compact-archive'])
+        
+        assert 'Merged away 2 segments' in result.output
+        (segment,) = log_archive.load_manifest(temp_log_file)['segments']
+        assert (segment['first_line'], segment['lines']) == (0, 30)
+        assert client.get('/history').get_json()['sessions'] == before
+        assert client.get('/stats').get_json()['totals'] == {'work': {'completed': 30}}
+    
+    def test_stream_opens_one_segment_at_a_time(self, client, monkeypatch, temp_log_file):
+        """Test that an export over many segments never holds more than one of them open"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        for day in range(1, 8):
+            self.write_day(temp_log_file, day, 3)
+            self.rotate(temp_log_file)
+        
+        open_now, most = [0], [0]
+        original = log_archive.open_segment_lines
+        def counted(log_file, segment, start=0):
+            lines = original(log_file, segment, start)
+            open_now[0] += 1
+            most[0] = max(most[0], open_now[0])
+            def lines_then_close():
+                try:
+                    yield from lines
+                finally:
+                    open_now[0] -= 1
+            return lines_then_close()
+        monkeypatch.setattr('log_archive.open_segment_lines', counted)
+        
+        records = client.get('/history/export').data.decode().splitlines()
+        assert len(records) == 21
+        assert most[0] == 1
+        assert open_now[0] == 0
+    
+    def test_stream_survives_compaction_and_retention(self, client, monkeypatch, temp_log_file):
+        """Test that a stream finds compacted segments again and skips ones retention deleted"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        for day in (1, 2, 3):
+            self.write_day(temp_log_file, day, 10, first=10 * (day - 1))
+            self.rotate(temp_log_file)
+        store = storage.TextStorage(temp_log_file)
+        
+        compacted = store.stream()
+        first = [next(compacted) for _ in range(5)]
+        assert log_archive.compact_archive(temp_log_file, 1 << 20) == 2
+        numbers = [session['session_number'] for _, session in first + list(compacted)]
+        assert numbers == [f'session_{i}' for i in range(30)]
+        
+        for day in (4, 5):
+            self.write_day(temp_log_file, day, 10, first=10 * (day - 1))
+            self.rotate(temp_log_file)
+        retained = store.stream()
+        first = [next(retained) for _ in range(5)]
+        fourth = log_archive.load_manifest(temp_log_file)['segments'][1]
+        log_archive._replace_segments(temp_log_file, [fourth['file']], None)
+        numbers = [session['session_number'] for _, session in first + list(retained)]
+        assert numbers == [f'session_{i}' for i in [*range(30), *range(40, 50)]]
+    
+    def test_size_trigger_rotates_on_write(self, client, monkeypatch, temp_log_file):
+        """Test that /log rotates the log once it reaches the size limit"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.ROTATE_MAX_BYTES', 200)
+        monkeypatch.setattr('log_archive.threading.Thread', FakeThread)
+        
+        for i in range(6):
+            client.post('/log', data=json.dumps({'session_number': i}), content_type='application/json')
+        
+        manifest = log_archive.load_manifest(temp_log_file)
+        assert len(manifest['segments']) == 1
+        assert manifest['segments'][0]['file'].endswith('.gz')
+        assert len(client.get('/history').get_json()['sessions']) == 6
+
+
+class FakeThread:
+    """Runs a thread target synchronously so background work is deterministic in tests"""
+    
+    def __init__(self, target, args=(), **kwargs):
+        self.target = target
+        self.args = args
+    
+    def start(self):
+        self.target(*self.args)
+
+
+class TestConditionalGet:
+    """Tests for ETag/Last-Modified validation of cached responses"""
+    
+    def test_history_returns_validators(self, client, monkeypatch, temp_log_file):
+        """Test that history responses carry ETag and Last-Modified"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        response = client.get('/history')
+        assert response.headers.get('ETag')
+        assert response.headers.get('Last-Modified')
+    
+    def test_history_304_when_unchanged(self, client, monkeypatch, temp_log_file):
+        """Test that an unchanged log answers If-None-Match without reading it"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        etag = client.get('/history').headers['ETag']
+        
+        def fail_open(*args, **kwargs):
+            raise AssertionError('log file should not be read')
+        monkeypatch.setattr('builtins.open', fail_open)
+        
+        response = client.get('/history', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == etag
+    
+    def test_history_200_after_write(self, client, monkeypatch, temp_log_file):
+        """Test that a new session invalidates the ETag"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        etag = client.get('/history').headers['ETag']
+        
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        
+        response = client.get('/history', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert len(response.get_json()['sessions']) == 1
+    
+    def test_rotation_invalidates_etag(self, client, monkeypatch, temp_log_file):
+        """Test that sessions moved into the archive change the ETag even when no active log exists"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        client.post('/log', data=json.dumps({}), content_type='application/json')
+        log_archive.rotate_log(temp_log_file, force=True)
+        etags = {path: client.get(path).headers['ETag'] for path in ('/history', '/stats')}
+        
+        for _ in range(2):
+            client.post('/log', data=json.dumps({}), content_type='application/json')
+        log_archive.rotate_log(temp_log_file, force=True)
+        
+        for path, etag in etags.items():
+            response = client.get(path, headers={'If-None-Match': etag})
+            assert response.status_code == 200
+            assert response.headers['ETag'] != etag
+        assert len(client.get('/history').get_json()['sessions']) == 3
+    
+    def test_index_304_when_unchanged(self, client):
+        """Test that the index page honours If-None-Match"""
+        etag = client.get('/').headers['ETag']
+        
+        response = client.get('/', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+    
+    def test_errors_are_not_validated(self, client, monkeypatch, temp_log_file):
+        """Test that error responses carry no ETag"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        response = client.get('/history?limit=abc')
+        assert response.status_code == 400
+        assert 'ETag' not in response.headers
+
+
+
+class TestHistoryStream:
+    """Tests for the /history/stream Server-Sent Events feed"""
+    
+    @pytest.fixture(autouse=True)
+    def fast_feed(self, monkeypatch, temp_log_file):
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.STREAM_MAX_SECONDS', 2)
+        monkeypatch.setattr('session_feed.POLL_INTERVAL', 0.01)
+    
+    def post(self, client, number, **fields):
+        client.post('/log', data=json.dumps(dict(fields, session_number=number)), content_type='application/json')
+    
+    def events(self, chunks, count):
+        """Read SSE messages from chunks until count session events arrived"""
+        events = []
+        for chunk in chunks:
+            for message in chunk.decode().split('\n\n'):
+                fields = dict(line.split(': ', 1) for line in message.splitlines() if not line.startswith(':'))
+                if fields.get('event') == 'session':
+                    events.append((int(fields['id']), json.loads(fields['data'])['session_number']))
+            if len(events) >= count:
+                break
+        return events
+    
+    def test_resumes_after_last_event_id(self, client):
+        """Test that a reconnect gets exactly the sessions after the id it last saw"""
+        for i in range(5):
+            self.post(client, i)
+        
+        response = client.get('/history/stream', headers={'Last-Event-ID': '2'}, buffered=False)
+        
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        assert response.headers['Cache-Control'] == 'no-cache'
+        assert self.events(response.iter_encoded(), 3) == [(3, 'session_2'), (4, 'session_3'), (5, 'session_4')]
+        response.close()
+    
+    def test_pushes_sessions_as_they_are_logged(self, client, temp_log_file):
+        """Test that a new stream starts at the end and then receives each logged session"""
+        self.post(client, 0)
+        response = client.get('/history/stream', buffered=False)
+        chunks = response.iter_encoded()
+        assert next(chunks).startswith(b'retry: ')
+        
+        self.post(client, 1)
+        assert self.events(chunks, 1) == [(2, 'session_1')]
+        # Written by another process: noticed through the generation counter alone
+        log_writer.append_lines(temp_log_file, ['2024-01-01 10:00:00 | work | completed | session_2\n'])
+        assert self.events(chunks, 1) == [(3, 'session_2')]
+        response.close()
+    
+    def test_filters_and_user_shards(self, client, monkeypatch, temp_log_file):
+        """Test that user_id picks the shard and session_type/action filter the events"""
+        monkeypatch.setattr('app.SHARD_DIR', temp_log_file + '.shards')
+        response = client.get('/history/stream?user_id=alice&action=skipped', buffered=False)
+        chunks = response.iter_encoded()
+        next(chunks)
+        
+        self.post(client, 1, user_id='bob', action='skipped')
+        self.post(client, 2, user_id='alice', action='completed')
+        self.post(client, 3, user_id='alice', action='skipped')
+        assert self.events(chunks, 1) == [(2, 'session_3')]
+        response.close()
+    
+    def test_streams_end_and_are_limited_per_worker(self, client, monkeypatch):
+        """Test that streams close after STREAM_MAX_SECONDS and excess ones are refused"""
+        import app as app_module
+        import session_feed
+        monkeypatch.setattr('app.MAX_STREAMS', 1)
+        monkeypatch.setattr('app.STREAM_MAX_SECONDS', 0.1)
+        
+        first = client.get('/history/stream', buffered=False)
+        second = client.get('/history/stream', buffered=False)
+        assert second.status_code == 503
+        assert second.headers['Retry-After']
+        
+        assert self.events(first.iter_encoded(), 1) == []
+        first.close()
+        assert session_feed.get_feed(app_module.get_storage()).subscriber_count() == 0
+        assert app_module._open_streams.count == 0
+    
+    def test_stream_limit_covers_every_shard(self, client, monkeypatch, temp_log_file):
+        """Test that streams of different user shards share the worker's limit"""
+        import app as app_module
+        monkeypatch.setattr('app.SHARD_DIR', temp_log_file + '.shards')
+        monkeypatch.setattr('app.MAX_STREAMS', 2)
+        
+        alice = client.get('/history/stream?user_id=alice', buffered=False)
+        bob = client.get('/history/stream?user_id=bob', buffered=False)
+        assert client.get('/history/stream?user_id=carol', buffered=False).status_code == 503
+        
+        alice.close()
+        carol = client.get('/history/stream?user_id=carol', buffered=False)
+        assert carol.status_code == 200
+        bob.close()
+        carol.close()
+        assert app_module._open_streams.count == 0
+    
+    def test_slow_subscriber_is_dropped(self, client, monkeypatch):
+        """Test that a client whose queue overflows is disconnected instead of buffering without bound"""
+        monkeypatch.setattr('session_feed.SUBSCRIBER_QUEUE_SIZE', 2)
+        response = client.get('/history/stream', buffered=False)
+        chunks = response.iter_encoded()
+        next(chunks)
+        
+        client.post('/log/batch', data=json.dumps([{'session_number': i} for i in range(5)]),
+                    content_type='application/json')
+        started = time.monotonic()
+        events = self.events(chunks, 10)
+        
+        assert len(events) < 5
+        assert time.monotonic() - started < 1
+        response.close()
+    
+    def test_invalid_last_event_id(self, client):
+        """Test that an unusable Last-Event-ID is rejected"""
+        assert client.get('/history/stream', headers={'Last-Event-ID': 'abc'}).status_code == 400
+        assert client.get('/history/stream?cursor=-1').status_code == 400
+
+class TestHistoryExport:
+    """Tests for the streaming /history/export endpoint"""
+    
+    def write_sessions(self, path, count, day=1, first=0):
+        with open(path, 'a') as f:
+            for i in range(first, first + count):
+                session_type = 'work' if i % 2 == 0 else 'short_break'
+                f.write(f"2024-01-{day:02d} 10:{i // 60:02d}:{i % 60:02d} | {session_type} | completed | session_{i}\n")
+    
+    def test_ndjson_is_default(self, client, monkeypatch, temp_log_file):
+        """Test that the export defaults to NDJSON with a resume cursor per record"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 3)
+        
+        response = client.get('/history/export')
+        
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        assert 'attachment' in response.headers['Content-Disposition']
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert [r['session_number'] for r in records] == ['session_0', 'session_1', 'session_2']
+        assert [r['cursor'] for r in records] == [1, 2, 3]
+    
+    def test_csv_via_accept_header(self, client, monkeypatch, temp_log_file):
+        """Test that Accept: text/csv selects CSV with a header row"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 2)
+        
+        response = client.get('/history/export', headers={'Accept': 'text/csv'})
+        
+        assert response.mimetype == 'text/csv'
+        assert response.data.decode().splitlines() == [
+            'cursor,timestamp,session_type,action,session_number',
+            '1,2024-01-01 10:00:00,work,completed,session_0',
+            '2,2024-01-01 10:00:01,short_break,completed,session_1'
+        ]
+    
+    def test_gzip_encoding(self, client, monkeypatch, temp_log_file):
+        """Test that the stream is gzip-compressed when the client accepts it"""
+        import gzip
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('app.EXPORT_CHUNK_RECORDS', 7)
+        self.write_sessions(temp_log_file, 50)
+        
+        response = client.get('/history/export', headers={'Accept-Encoding': 'gzip'})
+        
+        assert response.headers['Content-Encoding'] == 'gzip'
+        lines = gzip.decompress(response.data).decode().splitlines()
+        assert len(lines) == 50
+        assert json.loads(lines[-1])['session_number'] == 'session_49'
+    
+    def test_resume_from_cursor_across_archive(self, client, monkeypatch, temp_log_file):
+        """Test that an interrupted export resumes after the last cursor received"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 100)
+        app.test_cli_runner().invoke(args=['rotate-log'])
+        self.write_sessions(temp_log_file, 100, day=2, first=100)
+        
+        full = [json.loads(line) for line in client.get('/history/export').data.decode().splitlines()]
+        resumed = [json.loads(line) for line in
+                   client.get(f"/history/export?cursor={full[129]['cursor']}").data.decode().splitlines()]
+        
+        assert len(full) == 200
+        assert resumed == full[130:]
+    
+    def test_filters_and_bad_format(self, client, monkeypatch, temp_log_file):
+        """Test that filters apply to the export and unknown formats are rejected"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.write_sessions(temp_log_file, 10)
+        
+        response = client.get('/history/export?format=csv&session_type=short_break')
+        assert len(response.data.decode().splitlines()) == 1 + 5
+        
+        response = client.get('/history/export?format=xml')
+        assert response.status_code == 400
+
+
+class TestStaticAssets:
+    """Tests for the fingerprinted, pre-gzipped static assets"""
+    
+    @pytest.fixture
+    def asset_dir(self, monkeypatch):
+        path = tempfile.mkdtemp()
+        monkeypatch.setattr('app.ASSET_DIR', path)
+        yield path
+        shutil.rmtree(path, ignore_errors=True)
+    
+    def build(self):
+        import app as app_module
+        return app_module.build_static_assets(app)
+    
+    def test_build_writes_hashed_minified_and_gzipped_files(self, asset_dir):
+        """Test that each asset is written under a content hash, with a gzip copy and a manifest"""
+        manifest = self.build()
+        
+        assert sorted(manifest) == ['style.css', 'timer.js']
+        with open(os.path.join(asset_dir, 'manifest.json')) as f:
+            assert json.load(f) == manifest
+        for name, built in manifest.items():
+            with open(os.path.join(asset_dir, built), 'rb') as f:
+                content = f.read()
+            with open(os.path.join(asset_dir, built + '.gz'), 'rb') as f:
+                assert gzip.decompress(f.read()) == content
+            assert built == assets.fingerprinted_name(name, content)
+            assert len(content) < os.path.getsize(os.path.join(app.root_path, 'static', name))
+        assert self.build() == manifest  # builds are reproducible
+    
+    def test_minifiers(self):
+        """Test that comments and insignificant whitespace are removed"""
+        assert assets.minify_css('/* base */\nbody {\n    color: #333;\n    margin: 0 auto;\n}\n') == 'body{color:#333;margin:0 auto}\n'
+        assert assets.minify_js('// note\nfunction f() {\n\n    return 1; // one\n}\n') == 'function f() {\nreturn 1; // one\n}\n'
+    
+    def test_index_links_fingerprinted_assets(self, client, asset_dir):
+        """Test that the page links the plain files until a build exists, then the hashed ones"""
+        assert b'/static/timer.js' in client.get('/').data
+        etag = client.get('/').headers['ETag']
+        
+        manifest = self.build()
+        os.utime(os.path.join(asset_dir, 'manifest.json'), (time.time() + 10, time.time() + 10))
+        response = client.get('/', headers={'If-None-Match': etag})
+        
+        assert response.status_code == 200
+        assert f"/assets/{manifest['timer.js']}".encode() in response.data
+        assert f"/assets/{manifest['style.css']}".encode() in response.data
+    
+    def test_serves_gzip_with_immutable_caching(self, client, asset_dir):
+        """Test that an asset is sent pre-compressed to gzip clients and cached for good"""
+        built = self.build()['timer.js']
+        
+        response = client.get(f'/assets/{built}', headers={'Accept-Encoding': 'gzip, br'})
+        
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.mimetype == 'text/javascript'
+        assert 'immutable' in response.headers['Cache-Control']
+        assert 'max-age=31536000' in response.headers['Cache-Control']
+        assert 'Accept-Encoding' in response.headers['Vary']
+        with open(os.path.join(asset_dir, built), 'rb') as f:
+            content = f.read()
+        assert gzip.decompress(response.data) == content
+        
+        plain = client.get(f'/assets/{built}')
+        assert 'Content-Encoding' not in plain.headers
+        assert plain.data == content
+    
+    def test_unknown_and_internal_files_are_not_served(self, client, asset_dir):
+        """Test that the manifest, gzip copies and missing files answer 404"""
+        built = self.build()['style.css']
+        
+        assert client.get('/assets/manifest.json').status_code == 404
+        assert client.get(f'/assets/{built}.gz').status_code == 404
+        assert client.get('/assets/missing.0123456789ab.js').status_code == 404
+
+
+class TestAppFactory:
+    """Tests for create_app() and warm_up()"""
+    
+    def test_create_app_applies_settings(self, monkeypatch, temp_log_file):
+        """Test that a factory-built app serves requests with the given settings"""
+        import app as app_module
+        monkeypatch.setattr('app.LOG_FILE', app_module.LOG_FILE)  # restored afterwards
+        
+        factory_app = app_module.create_app({'LOG_FILE': temp_log_file, 'TESTING': True})
+        client = factory_app.test_client()
+        client.post('/log', data=json.dumps({'session_number': 7}), content_type='application/json')
+        
+        assert factory_app is not app
+        assert factory_app.config['TESTING'] is True
+        assert app_module.LOG_FILE == temp_log_file
+        assert client.get('/history').get_json()['sessions'][0]['session_number'] == 'session_7'
+        assert client.get('/').status_code == 200
+    
+    def test_default_app_is_built_on_first_use(self, tmp_path):
+        """Test that importing the module builds no app, so wsgi.py's create_app() makes the only one"""
+        import subprocess
+        import sys
+        script = ('import app; assert app._default_app is None; built = app.create_app(); '
+                  'assert app._default_app is None and app.app is not built and app._apps_built == 2')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', script], cwd=tmp_path, env=env, check=True)
+    
+    def test_reconfiguring_warns(self, monkeypatch, temp_log_file, caplog):
+        """Test that a second create_app() with other settings says it moves every app of the process"""
+        import app as app_module
+        monkeypatch.setattr('app.LOG_FILE', app_module.LOG_FILE)  # restored afterwards
+        app_module.create_app({'LOG_FILE': app_module.LOG_FILE})
+        assert not caplog.records
+        
+        app_module.create_app({'LOG_FILE': temp_log_file})
+        assert 'LOG_FILE' in caplog.text
+    
+    def test_warm_up_prepares_caches(self, monkeypatch, temp_log_file):
+        """Test that warming up builds the index, rollups and history cache before the first request"""
+        import app as app_module
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        with open(temp_log_file, 'w') as f:
+            for i in range(100):
+                f.write(f"2024-01-01 10:00:00 | work | completed | session_{i}\n")
+        
+        app_module.warm_up(app)
+        
+        assert os.path.exists(log_index.index_path(temp_log_file))
+        assert os.path.exists(rollups.stats_path(temp_log_file))
+        monkeypatch.setattr('storage.parse_counter', storage._ParseCounter())
+        cache = history_cache.get_cache(temp_log_file, storage.parse_log_line, app_module.HISTORY_CACHE_RECORDS)
+        assert cache.offset == os.path.getsize(temp_log_file)
+        assert len(app.test_client().get('/history').get_json()['sessions']) == 100
+        assert storage.parse_counter.records == 0
+
+
+class TestBenchmark:
+    """Tests for the helpers of the offline benchmark suite"""
+    
+    def test_generated_log_is_valid_and_ordered(self, client, monkeypatch, temp_log_file):
+        """Test that synthetic logs parse and serve like real ones"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        benchmark.generate_log(temp_log_file, 25000)
+        
+        assert client.get('/history?limit=1&cursor=24999').get_json()['sessions'][0]['session_number'] == 'session_4'
+        assert log_index.refresh_index(temp_log_file) == 25000
+        first, last = log_index.time_span(temp_log_file)
+        assert first < last
+    
+    def test_compare_flags_regressions(self):
+        """Test that slower latencies and lower throughput beyond the tolerance are reported"""
+        baseline = {'results': {'test_client': {'1000': {
+            'history_last': {'p50_ms': 10.0, 'cold_ms': 10.0}, 'log_rps': 1000.0}}}}
+        current = {'results': {'test_client': {'1000': {
+            'history_last': {'p50_ms': 13.0, 'cold_ms': 90.0}, 'log_rps': 700.0}}}}
+        
+        regressions = benchmark.compare(current, baseline, tolerance=0.2)
+        
+        assert len(regressions) == 2
+        assert regressions[0].startswith('test_client/1000/history_last/p50_ms')
+        assert regressions[1].startswith('test_client/1000/log_rps')
+        assert benchmark.compare(current, baseline, tolerance=0.5) == []
+    
+    def test_compare_ignores_noise(self):
+        """Test that sub-millisecond latency changes never count as regressions"""
+        baseline = {'results': {'test_client': {'1000': {'stats': {'p50_ms': 0.3}}}}}
+        current = {'results': {'test_client': {'1000': {'stats': {'p50_ms': 0.6}}}}}
+        
+        assert benchmark.compare(current, baseline, tolerance=0.2) == []
+    
+    def test_log_throughput_per_durability_mode(self, monkeypatch, temp_log_file):
+        """Test that each requested durability mode gets its own higher-is-better throughput"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        start, end = benchmark.generate_log(temp_log_file, 100)
+        
+        results = benchmark.bench_test_client(temp_log_file, 100, start, end, 5, 1, ('none', 'always'))
+        
+        assert results['log_rps'] > 0 and results['log_rps_always'] > 0
+        assert log_writer.DURABILITY == 'none'
+        slower = {'results': {'test_client': {'100': {'log_rps_always': results['log_rps_always'] / 10}}}}
+        assert len(benchmark.compare(slower, {'results': {'test_client': {'100': results}}}, tolerance=0.2)) == 1
+
+
+class TestLogFileIntegrity:
+    """Tests for log file integrity and format"""
+    
+    def test_log_file_format(self, client, monkeypatch, temp_log_file):
+        """Test that log entries follow the correct format"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        data = {
+            'session_type': 'work',
+            'action': 'completed',
+            'session_number': 1
+        }
+        
+        client.post('/log',
+                   data=json.dumps(data),
+                   content_type='application/json')
+        
+        # Read and verify format
+        with open(temp_log_file, 'r') as f:
+            line = f.readline().strip()
+            parts = line.split(' | ')
+            
+            assert len(parts) == 4
+            # Verify timestamp format (basic check)
+            assert len(parts[0]) > 0
+            assert parts[1] == 'work'
+            assert parts[2] == 'completed'
+            assert parts[3] == 'session_1'
+    
+    def test_log_file_append_mode(self, client, monkeypatch, temp_log_file):
+        """Test that log entries are appended, not overwritten"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        # Log first session
+        client.post('/log',
+                   data=json.dumps({'session_type': 'work', 'action': 'completed', 'session_number': 1}),
+                   content_type='application/json')
+        
+        # Log second session
+        client.post('/log',
+                   data=json.dumps({'session_type': 'work', 'action': 'completed', 'session_number': 2}),
+                   content_type='application/json')
+        
+        # Verify both entries exist
+        with open(temp_log_file, 'r') as f:
+            lines = f.readlines()
+            assert len(lines) == 2
+            assert 'session_1' in lines[0]
+            assert 'session_2' in lines[1]
+
+
+
+class TestDurability:
+    """Tests for durability modes, checksummed records and torn-record recovery"""
+    
+    def post(self, client, payload):
+        return client.post('/log', data=json.dumps(payload), content_type='application/json')
+    
+    def count_fsyncs(self, monkeypatch):
+        calls = []
+        original = os.fsync
+        monkeypatch.setattr('os.fsync', lambda fd: calls.append(fd) or original(fd))
+        return calls
+    
+    def test_checksummed_lines_round_trip(self, client, monkeypatch, temp_log_file):
+        """Test that framed lines carry a CRC-32 field and read back like plain ones"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        self.post(client, {'session_number': 1})
+        monkeypatch.setattr('framing.ENABLED', True)
+        self.post(client, {'session_number': 2, 'action': 'skipped'})
+        
+        with open(temp_log_file, 'r') as f:
+            lines = f.readlines()
+        assert len(lines[0].split(' | ')) == 4
+        assert lines[1].split(' | ')[4].startswith('crc32=')
+        sessions = client.get('/history').get_json()['sessions']
+        assert [s['session_number'] for s in sessions] == ['session_1', 'session_2']
+        assert client.get('/stats').get_json()['totals'] == {'work': {'completed': 1, 'skipped': 1}}
+    
+    def test_damaged_record_is_not_served(self, client, monkeypatch, temp_log_file):
+        """Test that a framed line whose checksum fails is skipped by /history and /stats"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('framing.ENABLED', True)
+        with open(temp_log_file, 'w') as f:
+            f.write(storage.format_log_entry({'timestamp': datetime(2024, 1, 1, 9), 'session_type': 'work',
+                                              'action': 'completed', 'session_number': 1}).replace('work', 'walk'))
+            f.write(storage.format_log_entry({'timestamp': datetime(2024, 1, 1, 10), 'session_type': 'work',
+                                              'action': 'completed', 'session_number': 2}))
+        
+        assert [s['session_number'] for s in client.get('/history').get_json()['sessions']] == ['session_2']
+        assert client.get('/stats').get_json()['totals'] == {'work': {'completed': 1}}
+    
+    def test_recovery_truncates_torn_tail(self, temp_log_file):
+        """Test that an unterminated last line and framed lines failing their checksum are cut off"""
+        good = framing.frame('2024-01-01 09:00:00 | work | completed | session_1\n')
+        damaged = framing.frame('2024-01-01 09:30:00 | work | completed | session_2\n').replace('session_2', 'session_9')
+        with open(temp_log_file, 'w') as f:
+            f.write(good + damaged + '2024-01-01 10:00:00 | wo')
+        
+        removed = log_writer.recover_tail(temp_log_file)
+        
+        with open(temp_log_file, 'r') as f:
+            assert f.read() == good
+        assert removed == len(damaged) + len('2024-01-01 10:00:00 | wo')
+        assert log_writer.recover_tail(temp_log_file) == 0
+    
+    def test_recovery_keeps_plain_lines_and_reads_only_the_tail(self, temp_log_file):
+        """Test that unframed complete lines are kept and a tail without any newline is left alone"""
+        plain = '2024-01-01 09:00:00 | work | completed | session_1\n'
+        with open(temp_log_file, 'w') as f:
+            f.write(plain * 3)
+        assert log_writer.recover_tail(temp_log_file) == 0
+        
+        with open(temp_log_file, 'a') as f:
+            f.write('x' * 100)
+        assert log_writer.recover_tail(temp_log_file, block_size=50) == 0
+        assert log_writer.recover_tail(temp_log_file) == 100
+        assert os.path.getsize(temp_log_file) == len(plain) * 3
+    
+    def test_opening_the_log_recovers_it(self, client, monkeypatch, temp_log_file):
+        """Test that a torn record left by a crash is removed before the next append"""
+        with open(temp_log_file, 'w') as f:
+            f.write('2024-01-01 09:00:00 | work | completed | session_1\n2024-01-01 09:3')
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        
+        self.post(client, {'session_number': 2})
+        
+        with open(temp_log_file, 'r') as f:
+            lines = f.readlines()
+        assert len(lines) == 2
+        assert lines[1].endswith('| session_2\n')
+    
+    def test_binary_recovery(self, client, monkeypatch, temp_log_file):
+        """Test that a partial binary record is truncated when the store is opened"""
+        binary_log_file = temp_log_file + '.bin'
+        with open(binary_log_file, 'wb') as f:
+            f.write(b'\x00' * (binary_store.RECORD.size + 3))
+        monkeypatch.setattr('app.BINARY_LOG_FILE', binary_log_file)
+        monkeypatch.setattr('app.STORAGE_ENGINE', 'binary')
+        
+        self.post(client, {'session_number': 2})
+        
+        assert os.path.getsize(binary_log_file) == 2 * binary_store.RECORD.size
+        assert client.get('/history?last=1').get_json()['sessions'][0]['session_number'] == 'session_2'
+    
+    def test_none_never_fsyncs(self, client, monkeypatch, temp_log_file):
+        """Test that the default mode leaves flushing to the operating system"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        calls = self.count_fsyncs(monkeypatch)
+        
+        self.post(client, {})
+        assert calls == []
+    
+    def test_always_fsyncs_before_answering(self, client, monkeypatch, temp_log_file):
+        """Test that 'always' fsyncs the log (and the directory of a new log) and times it"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('log_writer.DURABILITY', 'always')
+        os.remove(temp_log_file)
+        calls = self.count_fsyncs(monkeypatch)
+        
+        assert self.post(client, {}).status_code == 200
+        assert len(calls) == 2
+        self.post(client, {})
+        assert len(calls) == 3
+        assert 'pomodoro_log_fsync_duration_seconds_count 2' in client.get('/metrics').get_data(as_text=True)
+    
+    def test_interval_defers_fsync_to_the_syncer(self, client, monkeypatch, temp_log_file):
+        """Test that 'interval' marks written files and the syncer thread fsyncs them in one pass"""
+        monkeypatch.setattr('app.LOG_FILE', temp_log_file)
+        monkeypatch.setattr('log_writer.DURABILITY', 'interval')
+        syncer = log_writer.IntervalSyncer(3600)
+        monkeypatch.setattr('log_writer._syncer', syncer)
+        calls = self.count_fsyncs(monkeypatch)
+        
+        self.post(client, {})
+        self.post(client, {})
+        assert calls == []
+        assert syncer.dirty == {temp_log_file}
+        
+        syncer.close()
+        assert len(calls) == 1
+        assert syncer.dirty == set()
+    
+    def test_sqlite_follows_durability(self, monkeypatch, temp_log_file):
+        """Test that 'always' makes SQLite sync its WAL on every commit"""
+        monkeypatch.setattr('log_writer.DURABILITY', 'always')
+        connection = storage.sqlite_connection(temp_log_file + '.db')
+        try:
+            assert connection.execute('PRAGMA synchronous').fetchone()[0] == 2
+        finally:
+            storage.close_sqlite_connections(temp_log_file + '.db')
 
 class TestErrorHandling:
     """Tests for error handling"""
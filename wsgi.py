@@ -9,11 +9,23 @@ project_home = os.path.dirname(os.path.abspath(__file__))
 if project_home not in sys.path:
     sys.path.insert(0, project_home)
 
-# Import the Flask application
-from pomodoro_app.app import app
+# The app imports its helper modules (log_index, ...) as top-level modules
+app_home = os.path.join(project_home, 'pomodoro_app')
+if app_home not in sys.path:
+    sys.path.insert(0, app_home)
 
-# This is the WSGI application object that Azure App Service will use
-application = app
+# Build the Flask application, its fingerprinted static assets and its
+# caches. With gunicorn's preload_app this happens once in the master,
+# before workers are forked.
+from pomodoro_app.app import build_static_assets, create_app, logger, warm_up
+
+application = create_app()
+try:
+    build_static_assets(application)
+except OSError as e:
+    # A read-only deployment still works; the page links the plain static files
+    logger.warning('Could not build static assets: %s', e)
+warm_up(application)
 
 if __name__ == "__main__":
-    application.run()
\ No newline at end of file
+    application.run()